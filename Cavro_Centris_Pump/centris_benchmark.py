@@ -0,0 +1,93 @@
+"""
+Throughput of the Cavro Centris driver against the pty stand-in
+(centris_emulator.py)
+
+naive       one command string per move, waiting for each to finish by
+            polling the status before sending the next
+queued      the same moves through CentrisPump's queue, merged into as few
+            command strings as the protocol allows
+overlapped  the queued moves while another thread polls the plunger
+            position, as a dashboard would
+
+Usage:
+python centris_benchmark.py
+python centris_benchmark.py --moves 200 --time-scale 0.001
+"""
+
+def sequence(n):
+    """n move commands of a fluidics run: valve switches, pickups, dispenses"""
+    moves = []
+    for i in range(0,n//2):
+        moves += ["I1P%d" % (100+i%50),"O2D%d" % (100+i%50)]
+    return moves
+
+def naive(pump,moves):
+    """One round trip per move plus polling until the pump is ready"""
+    from time import sleep
+    for move in moves:
+        ready,error,data = pump.transact(move+"R")
+        while True:
+            ready,error,data = pump.transact("Q")
+            if ready: break
+            sleep(pump.poll_interval)
+
+def run(moves=100,time_scale=0.01):
+    from time import perf_counter
+    from threading import Thread
+    from centris_emulator import CentrisEmulator
+    from centris_pump import CentrisPump
+    results = {}
+    commands = sequence(moves)
+    for name in "naive","queued","overlapped":
+        emulator = CentrisEmulator(time_scale=time_scale)
+        emulator.start()
+        pump = CentrisPump()
+        if name == "naive":
+            from serial import Serial
+            pump.port = Serial(emulator.port_name,baudrate=pump.baudrate,
+                timeout=pump.timeout)
+            pump.transact("ZR")
+        else:
+            pump.open(emulator.port_name)
+            pump.initialize().result()
+        emulator.busy_until = 0
+        polls = [0]
+        start = perf_counter()
+        if name == "naive": naive(pump,commands)
+        else:
+            futures = [pump.move(move) for move in commands]
+            if name == "overlapped":
+                def poll():
+                    while not futures[-1].done():
+                        pump.position().result()
+                        polls[0] += 1
+                thread = Thread(target=poll)
+                thread.start()
+            for future in futures: future.result()
+            if name == "overlapped": thread.join()
+        elapsed = perf_counter()-start
+        results[name] = {"moves_per_second":len(commands)/elapsed,
+            "seconds":elapsed,"executions":emulator.executions,
+            "round_trips":pump.round_trips,"position_polls":polls[0]}
+        if name == "naive": pump.port.close()
+        else: pump.close()
+        emulator.stop()
+    return results
+
+def report(results):
+    lines = ["%-12s %10s %9s %11s %12s %7s" % ("mode","moves/s","seconds",
+        "executions","round trips","polls")]
+    for name in "naive","queued","overlapped":
+        r = results[name]
+        lines += ["%-12s %10.1f %9.3f %11d %12d %7d" % (name,r["moves_per_second"],
+            r["seconds"],r["executions"],r["round_trips"],r["position_polls"])]
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--moves",type=int,default=100)
+    parser.add_argument("--time-scale",type=float,default=0.01,
+        help="simulated move duration factor")
+    args = parser.parse_args()
+    print(report(run(args.moves,args.time_scale)))
@@ -0,0 +1,151 @@
+"""
+Cavro Centris pump stand-in on a Linux pseudo-terminal
+
+Understands the command strings of centris_pump.py, "/1<commands>R\r" and
+the queries "/1?\r", "/1?6\r", "/1Q\r", and answers like the pump:
+"/0<status><data>\x03\r\n". Moves take simulated time: plunger moves at
+the top speed (V, steps/s), valve moves valve_time seconds, delays (M) their
+duration, all multiplied by time_scale. An execution command received while
+busy is rejected with error 15 (command overflow), moves before
+initialization (Z) with error 7, positions outside 0...max_position with
+error 3.
+
+Usage:
+from centris_emulator import CentrisEmulator
+emulator = CentrisEmulator(time_scale=0.01)
+emulator.start()
+pump.open(emulator.port_name)
+emulator.stop()
+"""
+from logging import debug
+import re
+
+class CentrisEmulator(object):
+    """Emulated Cavro Centris pump on a pseudo-terminal"""
+    max_position = 30000 # steps
+    valve_time = 0.2 # seconds per valve move
+
+    def __init__(self,time_scale=1.0,baudrate=9600):
+        self.time_scale = time_scale
+        self.baudrate = baudrate
+        self.initialized = False
+        self.position = 0
+        self.valve = 1
+        self.speed = 1400 # steps/s
+        self.busy_until = 0.0
+        self.error = 0
+        self.commands = 0 # command strings received
+        self.executions = 0 # command strings executed
+        self.master = None
+        self.slave = None
+        self.thread = None
+
+    @property
+    def port_name(self):
+        from os import ttyname
+        return ttyname(self.slave) if self.slave is not None else ""
+
+    @property
+    def busy(self):
+        from time import time
+        return time() < self.busy_until
+
+    def start(self):
+        from os import openpty
+        from threading import Thread
+        import tty
+        self.master,self.slave = openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.thread = Thread(target=self.run,name="centris_emulator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        from os import close
+        master,slave = self.master,self.slave
+        self.master,self.slave = None,None
+        for fd in master,slave:
+            if fd is not None:
+                try: close(fd)
+                except OSError: pass
+        if self.thread is not None: self.thread.join(1.0)
+
+    def run(self):
+        from os import read,write
+        from time import sleep
+        master = self.master
+        line = b""
+        while self.master is not None:
+            try:
+                data = read(master,256)
+                if not data: break
+                line += data
+                while b"\r" in line:
+                    command,line = line.split(b"\r",1)
+                    reply = self.reply(command.decode("ascii","replace"))
+                    if not reply: continue
+                    # line time of command and reply at 10 bits per byte
+                    if self.baudrate: sleep((len(command)+1+len(reply))*10.0/self.baudrate)
+                    write(master,reply)
+            except (OSError,TypeError): break # closed by stop()
+
+    def reply(self,command):
+        """Answer to one command string, empty if not addressed to us"""
+        if not command.startswith("/1"): return b""
+        self.commands += 1
+        body = command[2:]
+        data = ""
+        error = 0
+        if body == "?": data = "%d" % self.position
+        elif body == "?6": data = "%d" % self.valve
+        elif body == "Q": error = self.error
+        elif body.endswith("R"):
+            if self.busy: error = 15
+            else:
+                error = self.execute(body[:-1])
+                self.error = error
+        else: error = 2
+        status = 0x40 | (0 if self.busy else 0x20) | error
+        debug("centris emulator: %r: status 0x%X %r" % (command,status,data))
+        return ("/0%c%s\x03\r\n" % (status,data)).encode("latin-1")
+
+    def execute(self,commands):
+        """Run the moves of a command string. Returns the error code"""
+        from time import time
+        moves = re.findall(r"([A-Za-z])(\d*)",commands)
+        if "".join([c+n for c,n in moves]) != commands: return 2
+        duration = 0.0
+        position,valve = self.position,self.valve
+        for command,operand in moves:
+            n = int(operand) if operand else 0
+            if command == "Z":
+                position,valve = 0,1
+                duration += 1.0
+                self.initialized = True
+                continue
+            if not self.initialized: return 7
+            if command in "APD":
+                target = {"A":n,"P":position+n,"D":position-n}[command]
+                if not 0 <= target <= self.max_position: return 3
+                duration += abs(target-position)/float(self.speed)
+                position = target
+            elif command in "IOB":
+                if command in "IO" and n: valve = n
+                duration += self.valve_time
+            elif command == "V": self.speed = max(n,1)
+            elif command == "M": duration += n/1000.0
+            else: return 2
+        self.position,self.valve = position,valve
+        self.executions += 1
+        self.busy_until = time()+duration*self.time_scale
+        return 0
+
+if __name__ == "__main__":
+    from time import sleep
+    emulator = CentrisEmulator()
+    emulator.start()
+    print("Centris emulator at %s" % emulator.port_name)
+    try:
+        while True: sleep(1)
+    except KeyboardInterrupt: emulator.stop()
@@ -0,0 +1,235 @@
+"""
+Cavro Centris syringe pump driver with a pipelined command queue
+
+Protocol (Cavro DT, ASCII): a command string "/<address><commands>R\\r" is
+executed as a whole; the pump answers "/0<status><data>\\x03\\r\\n".
+Status byte: bit 5 (0x20) set = ready, clear = busy; bits 3-0 = error code.
+Several move commands may be concatenated in one command string, e.g.
+"I1A3000O2A0R" (valve to port 1, pick up to 3000, valve to port 2, dispense
+all). Queries ("?" plunger position, "?6" valve position, "Q" status) are
+answered at any time, also while the pump is busy.
+
+The driver never blocks the caller. Every call returns a Future
+(concurrent.futures) and is queued for a worker thread that owns the port:
+- moves are merged, in order, into one command string per execution (up to
+  max_command_length), sent once the pump is idle; their futures complete
+  when the pump is idle again after executing them
+- queries jump ahead of queued moves and are sent immediately, so status
+  polling never waits for a move
+- while moves execute, the worker polls "Q" every poll_interval seconds
+
+Usage:
+from centris_pump import CentrisPump
+pump = CentrisPump()
+pump.open("/dev/ttyUSB0")
+pump.initialize().result()
+f = pump.pickup(1500,valve=1)   # returns at once
+... chiller and DAQ I/O ...
+f.result()                      # wait for the move
+pump.position().result()
+pump.close()
+
+Authors: Valentyn Stadnytskyi
+"""
+from logging import debug,warning
+from collections import deque
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+error_messages = {
+    1: "initialization error",
+    2: "invalid command",
+    3: "invalid operand",
+    4: "invalid command sequence",
+    6: "EEPROM failure",
+    7: "device not initialized",
+    9: "plunger overload",
+    10: "valve overload",
+    11: "plunger move not allowed",
+    15: "command overflow",
+}
+
+class PumpError(Exception):
+    """Error reported by the pump in the status byte"""
+    def __init__(self,code,command=""):
+        self.code = code
+        Exception.__init__(self,"%r: error %d: %s" % (command,code,
+            error_messages.get(code,"unknown error")))
+
+def parse_reply(reply):
+    """Status byte and data of a reply "/0<status><data>\\x03...".
+    Returns (ready,error code,data), raises IOError if malformed"""
+    start = reply.find(b"/0")
+    end = reply.find(b"\x03",start)
+    if start < 0 or end < start+3: raise IOError("invalid reply %r" % reply)
+    status = bytearray(reply[start+2:start+3])[0]
+    return bool(status & 0x20),status & 0x0F,reply[start+3:end].decode("ascii")
+
+class CentrisPump(object):
+    """Cavro Centris pump with a non-blocking command queue"""
+    name = "centris_pump"
+    baudrate = 9600
+    timeout = 0.5 # seconds to wait for a reply
+    poll_interval = 0.05 # seconds between status polls while busy
+    max_command_length = 255 # characters per command string
+
+    def __init__(self,address=1):
+        from threading import Event
+        self.address = address
+        self.port = None
+        self.moves = deque() # (command,future,None)
+        self.queries = deque() # (command,future,function converting the reply)
+        self.executing = [] # futures of the moves being executed
+        self.lock = allocate_lock()
+        self.wakeup = Event()
+        self.thread = None
+        self.running = False
+        self.round_trips = 0
+
+    def open(self,port_name):
+        """Open the port and start the worker thread"""
+        from serial import Serial
+        from threading import Thread
+        self.port = Serial(port_name,baudrate=self.baudrate,timeout=self.timeout)
+        self.running = True
+        self.thread = Thread(target=self.run,name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop the worker, failing queued commands, and release the port"""
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        with self.lock:
+            pending = list(self.moves)+list(self.queries)
+            self.moves.clear()
+            self.queries.clear()
+        for command,future,convert in pending:
+            future.set_exception(IOError("%s: closed" % self.name))
+        self.fail_executing(IOError("%s: closed" % self.name))
+        if self.port is not None: self.port.close()
+        self.port = None
+
+    # Non-blocking API: every method returns a Future
+    def move(self,commands):
+        """Queue move commands (without the trailing R), e.g. "I1A3000".
+        The Future's result is None once the pump has executed them"""
+        return self.submit(self.moves,commands)
+
+    def query(self,command,convert=None):
+        """Queue a query, e.g. "?" or "?6". The Future's result is the data
+        string of the reply, or convert(data) if given"""
+        def result(ready,error,data):
+            if error: raise PumpError(error,command)
+            return convert(data) if convert else data
+        return self.submit(self.queries,command,result)
+
+    def initialize(self): return self.move("Z")
+    def absolute(self,position): return self.move("A%d" % position)
+    def valve(self,port): return self.move("I%d" % port)
+    def speed(self,steps_per_second): return self.move("V%d" % steps_per_second)
+    def delay(self,milliseconds): return self.move("M%d" % milliseconds)
+
+    def pickup(self,steps,valve=None):
+        """Aspirate steps, through valve port valve if given"""
+        return self.move(("I%d" % valve if valve is not None else "")+"P%d" % steps)
+
+    def dispense(self,steps,valve=None):
+        return self.move(("O%d" % valve if valve is not None else "")+"D%d" % steps)
+
+    def position(self):
+        """Future of the plunger position in steps"""
+        return self.query("?",int)
+
+    def valve_position(self): return self.query("?6")
+
+    def status(self):
+        """Future of (ready,error code)"""
+        return self.submit(self.queries,"Q",lambda ready,error,data: (ready,error))
+
+    def wait(self):
+        """Future done when all moves queued so far have been executed"""
+        return self.move("")
+
+    def submit(self,queue,command,convert=None):
+        from concurrent.futures import Future
+        future = Future()
+        with self.lock: queue.append((command,future,convert))
+        self.wakeup.set()
+        return future
+
+    # Worker thread
+    def run(self):
+        from time import time
+        next_poll = 0.0
+        while self.running:
+            self.wakeup.clear()
+            try:
+                while self.serve_query(): pass
+                if self.executing and time() >= next_poll:
+                    self.poll()
+                    next_poll = time()+self.poll_interval
+                if not self.executing and self.moves:
+                    self.execute_moves()
+                    next_poll = time()+self.poll_interval
+            except Exception as msg:
+                warning("%s: %s" % (self.name,msg))
+                self.fail_executing(msg)
+            if self.executing: self.wakeup.wait(max(next_poll-time(),0))
+            elif not (self.moves or self.queries): self.wakeup.wait(1.0)
+
+    def transact(self,commands):
+        """Send one command string, return (ready,error,data)"""
+        command = ("/%d%s\r" % (self.address,commands)).encode("ascii")
+        self.port.write(command)
+        reply = self.port.read_until(b"\x03\r\n")
+        self.round_trips += 1
+        debug("%s: %r: %r" % (self.name,command,reply))
+        if not reply: raise IOError("%r: no reply" % command)
+        return parse_reply(reply)
+
+    def serve_query(self):
+        """Send the next query, if any. Returns False if there was none"""
+        with self.lock:
+            if not self.queries: return False
+            command,future,convert = self.queries.popleft()
+        if not future.set_running_or_notify_cancel(): return True
+        try: future.set_result(convert(*self.transact(command)))
+        except Exception as msg: future.set_exception(msg)
+        return True
+
+    def execute_moves(self):
+        """Merge queued moves into one command string and execute it"""
+        commands,futures = "",[]
+        with self.lock:
+            while self.moves:
+                command,future,convert = self.moves[0]
+                if futures and len(commands)+len(command)+4 > self.max_command_length:
+                    break
+                self.moves.popleft()
+                if future.set_running_or_notify_cancel():
+                    commands += command
+                    futures += [future]
+        if not futures: return
+        if not commands:
+            for future in futures: future.set_result(None)
+            return
+        self.executing = futures
+        ready,error,data = self.transact(commands+"R")
+        if error: self.fail_executing(PumpError(error,commands))
+
+    def poll(self):
+        """Status poll while moves execute"""
+        ready,error,data = self.transact("Q")
+        if error: self.fail_executing(PumpError(error,"Q"))
+        elif ready:
+            futures,self.executing = self.executing,[]
+            for future in futures: future.set_result(None)
+
+    def fail_executing(self,exception):
+        if not isinstance(exception,Exception): exception = IOError(exception)
+        futures,self.executing = self.executing,[]
+        for future in futures: future.set_exception(exception)
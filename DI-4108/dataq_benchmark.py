@@ -0,0 +1,100 @@
+"""
+Throughput and dropped-sample benchmarks of dataq_stream.py against the pty
+emulator (dataq_emulator.py)
+
+decode      vectorized decoding alone, scans/s
+sustained   emulator sending as fast as the pty accepts, scans/s and MB/s
+            received by the stream
+continuity  emulator at the nominal scan rate for duration seconds; every
+            scan lost, repeated or out of order shows as a gap in the ramp
+            the emulator sends
+
+Usage:
+python dataq_benchmark.py
+python dataq_benchmark.py --duration 10 --channels 8
+"""
+from numpy import diff,concatenate
+
+def decode_benchmark(device,scans=1000000):
+    """Scans/s decoded from an encoded buffer"""
+    from time import perf_counter
+    from numpy import frombuffer,zeros,uint8,int16
+    from dataq_emulator import DataqEmulator
+    emulator = DataqEmulator(device.name)
+    emulator.channels = dict(enumerate(device.channels))
+    data = frombuffer(emulator.encode(0,scans),dtype=uint8)
+    out = zeros((scans,len(device.channels)),dtype=int16)
+    start = perf_counter()
+    device.decode(data,out)
+    return scans/(perf_counter()-start)
+
+def gaps(blocks_seen,block):
+    """Count discontinuities of the ramp in channel 0, carrying the last
+    value of the previous block in blocks_seen"""
+    from dataq_emulator import ramp_length
+    values = block[:,0].astype(int)
+    if "last" in blocks_seen: values = concatenate([[blocks_seen["last"]],values])
+    blocks_seen["last"] = values[-1]
+    return int(((diff(values) % ramp_length) != 1).sum())
+
+def stream_benchmark(device,rate,duration,rate_factor=1.0,drop_rate=0.0,
+    block_scans=None):
+    """Run the stream against the emulator for duration seconds.
+    Returns dictionary with scans/s, MB/s, gaps, resyncs, overruns"""
+    from time import perf_counter
+    from dataq_emulator import DataqEmulator
+    from dataq_stream import DataqStream
+    emulator = DataqEmulator(device.name,drop_rate=drop_rate,rate_factor=rate_factor)
+    emulator.start()
+    stream = DataqStream(device,rate=rate,block_scans=block_scans)
+    stream.open(emulator.port_name)
+    stream.start()
+    seen = {}
+    count = 0
+    start = perf_counter()
+    for block in stream.blocks():
+        count += gaps(seen,block)
+        if perf_counter()-start >= duration: break
+    elapsed = perf_counter()-start
+    stream.stop()
+    stats = stream.stats()
+    stream.close()
+    emulator.stop()
+    return {"scans_per_second":stats["scans"]/elapsed,
+        "MB_per_second":stats["bytes"]/elapsed/1e6,"gaps":count,
+        "resyncs":stats["resyncs"],"overruns":stats["overruns"],
+        "dropped_bytes":emulator.dropped_bytes}
+
+def run(duration=3.0,channels=4):
+    from dataq_stream import DI4108,DI245
+    results = {}
+    for device,rate in [(DI4108(range(channels)),10000.0),
+        (DI245(range(channels)),14400.0/channels)]:
+        name = device.name
+        results[name+" decode"] = {"scans_per_second":decode_benchmark(device)}
+        results[name+" sustained"] = stream_benchmark(device,rate,duration,
+            rate_factor=0,block_scans=4096)
+        results[name+" continuity"] = stream_benchmark(device,rate,duration)
+    results["DI-245 resync"] = stream_benchmark(DI245(range(channels)),
+        14400.0/channels,duration,drop_rate=0.05)
+    return results
+
+def report(results):
+    lines = ["%-20s %12s %8s %6s %8s %9s %8s" % ("benchmark","scans/s","MB/s",
+        "gaps","resyncs","overruns","dropped")]
+    for name in sorted(results):
+        r = results[name]
+        lines += ["%-20s %12.0f %8s %6s %8s %9s %8s" % (name,r["scans_per_second"],
+            "%.2f" % r["MB_per_second"] if "MB_per_second" in r else "",
+            r.get("gaps",""),r.get("resyncs",""),r.get("overruns",""),
+            r.get("dropped_bytes",""))]
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--duration",type=float,default=3.0,
+        help="seconds per stream benchmark")
+    parser.add_argument("--channels",type=int,default=4)
+    args = parser.parse_args()
+    print(report(run(args.duration,args.channels)))
@@ -0,0 +1,165 @@
+"""
+DATAQ DI-4108 / DI-245 scan stream emulator on a Linux pseudo-terminal
+
+Echoes the ASCII configuration commands and, after the start command,
+streams scans in the device's binary format at the configured scan rate
+until the stop command. The number of channels and the rate are taken from
+the commands (slist/srate/dec or chn/xrate), as the device would.
+
+Every channel carries a ramp: channel c of scan k has count (k+c) modulo
+ramp_length, offset to be centred on zero, so that a consumer can detect
+every lost or repeated scan (see dataq_benchmark.py).
+
+Simulated line conditions:
+drop_rate   probability of losing one byte in each chunk sent
+            (DI-245: exercises the resynchronisation)
+rate_factor scans are sent this many times faster than configured
+            (0 = as fast as the pty accepts them)
+
+Usage:
+from dataq_emulator import DataqEmulator
+from dataq_stream import DataqStream,DI4108
+emulator = DataqEmulator("DI-4108")
+emulator.start()
+stream = DataqStream(DI4108(channels=[0,1]),rate=1000)
+stream.open(emulator.port_name)
+emulator.stop()
+"""
+from logging import debug
+from numpy import arange,zeros,uint8,int16
+
+ramp_length = 4096
+
+class DataqEmulator(object):
+    """Emulated DATAQ logger on a pseudo-terminal"""
+    chunk_time = 0.01 # seconds of scans sent at a time
+
+    def __init__(self,model="DI-4108",drop_rate=0.0,rate_factor=1.0,seed=None):
+        from random import Random
+        self.model = model
+        self.drop_rate = drop_rate
+        self.rate_factor = rate_factor
+        self.random = Random(seed)
+        self.channels = {} # scan list index: configuration
+        self.srate,self.dec,self.xrate = 60000,1,0 # rate settings
+        self.rate = 1000.0 # scans per second
+        self.scanning = False
+        self.scans = 0 # scans sent since start
+        self.dropped_bytes = 0
+        self.master = None
+        self.slave = None
+        self.thread = None
+
+    @property
+    def port_name(self):
+        from os import ttyname
+        return ttyname(self.slave) if self.slave is not None else ""
+
+    def start(self):
+        from os import openpty
+        from threading import Thread
+        import tty
+        self.master,self.slave = openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.thread = Thread(target=self.run,name="dataq_emulator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        from os import close
+        master,slave = self.master,self.slave
+        self.master,self.slave = None,None
+        for fd in master,slave:
+            if fd is not None:
+                try: close(fd)
+                except OSError: pass
+        if self.thread is not None: self.thread.join(1.0)
+
+    def run(self):
+        from os import read
+        from select import select
+        from time import time
+        line = b""
+        next_time = time()
+        master = self.master
+        while self.master is not None:
+            try:
+                timeout = max(next_time-time(),0) if self.scanning else 0.1
+                if select([master],[],[],timeout)[0]:
+                    data = read(master,1024)
+                    if not data: break
+                    line += data
+                    while b"\r" in line:
+                        command,line = line.split(b"\r",1)
+                        self.execute(command.decode("ascii","replace").strip())
+                        next_time = time()
+                if self.scanning and time() >= next_time:
+                    self.send_scans(self.chunk_scans())
+                    next_time += self.chunk_time
+                    if next_time < time()-1: next_time = time() # fell behind
+            except (OSError,ValueError,TypeError): break # closed by stop()
+
+    def execute(self,command):
+        """Handle one ASCII command"""
+        from os import write
+        debug("dataq emulator: %r" % command)
+        words = command.split()
+        if not words: return
+        if words[0] in ("slist","chn") and len(words) == 3:
+            self.channels[int(words[1])] = int(words[2])
+        elif words[0] == "srate": self.srate = int(words[1])
+        elif words[0] == "dec": self.dec = int(words[1])
+        elif words[0] == "xrate": self.xrate = int(words[1])
+        if words[0] in ("start","S1"):
+            self.configure()
+            self.scanning = True
+            self.scans = 0
+            return
+        if words[0] in ("stop","S0"): self.scanning = False
+        if not self.scanning: write(self.master,(command+"\r").encode("ascii"))
+
+    def configure(self):
+        """Scan rate from the rate commands"""
+        n = max(len(self.channels),1)
+        if self.model == "DI-245": self.rate = 14400.0/(self.xrate+1)/n
+        else: self.rate = 60e6/(self.srate*self.dec)
+
+    def chunk_scans(self):
+        if self.rate_factor == 0: return 4096
+        return max(int(round(self.rate*self.rate_factor*self.chunk_time)),1)
+
+    def encode(self,first,count):
+        """count scans starting at scan number first in the binary format"""
+        n = max(len(self.channels),1)
+        k = arange(first,first+count).reshape(-1,1)+arange(0,n).reshape(1,-1)
+        counts = (k % ramp_length - ramp_length//2).astype(int16)
+        if self.model != "DI-245": return counts.astype("<i2").tobytes()
+        v = counts.astype("u2") & 0x3FFF
+        data = zeros((count,n,2),dtype=uint8)
+        data[:,:,0] = (v & 0x7F) << 1 | 1
+        data[:,0,0] &= 0xFE # sync bit of the first channel
+        data[:,:,1] = (v >> 7) << 1 | 1
+        return data.tobytes()
+
+    def send_scans(self,count):
+        from os import write
+        data = self.encode(self.scans,count)
+        self.scans += count
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            i = self.random.randint(0,len(data)-1)
+            data = data[0:i]+data[i+1:]
+            self.dropped_bytes += 1
+        while data:
+            n = write(self.master,data)
+            data = data[n:]
+
+if __name__ == "__main__":
+    import sys
+    from time import sleep
+    emulator = DataqEmulator(sys.argv[1] if len(sys.argv) > 1 else "DI-4108")
+    emulator.start()
+    print("%s emulator at %s" % (emulator.model,emulator.port_name))
+    try:
+        while True: sleep(1)
+    except KeyboardInterrupt: emulator.stop()
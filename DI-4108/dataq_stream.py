@@ -0,0 +1,316 @@
+"""
+Streaming acquisition from the DATAQ DI-4108 and DI-245 data loggers
+
+The logger is put in binary scan mode and a reader thread reads the serial
+stream in large blocks with readinto (straight from the file descriptor on
+POSIX, without intermediate bytes objects). Whole scans are decoded with
+NumPy directly into a preallocated ring buffer of 16-bit ADC counts, shape
+(capacity,channels). Consumers get full blocks of block_scans scans, as
+views into the ring, from a generator or a callback; there is no Python code
+per sample.
+
+DI-4108 (USB, ASCII commands terminated by CR, echoed by the device):
+    stop, encode 0 (binary), ps N (packet size 16 x 2^N bytes),
+    slist i config (bits 0-3 channel, bits 8-11 range), srate/dec (scan
+    rate = 60 MHz/(srate x dec)), start.
+    Each sample is a 16-bit little-endian two's complement count,
+    full scale = +/-32768.
+DI-245 (ASCII commands terminated by CR):
+    S0 (stop), chn i config (bits 0-3 channel, bits 8-11 range),
+    xrate N (14400/(N+1) samples/s, shared by the channels), S1 (start).
+    Each sample is 2 bytes with 7 data bits each. Bit 0 of the first byte
+    is the sync bit, 0 for the first channel of a scan and 1 otherwise, bit
+    0 of the second byte is always 1. The 14-bit count is two's complement,
+    full scale = +/-8192. On a sync error the bytes up to the next valid
+    scan start are skipped, counted in resyncs and skipped_bytes.
+
+Usage:
+from dataq_stream import DataqStream,DI4108
+stream = DataqStream(DI4108(channels=[0,1,2,3]),rate=1000)
+stream.open("/dev/ttyACM0")
+stream.start()
+for block in stream.blocks(): # (block_scans,channels) int16 counts
+    volts = stream.volts(block)
+stream.subscribe(callback) # callback(block) in the reader thread
+stream.stop()
+stream.close()
+
+Authors: Valentyn Stadnytskyi
+"""
+from logging import debug,info,warning
+from numpy import zeros,frombuffer,array,uint8,int16,float64
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+class DI4108(object):
+    """Scan protocol of the DI-4108"""
+    name = "DI-4108"
+    baudrate = 115200 # ignored by the USB CDC interface
+    full_scale = 32768.0
+    clock = 60e6
+    ranges = {10.0:0,5.0:1,2.0:2,1.0:3,0.5:4,0.2:5} # volts: range code
+    packet_size = 6 # ps 6: 1024-byte packets
+
+    def __init__(self,channels=(0,),ranges=None):
+        self.channels = list(channels)
+        self.voltage_ranges = list(ranges) if ranges else [10.0]*len(self.channels)
+
+    @property
+    def scan_bytes(self): return 2*len(self.channels)
+
+    @property
+    def scale(self):
+        """Volts per count of each channel"""
+        return array(self.voltage_ranges,dtype=float64)/self.full_scale
+
+    def commands(self,rate):
+        """Configuration commands for the given scan rate in Hz"""
+        from math import ceil
+        commands = ["stop","encode 0","ps %d" % self.packet_size]
+        for i,(channel,r) in enumerate(zip(self.channels,self.voltage_ranges)):
+            commands += ["slist %d %d" % (i,channel | self.ranges[r] << 8)]
+        dec = max(int(ceil(self.clock/(rate*65535))),1)
+        srate = min(max(int(round(self.clock/(rate*dec))),375),65535)
+        commands += ["srate %d" % srate,"dec %d" % dec]
+        return commands
+
+    start_command = "start"
+    stop_command = "stop"
+
+    def decode(self,data,out):
+        """Convert whole scans of data (uint8 array) into out (int16
+        array, shape (n,channels)).
+        Returns (scans decoded, bytes consumed, bytes skipped)"""
+        n = min(len(data)//self.scan_bytes,len(out))
+        out[0:n] = data[0:n*self.scan_bytes].view("<i2").reshape(n,len(self.channels))
+        return n,n*self.scan_bytes,0
+
+class DI245(DI4108):
+    """Scan protocol of the DI-245"""
+    name = "DI-245"
+    baudrate = 115200
+    full_scale = 8192.0
+    ranges = {10.0:0,5.0:1,2.5:2,1.0:3,0.5:4,0.25:5,0.1:6,0.05:7}
+    max_rate = 14400.0 # scans/s with xrate 0 and one channel
+
+    def commands(self,rate):
+        commands = ["S0"]
+        for i,(channel,r) in enumerate(zip(self.channels,self.voltage_ranges)):
+            commands += ["chn %d %d" % (i,channel | self.ranges[r] << 8)]
+        xrate = max(int(round(self.max_rate/(rate*len(self.channels))))-1,0)
+        commands += ["xrate %d" % xrate]
+        return commands
+
+    start_command = "S1"
+    stop_command = "S0"
+
+    def sync_pattern(self):
+        """Expected bit 0 of the first and second byte of every sample"""
+        first = array([0]+[1]*(len(self.channels)-1),dtype=uint8)
+        return first,array([1]*len(self.channels),dtype=uint8)
+
+    def decode(self,data,out):
+        from numpy import flatnonzero
+        n = min(len(data)//self.scan_bytes,len(out))
+        scans = data[0:n*self.scan_bytes].reshape(n,len(self.channels),2)
+        first,second = self.sync_pattern()
+        bad = ((scans[:,:,0] & 1) != first) | ((scans[:,:,1] & 1) != second)
+        bad = bad.any(axis=1)
+        if bad[0]:
+            # skip to the next byte pair that can start a scan
+            starts = flatnonzero(((data[1:-1] & 1) == 0) & ((data[2:] & 1) == 1))
+            skipped = int(starts[0])+1 if len(starts) else len(data)-1
+            return 0,skipped,skipped
+        if bad.any(): n = int(bad.argmax()) # decode up to the first bad scan
+        scans = scans[0:n]
+        counts = (scans[:,:,1] >> 1).astype(int16) << 7 | (scans[:,:,0] >> 1)
+        out[0:n] = (counts ^ 0x2000) - 0x2000
+        return n,n*self.scan_bytes,0
+
+class ScanRing(object):
+    """Preallocated ring of scans, handed out in blocks of block_scans"""
+    def __init__(self,block_scans,blocks,channels):
+        from threading import Condition
+        self.block_scans = block_scans
+        self.data = zeros((block_scans*blocks,channels),dtype=int16)
+        self.written = 0 # total number of scans ever written
+        self.condition = Condition()
+
+    @property
+    def capacity(self): return len(self.data)
+
+    @property
+    def blocks(self): return self.capacity//self.block_scans
+
+    def writable(self):
+        """Contiguous free region at the write position"""
+        i = self.written % self.capacity
+        return self.data[i:]
+
+    def commit(self,count):
+        """count scans were written at the write position.
+        Returns the indices of the blocks completed"""
+        before = self.written//self.block_scans
+        with self.condition:
+            self.written += count
+            self.condition.notify_all()
+        return range(before,self.written//self.block_scans)
+
+    def block(self,i):
+        """View of block number i (total count), valid until overwritten"""
+        j = (i % self.blocks)*self.block_scans
+        return self.data[j:j+self.block_scans]
+
+class DataqStream(object):
+    """Binary scan mode acquisition of a DATAQ logger"""
+    def __init__(self,device,rate=1000.0,block_scans=None,blocks=64,
+        read_size=65536):
+        """device: DI4108 or DI245 object
+        rate: scans per second
+        block_scans: scans handed to consumers at a time, default 0.1 s
+        blocks: ring capacity in blocks
+        read_size: bytes per read from the port"""
+        self.device = device
+        self.rate = rate
+        if block_scans is None: block_scans = max(int(rate/10),1)
+        self.ring = ScanRing(block_scans,blocks,len(device.channels))
+        self.read_size = max(read_size//device.scan_bytes,1)*device.scan_bytes
+        self.port = None
+        self.fd = None
+        self.thread = None
+        self.running = False
+        self.callbacks = []
+        self.lock = allocate_lock()
+        self.bytes_read = 0
+        self.resyncs = 0 # sync errors
+        self.skipped_bytes = 0
+        self.overruns = 0 # blocks consumers missed
+
+    def open(self,port_name):
+        from serial import Serial
+        self.port = Serial(port_name,baudrate=self.device.baudrate,timeout=0.1)
+        try:
+            from io import FileIO
+            self.fd = FileIO(self.port.fileno(),"rb",closefd=False)
+        except Exception as msg:
+            debug("%s: no direct readinto: %s" % (port_name,msg))
+            self.fd = None
+
+    def close(self):
+        self.stop()
+        if self.port is not None: self.port.close()
+        self.port = None
+        self.fd = None
+
+    def command(self,command):
+        """Send an ASCII command, return the echo"""
+        self.port.write((command+"\r").encode("ascii"))
+        reply = self.port.read_until(b"\r")
+        debug("%s: %r: %r" % (self.device.name,command,reply))
+        return reply
+
+    def start(self):
+        """Configure the logger, start scanning and the reader thread"""
+        from threading import Thread
+        if self.running: return
+        for command in self.device.commands(self.rate): self.command(command)
+        self.port.reset_input_buffer()
+        self.port.write((self.device.start_command+"\r").encode("ascii"))
+        self.running = True
+        self.thread = Thread(target=self.run,name="dataq_stream")
+        self.thread.daemon = True
+        self.thread.start()
+        info("%s: scanning %d channels at %g Hz" % (self.device.name,
+            len(self.device.channels),self.rate))
+
+    def stop(self):
+        if not self.running: return
+        self.running = False
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        try:
+            self.port.write((self.device.stop_command+"\r").encode("ascii"))
+            self.port.reset_input_buffer()
+        except Exception as msg: warning("%s: %s" % (self.device.name,msg))
+        with self.ring.condition: self.ring.condition.notify_all()
+
+    def readinto(self,buffer):
+        """Read available bytes into buffer (memoryview), waiting up to the
+        port timeout for the first one. Returns the number of bytes read"""
+        if self.fd is not None:
+            from select import select
+            if not select([self.fd],[],[],self.port.timeout)[0]: return 0
+            return self.fd.readinto(buffer) or 0
+        return self.port.readinto(buffer)
+
+    def run(self):
+        """Reader thread: read, decode into the ring, notify consumers"""
+        raw = bytearray(self.read_size)
+        view = memoryview(raw)
+        data = frombuffer(raw,dtype=uint8)
+        fill = 0
+        while self.running:
+            try: n = self.readinto(view[fill:])
+            except Exception as msg:
+                warning("%s: %s" % (self.device.name,msg))
+                break
+            self.bytes_read += n
+            fill += n
+            start = 0
+            while fill-start >= self.device.scan_bytes:
+                scans,consumed,skipped = self.device.decode(data[start:fill],
+                    self.ring.writable())
+                start += consumed
+                if skipped:
+                    self.resyncs += 1
+                    self.skipped_bytes += skipped
+                if scans: self.publish(self.ring.commit(scans))
+            # keep the partial scan for the next read
+            if start:
+                raw[0:fill-start] = raw[start:fill]
+                fill -= start
+        self.running = False
+        with self.ring.condition: self.ring.condition.notify_all()
+
+    def publish(self,blocks):
+        for i in blocks:
+            for callback in list(self.callbacks):
+                try: callback(self.ring.block(i))
+                except Exception as msg: warning("%s: %s" % (callback,msg))
+
+    def subscribe(self,callback):
+        """Call callback(block) from the reader thread for every full block"""
+        if callback not in self.callbacks: self.callbacks.append(callback)
+
+    def unsubscribe(self,callback):
+        if callback in self.callbacks: self.callbacks.remove(callback)
+
+    def blocks(self,timeout=1.0):
+        """Generator of full blocks (int16 counts, shape (block_scans,
+        channels)), starting with the next one completed, until the stream
+        stops. Blocks are views into the ring: copy them if they are kept
+        longer than the ring takes to wrap. Blocks overwritten before they
+        were consumed are skipped and counted in overruns"""
+        ring = self.ring
+        i = ring.written//ring.block_scans
+        while True:
+            with ring.condition:
+                while ring.written < (i+1)*ring.block_scans and self.running:
+                    ring.condition.wait(timeout)
+                if ring.written < (i+1)*ring.block_scans: return
+                oldest = ring.written//ring.block_scans-ring.blocks+1
+                if i < oldest:
+                    with self.lock: self.overruns += oldest-i
+                    i = oldest
+            yield ring.block(i)
+            i += 1
+
+    def volts(self,block):
+        """Counts converted to volts"""
+        return block*self.device.scale
+
+    def stats(self):
+        return {"scans":self.ring.written,"bytes":self.bytes_read,
+            "resyncs":self.resyncs,"skipped_bytes":self.skipped_bytes,
+            "overruns":self.overruns}
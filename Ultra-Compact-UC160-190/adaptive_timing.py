@@ -0,0 +1,84 @@
+"""
+Adaptive reply deadlines and command spacing
+
+Instead of a fixed timeout (1-10 s) and fixed pauses between commands,
+AdaptiveTiming learns the device's turnaround time (reply latency minus the
+time the bytes spend on the wire) from observed replies and derives:
+
+deadline(bytes_out,bytes_in,commands): wire time of command and reply at
+    the baud rate + margin x 99th percentile of the turnaround per command
+    x number of commands, so a dead link fails after milliseconds instead
+    of seconds. The device turns around once per command, also when
+    several are sent back-to-back (read_many).
+spacing: minimum pause between the end of a reply and the next command,
+    0 while replies are clean, doubled on every error and halved again after
+    a run of good replies
+
+After an error the deadline is also stretched (x2 per error, up to
+max_backoff) and relaxes with the spacing.
+
+Usage:
+driver.set_adaptive_timing(True)
+"""
+from collections import deque
+
+class AdaptiveTiming(object):
+    """Reply deadline and command spacing learned from observed replies"""
+    min_samples = 10 # replies needed before the deadline adapts
+    margin = 3.0 # deadline = wire time + margin x commands x p99 turnaround
+    min_timeout = 0.005 # seconds
+    max_timeout = 1.0 # seconds
+    initial_timeout = 0.5 # seconds, until min_samples replies are seen
+    spacing_step = 0.002 # seconds, first spacing after an error
+    max_spacing = 0.5 # seconds
+    max_backoff = 8.0 # deadline stretch factor after errors
+    recover_after = 20 # good replies before relaxing spacing and backoff
+
+    def __init__(self,baudrate=9600,window=200):
+        self.baudrate = baudrate
+        self.turnarounds = deque(maxlen=window)
+        self.spacing = 0.0
+        self.backoff = 1.0
+        self.good_replies = 0
+        self.errors = 0
+
+    def wire_time(self,count):
+        """Transmission time of count bytes (8N1 = 10 bits per byte)"""
+        return count*10.0/self.baudrate
+
+    def turnaround(self,percent=99):
+        """Percentile of the observed device turnaround times per command in
+        seconds"""
+        if len(self.turnarounds) == 0: return 0.0
+        values = sorted(self.turnarounds)
+        return values[min(int(len(values)*percent/100.0),len(values)-1)]
+
+    def deadline(self,bytes_out,bytes_in,commands=1):
+        """Time to wait for a reply of bytes_in bytes to bytes_out bytes
+        holding commands commands, in seconds"""
+        if len(self.turnarounds) < self.min_samples: timeout = self.initial_timeout
+        else: timeout = self.wire_time(bytes_out+bytes_in) + \
+            self.margin*commands*self.turnaround(99) + self.min_timeout
+        return min(max(timeout*self.backoff,self.min_timeout),self.max_timeout)
+
+    def observe(self,seconds,bytes_out,bytes_in,ok=True,commands=1):
+        """Record a command/reply exchange.
+        seconds: from writing the command to the end of the reply
+        ok: False for a timeout or corrupted reply
+        commands: number of commands sent back-to-back"""
+        if ok:
+            turnaround = max(seconds-self.wire_time(bytes_out+bytes_in),0.0)
+            self.turnarounds.append(turnaround/commands)
+            self.good_replies += 1
+            if self.good_replies >= self.recover_after:
+                self.good_replies = 0
+                self.spacing = self.spacing/2 if self.spacing > self.spacing_step else 0.0
+                self.backoff = max(self.backoff/2,1.0)
+        else: self.error()
+
+    def error(self):
+        """Back off after a timeout or an invalid reply"""
+        self.errors += 1
+        self.good_replies = 0
+        self.spacing = min(max(self.spacing*2,self.spacing_step),self.max_spacing)
+        self.backoff = min(self.backoff*2,self.max_backoff)
@@ -0,0 +1,116 @@
+"""
+Several Oasis chillers in one process, each on its own serial port
+
+ChillerFleet discovers all units answering the ID query and owns one
+OasisChillerDriver per unit. Fleet-wide operations run on a thread pool
+with one I/O thread per unit, so a snapshot of all units takes about as
+long as one unit's round trip. Getters return NumPy arrays indexed like
+fleet.drivers.
+
+Usage:
+from chiller_fleet import ChillerFleet
+fleet = ChillerFleet()
+fleet.discover()
+fleet.actual_temperatures
+fleet.faults
+fleet.snapshot()
+fleet.set_nominal_temperatures([20,22,25])
+fleet.close()
+"""
+from logging import info
+from numpy import array,zeros,isnan
+
+dtype = [("set_point","f8"),("actual_temperature","f8"),("faults","i2")]
+
+class ChillerFleet(object):
+    """Manager for several Oasis chillers on separate serial ports"""
+    def __init__(self):
+        self.drivers = []
+        self.executor = None
+
+    def discover(self,port_names=None):
+        """Find all units answering the ID query.
+        port_names: candidates, default: same as OasisChillerDriver
+        Returns the number of units"""
+        from oasis_chiller_driver import OasisChillerDriver
+        from port_discovery import find_all
+        probe = OasisChillerDriver()
+        if port_names is None: port_names = probe.port_names()
+        in_use = set([driver.port_name for driver in self.drivers])
+        port_names = [name for name in port_names if name not in in_use]
+        for port in find_all(port_names,probe.probe_port): self.add_port(port)
+        info("Fleet: %d units" % len(self.drivers))
+        return len(self.drivers)
+
+    def add(self,port_name):
+        """Add the unit on the given port, returns its driver or None"""
+        from oasis_chiller_driver import OasisChillerDriver
+        port = OasisChillerDriver().probe_port(port_name)
+        if port is None: return None
+        return self.add_port(port)
+
+    def add_port(self,port):
+        """Add a unit on an already opened and validated port"""
+        from oasis_chiller_driver import OasisChillerDriver
+        driver = OasisChillerDriver()
+        driver.port = port
+        # Separate port cache entries so each unit reconnects to its own port.
+        driver.name = "oasis_chiller_%d" % len(self.drivers)
+        self.drivers += [driver]
+        self.shutdown_executor()
+        return driver
+
+    def __len__(self): return len(self.drivers)
+
+    def map(self,function,*args):
+        """Call function(driver,*args[i]...) for every unit concurrently.
+        Returns the list of results in the order of self.drivers"""
+        from concurrent.futures import ThreadPoolExecutor
+        if len(self.drivers) == 0: return []
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.drivers))
+        if args: return list(self.executor.map(function,self.drivers,*args))
+        return list(self.executor.map(function,self.drivers))
+
+    def snapshot(self):
+        """Set point, actual temperature (in C) and fault byte (-1 =
+        unreadable) of all units as NumPy structured array, read with one
+        pipelined round trip per unit"""
+        values = self.map(lambda driver: driver.read_many([1,9,8]))
+        data = zeros(len(values),dtype=dtype)
+        data["set_point"] = [v[1]/10. for v in values]
+        data["actual_temperature"] = [v[9]/10. for v in values]
+        data["faults"] = [-1 if isnan(v[8]) else v[8] for v in values]
+        return data
+
+    @property
+    def actual_temperatures(self):
+        return array(self.map(lambda driver: driver.actual_temperature),dtype=float)
+
+    @property
+    def nominal_temperatures(self):
+        return array(self.map(lambda driver: driver.nominal_temperature),dtype=float)
+
+    def set_nominal_temperatures(self,values):
+        """values: one set point per unit, in C"""
+        self.map(lambda driver,value: driver.set_value(1,value*10),values)
+
+    @property
+    def faults(self):
+        """Fault bytes of all units, -1 = unreadable"""
+        faults = array(self.map(lambda driver: driver.get_value(8)),dtype=float)
+        faults[isnan(faults)] = -1
+        return faults.astype("i2")
+
+    @property
+    def port_names(self): return [driver.port_name for driver in self.drivers]
+
+    def shutdown_executor(self):
+        if self.executor is not None: self.executor.shutdown()
+        self.executor = None
+
+    def close(self):
+        """Release all ports"""
+        self.shutdown_executor()
+        for driver in self.drivers: driver.close_port()
+        self.drivers = []
@@ -0,0 +1,199 @@
+"""
+Share one Oasis chiller among several local processes
+
+ChillerServer owns the OasisChillerDriver (and with it the serial port) and
+serves any number of clients over TCP or a Unix domain socket. Identical
+reads that are in flight at the same time are merged: if N clients ask for
+RBV at once, one serial query is made and all N get its result.
+ChillerClient has the same property names as the driver.
+
+Protocol: one request per line, one reply per line (UTF-8)
+GET <name>          -> OK <JSON value>  or  ERR <message>
+SET <name> <value>  -> OK null          or  ERR <message>
+
+Usage:
+server: ChillerServer(driver,("localhost",5090)).start()
+        ChillerServer(driver,"/tmp/oasis_chiller.sock").start()
+client: chiller = ChillerClient(("localhost",5090))
+        chiller.RBV
+        chiller.VAL = 25
+"""
+from logging import debug,info
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+aliases = {"VAL":"nominal_temperature","RBV":"actual_temperature",
+    "LLM":"low_limit","HLM":"high_limit","COMM":"port_name"}
+readable = ["nominal_temperature","actual_temperature","low_limit",
+    "high_limit","faults","fault_code","port_name","online"]
+writable = ["nominal_temperature","low_limit","high_limit"]
+
+class Flight(object):
+    """A read in progress, shared by all clients waiting for it"""
+    def __init__(self):
+        from threading import Event
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+class ChillerServer(object):
+    """Serve a driver's properties to many socket clients"""
+    def __init__(self,driver=None,address=("localhost",5090)):
+        if driver is None: from oasis_chiller_driver import driver
+        self.driver = driver
+        self.address = address
+        self.server = None
+        self.lock = allocate_lock()
+        self.in_flight = {} # property name: Flight
+        self.queries = 0 # number of reads passed on to the driver
+
+    def get(self,name):
+        """Read a property, sharing the result with concurrent identical
+        reads"""
+        name = aliases.get(name,name)
+        if name not in readable: raise AttributeError("%r not readable" % name)
+        with self.lock:
+            flight = self.in_flight.get(name)
+            owner = flight is None
+            if owner: flight = self.in_flight[name] = Flight()
+        if owner:
+            try:
+                self.queries += 1
+                flight.value = getattr(self.driver,name)
+            except Exception as msg: flight.error = msg
+            finally:
+                with self.lock: del self.in_flight[name]
+                flight.event.set()
+        else: flight.event.wait()
+        if flight.error is not None: raise flight.error
+        return flight.value
+
+    def set(self,name,value):
+        name = aliases.get(name,name)
+        if name not in writable: raise AttributeError("%r not writable" % name)
+        setattr(self.driver,name,value)
+
+    def handle(self,line):
+        """Reply line to a request line"""
+        import json
+        try:
+            words = line.split(None,2)
+            if len(words) == 2 and words[0] == "GET":
+                value = self.get(words[1])
+                if hasattr(value,"item"): value = value.item() # NumPy scalar
+                return "OK "+json.dumps(value)
+            if len(words) == 3 and words[0] == "SET":
+                self.set(words[1],json.loads(words[2]))
+                return "OK null"
+            return "ERR bad request %r" % line
+        except Exception as msg: return "ERR %s" % msg
+
+    def start(self):
+        """Serve in a background thread"""
+        from threading import Thread
+        self.server = make_server(self.address,self.handle)
+        thread = Thread(target=self.server.serve_forever,name="chiller_server")
+        thread.daemon = True
+        thread.start()
+        info("Serving %s at %r" % (self.driver.name,self.address))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.address,str):
+                from os import remove
+                try: remove(self.address)
+                except OSError: pass
+        self.server = None
+
+def make_server(address,handle):
+    """Threaded stream server calling handle(line) for every request line.
+    address: (host,port) for TCP, path for a Unix domain socket"""
+    import socket
+    try: import socketserver
+    except ImportError: import SocketServer as socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def setup(self):
+            if self.request.family != getattr(socket,"AF_UNIX",None):
+                self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            socketserver.StreamRequestHandler.setup(self)
+        def handle(self):
+            for line in self.rfile:
+                reply = handle(line.decode("utf-8").strip())
+                self.wfile.write((reply+"\n").encode("utf-8"))
+
+    if isinstance(address,str):
+        from os.path import exists
+        from os import remove
+        if exists(address): remove(address) # stale socket file
+        base_class = socketserver.ThreadingUnixStreamServer
+    else: base_class = socketserver.ThreadingTCPServer
+
+    class Server(base_class):
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 128 # many clients connecting at once
+
+    return Server(address,Handler)
+
+class ChillerClient(object):
+    """Proxy with the same property names as OasisChillerDriver"""
+    def __init__(self,address=("localhost",5090),timeout=10.0):
+        self.address = address
+        self.timeout = timeout
+        self.connection = None
+        self.lock = allocate_lock()
+
+    def connect(self):
+        import socket
+        if isinstance(self.address,str):
+            connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        else:
+            connection = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        connection.settimeout(self.timeout)
+        connection.connect(self.address)
+        self.connection = connection
+        self.file = connection.makefile("rb")
+
+    def close(self):
+        if self.connection is not None:
+            self.file.close()
+            self.connection.close()
+        self.connection = None
+
+    def request(self,line):
+        """Send a request line, return the decoded reply value"""
+        import json
+        with self.lock:
+            for attempt in range(0,2):
+                try:
+                    if self.connection is None: self.connect()
+                    self.connection.sendall((line+"\n").encode("utf-8"))
+                    reply = self.file.readline().decode("utf-8").strip()
+                    if not reply: raise IOError("connection closed")
+                    break
+                except (IOError,OSError) as msg:
+                    debug("%r: attempt %d/2: %s" % (self.address,attempt+1,msg))
+                    self.close()
+                    if attempt == 1: raise
+        status,value = reply.split(" ",1)
+        if status != "OK": raise RuntimeError(value)
+        return json.loads(value)
+
+    def get(self,name): return self.request("GET "+name)
+
+    def set(self,name,value):
+        import json
+        self.request("SET %s %s" % (name,json.dumps(value)))
+
+def remote_property(name):
+    return property(lambda self: self.get(name),
+        lambda self,value: self.set(name,value))
+
+for name in readable+list(aliases.keys()):
+    setattr(ChillerClient,name,remote_property(name))
+del name
@@ -0,0 +1,151 @@
+"""
+Priority scheduling of the requests to one serial port
+
+One worker thread per port executes all requests, one at a time, highest
+class first:
+CONTROL      writes (set points, limits, PID parameters)
+INTERACTIVE  reads on behalf of an operator or client
+BACKGROUND   telemetry (sampler, publisher)
+A write therefore waits for at most the one request in progress, however
+many polls are queued.
+
+Every request returns a Future (concurrent.futures).
+- deadline: seconds; a request not started by then fails with
+  DeadlineExceeded instead of being sent late
+- key: requests with the same key are interchangeable (the same read).
+  A background request finds a queued one with the same key and shares its
+  future. When any request with a key completes, queued background
+  requests with that key are superseded: they get its result without
+  being sent.
+
+Usage:
+scheduler = CommandScheduler("oasis_chiller")
+scheduler.start()
+future = scheduler.submit(function,priority=BACKGROUND,key=command,deadline=2)
+future.result()
+scheduler.stop()
+"""
+from logging import debug
+from collections import deque
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+CONTROL,INTERACTIVE,BACKGROUND = 0,1,2
+priority_names = ["control","interactive","background"]
+
+class DeadlineExceeded(IOError):
+    """A request could not be started before its deadline"""
+
+class CommandScheduler(object):
+    """Worker thread executing requests by priority class"""
+    def __init__(self,name="scheduler"):
+        from threading import Event
+        self.name = name
+        self.queues = [deque() for priority in priority_names]
+        self.background = {} # key: (function,key,expires,future) queued
+        self.lock = allocate_lock()
+        self.wakeup = Event()
+        self.thread = None
+        self.running = False
+        self.counts = {"executed":0,"merged":0,"superseded":0,"expired":0}
+
+    def start(self):
+        from threading import Thread
+        if self.running: return
+        self.running = True
+        self.thread = Thread(target=self.run,name=self.name+" scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the worker, failing the queued requests"""
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        with self.lock:
+            pending = [request for queue in self.queues for request in queue]
+            for queue in self.queues: queue.clear()
+            self.background.clear()
+        for function,key,expires,future in pending:
+            future.set_exception(IOError("%s: scheduler stopped" % self.name))
+
+    def in_worker(self):
+        """Is the calling thread the worker?"""
+        from threading import current_thread
+        return current_thread() is self.thread
+
+    def submit(self,function,priority=INTERACTIVE,key=None,deadline=None):
+        """Queue function() for the worker thread.
+        Returns a Future of its result"""
+        from concurrent.futures import Future
+        from time import time
+        expires = time()+deadline if deadline is not None else None
+        with self.lock:
+            if priority == BACKGROUND and key is not None and key in self.background:
+                queued = self.background[key]
+                # shared unless the queued request may expire too early
+                if queued[2] is None or (expires is not None and queued[2] >= expires):
+                    self.counts["merged"] += 1
+                    return queued[3]
+            future = Future()
+            request = (function,key,expires,future)
+            self.queues[priority].append(request)
+            if priority == BACKGROUND and key is not None and key not in self.background:
+                self.background[key] = request
+        self.wakeup.set()
+        return future
+
+    def stats(self):
+        """Counts of executed, merged, superseded and expired requests and
+        of the requests queued in each class"""
+        with self.lock:
+            stats = dict(self.counts)
+            stats.update(dict(zip(priority_names,[len(queue) for queue in self.queues])))
+            return stats
+
+    def next_request(self):
+        """Highest priority request still wanted, None if there is none"""
+        from time import time
+        with self.lock:
+            for queue in self.queues:
+                while queue:
+                    request = queue.popleft()
+                    function,key,expires,future = request
+                    if self.background.get(key) is request: del self.background[key]
+                    if expires is not None and time() > expires:
+                        self.counts["expired"] += 1
+                        future.set_exception(DeadlineExceeded(
+                            "%s: %r: deadline passed" % (self.name,key)))
+                        continue
+                    if future.set_running_or_notify_cancel(): return request
+        return None
+
+    def supersede(self,key,result):
+        """Complete the queued background requests with key with result"""
+        with self.lock:
+            queue = self.queues[BACKGROUND]
+            superseded = [request for request in queue if request[1] == key]
+            for request in superseded: queue.remove(request)
+            if self.background.get(key) in superseded: del self.background[key]
+            self.counts["superseded"] += len(superseded)
+        for function,key,expires,future in superseded:
+            if future.set_running_or_notify_cancel(): future.set_result(result)
+
+    def run(self):
+        while self.running:
+            self.wakeup.clear()
+            request = self.next_request()
+            if request is None:
+                self.wakeup.wait(1.0)
+                continue
+            function,key,expires,future = request
+            try: result = function()
+            except Exception as msg:
+                debug("%s: %r: %s" % (self.name,key,msg))
+                future.set_exception(msg)
+                continue
+            with self.lock: self.counts["executed"] += 1
+            future.set_result(result)
+            if key is not None: self.supersede(key,result)
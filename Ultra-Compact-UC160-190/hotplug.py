@@ -0,0 +1,86 @@
+"""
+Serial adapter hot-plug notification on Linux
+
+A single background thread watches /dev and /dev/serial/by-id with inotify
+(through ctypes, no extra dependencies) and calls the registered callbacks
+with the path of every serial device node that appears. On other platforms
+watch() returns False and nothing is reported.
+
+Usage:
+import hotplug
+hotplug.watch(callback) # callback(path)
+hotplug.unwatch(callback)
+"""
+from logging import debug,warn
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+directories = ["/dev","/dev/serial/by-id"]
+prefixes = ("ttyUSB","ttyACM","tty.usbserial","cu.usbserial","usb-")
+
+callbacks = []
+thread = None
+
+def watch(callback):
+    """Call callback(path) when a serial device node appears.
+    Returns False if hot-plug detection is not available"""
+    global thread
+    if callback not in callbacks: callbacks.append(callback)
+    if thread is None:
+        fd,watch_dirs = inotify_fd()
+        if fd is None: return False
+        from threading import Thread
+        thread = Thread(target=run,args=(fd,watch_dirs),name="hotplug")
+        thread.daemon = True
+        thread.start()
+    return True
+
+def unwatch(callback):
+    if callback in callbacks: callbacks.remove(callback)
+
+def inotify_fd():
+    """inotify file descriptor watching the device directories, or None,
+    and dictionary {watch descriptor: directory}"""
+    import ctypes,ctypes.util
+    from os.path import exists
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError,AttributeError) as msg:
+        debug("hotplug: inotify not available: %s" % msg)
+        return None,{}
+    if fd < 0: return None,{}
+    mask = IN_CREATE|IN_ATTRIB|IN_MOVED_TO
+    watch_dirs = {}
+    for directory in directories:
+        # /dev/serial/by-id only exists while an adapter is plugged in; new
+        # /dev/tty* nodes are seen anyway.
+        if exists(directory):
+            wd = libc.inotify_add_watch(fd,directory.encode(),mask)
+            if wd < 0: warn("hotplug: cannot watch %s" % directory)
+            else: watch_dirs[wd] = directory
+    return fd,watch_dirs
+
+def run(fd,watch_dirs):
+    """Read inotify events and dispatch them"""
+    from os import read
+    from os.path import join
+    from struct import unpack_from,calcsize
+    header = "iIII" # wd, mask, cookie, len
+    size = calcsize(header)
+    while True:
+        try: data = read(fd,4096)
+        except OSError as msg:
+            warn("hotplug: %s" % msg)
+            break
+        offset = 0
+        while offset+size <= len(data):
+            wd,mask,cookie,length = unpack_from(header,data,offset)
+            name = data[offset+size:offset+size+length].rstrip(b"\0").decode("utf-8","replace")
+            offset += size+length
+            if name.startswith(prefixes):
+                path = join(watch_dirs.get(wd,"/dev"),name)
+                for callback in list(callbacks):
+                    try: callback(path)
+                    except Exception as msg: warn("hotplug: %s: %s" % (path,msg))
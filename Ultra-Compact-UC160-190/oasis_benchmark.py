@@ -0,0 +1,426 @@
+"""
+Latency and throughput benchmarks of the Oasis chiller drivers against the
+pty emulator (oasis_emulator.py)
+
+For every operation the per-call latency percentiles (ms) and the number of
+calls per second are reported. Results can be saved as JSON and compared
+against a saved baseline, so that every performance change can be checked.
+
+Usage:
+python oasis_benchmark.py
+python oasis_benchmark.py --save baseline.json
+python oasis_benchmark.py --baseline baseline.json --response-delay 0.005
+python oasis_benchmark.py --check-startup # exit status 1 if over budget
+python oasis_benchmark.py --check-overhead # exit status 1 if over budget
+python oasis_benchmark.py --check-framing # exit status 1 on a misread value
+python oasis_benchmark.py --check-scaling # exit status 1 if N ports < 0.8 N x
+python oasis_benchmark.py --transports # pty, raw TCP and RFC 2217 only
+"""
+from itertools import cycle
+
+startup_budget = 50.0 # ms an import may add to a bare interpreter start
+overhead_budget = 0.030 # ms of Python time per get_value (median)
+scaling_efficiency = 0.8 # N ports must give this x N x one port's throughput
+
+def measure(function,duration=1.0,count=None):
+    """Call function repeatedly for duration seconds (or count times).
+    Returns dictionary with calls, calls_per_second and latency percentiles
+    p50, p90, p99, max in ms"""
+    from time import perf_counter
+    from numpy import array,percentile
+    latencies = []
+    start = perf_counter()
+    while True:
+        t = perf_counter()
+        function()
+        latencies += [perf_counter()-t]
+        if count is not None:
+            if len(latencies) >= count: break
+        elif perf_counter()-start >= duration: break
+    elapsed = perf_counter()-start
+    latencies = array(latencies)*1000
+    p50,p90,p99 = percentile(latencies,[50,90,99])
+    return {"calls":len(latencies),"calls_per_second":len(latencies)/elapsed,
+        "p50":p50,"p90":p90,"p99":p99,"max":latencies.max()}
+
+def oasis_chiller_driver_benchmarks(emulator,duration):
+    from serial import Serial
+    from oasis_chiller_driver import OasisChillerDriver
+    from port_discovery import find_first
+    driver = OasisChillerDriver()
+    driver.cache_time = 0 # measure the line, not the cache
+    driver.port = Serial(emulator.port_name,baudrate=driver.baudrate)
+    values = cycle([200,201])
+    results = {}
+    results["get_value"] = measure(lambda: driver.get_value(9),duration)
+    results["set_value"] = measure(lambda: driver.set_value(1,next(values)),duration)
+    results["faults"] = measure(lambda: driver.faults,duration)
+    results["read_many"] = measure(lambda: driver.read_many([1,6,7,8,9]),duration)
+    driver.close_port()
+    results["discovery"] = measure(lambda: find_first([emulator.port_name],
+        driver.probe_port).close(),duration)
+    return results
+
+def serial_driver_benchmarks(emulator,duration):
+    from serial import Serial
+    from serial_driver import Driver
+    from port_discovery import find_first
+    driver = Driver()
+    driver.ser = Serial(emulator.port_name,baudrate=9600,timeout=0.1)
+    values = cycle([20.0,20.1])
+    results = {}
+    results["get_value"] = measure(lambda: driver.actual_temperature,duration)
+    results["set_value"] = measure(lambda: driver.set_target_temperature(next(values)),duration)
+    results["faults"] = measure(lambda: driver.faults,duration)
+    results["get_PID"] = measure(driver.get_PID,duration)
+    driver.close()
+    results["discovery"] = measure(lambda: find_first([emulator.port_name],
+        driver._probe_port).close(),duration,count=3)
+    return results
+
+def fleet_benchmarks(emulator_options,duration,sizes=(1,4,8)):
+    """Snapshot of N units, each on its own emulated port"""
+    from oasis_emulator import OasisEmulator
+    from chiller_fleet import ChillerFleet
+    results = {}
+    for n in sizes:
+        emulators = [OasisEmulator(**emulator_options) for i in range(n)]
+        for emulator in emulators: emulator.start()
+        fleet = ChillerFleet()
+        fleet.discover([emulator.port_name for emulator in emulators])
+        results["snapshot %d units" % n] = measure(fleet.snapshot,duration)
+        fleet.close()
+        for emulator in emulators: emulator.stop()
+    return results
+
+def check_scaling(results,efficiency=scaling_efficiency):
+    """Messages if N units on N ports read less than efficiency x N times
+    the values per second of one unit (fleet_benchmarks results)"""
+    single = results["snapshot 1 units"]["calls_per_second"]
+    messages = []
+    for name in sorted(results):
+        n = int(name.split()[1])
+        speedup = results[name]["calls_per_second"]*n/single
+        if speedup < efficiency*n:
+            messages += ["%s: %.1fx the throughput of 1 unit, below %.1fx" %
+                (name,speedup,efficiency*n)]
+    return messages
+
+def server_benchmarks(emulator,duration,clients=20):
+    """RBV reads of many concurrent clients through one ChillerServer"""
+    from serial import Serial
+    from threading import Thread
+    from oasis_chiller_driver import OasisChillerDriver
+    from chiller_server import ChillerServer,ChillerClient
+    from tempfile import gettempdir
+    from os import getpid
+    from os.path import join
+    driver = OasisChillerDriver()
+    driver.cache_time = 0
+    driver.port = Serial(emulator.port_name,baudrate=driver.baudrate)
+    server = ChillerServer(driver,join(gettempdir(),"oasis_benchmark_%d.sock" % getpid()))
+    server.start()
+    results = {}
+    def client_loop(i):
+        client = ChillerClient(server.address)
+        results[i] = measure(lambda: client.RBV,duration)
+        client.close()
+    threads = [Thread(target=client_loop,args=(i,)) for i in range(clients)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    server.stop()
+    driver.close_port()
+    total = sum([result["calls_per_second"] for result in results.values()])
+    worst = max(results.values(),key=lambda result: result["p99"])
+    result = dict(worst)
+    result["calls_per_second"] = total
+    return {"RBV %d clients" % clients: result}
+
+def scheduling_benchmarks(emulator,duration,pollers=8):
+    """set_value latency while pollers threads read as background
+    telemetry, first-come-first-served and with the command scheduler"""
+    from serial import Serial
+    from threading import Thread,Event
+    from oasis_chiller_driver import OasisChillerDriver,BACKGROUND
+    results = {}
+    for scheduling in False,True:
+        driver = OasisChillerDriver()
+        driver.cache_time = 0
+        driver.port = Serial(emulator.port_name,baudrate=driver.baudrate)
+        driver.set_scheduling(scheduling)
+        stop = Event()
+        def poll():
+            driver.thread_priority = BACKGROUND
+            while not stop.is_set(): driver.read_many([1,9,8])
+        threads = [Thread(target=poll) for i in range(pollers)]
+        for thread in threads: thread.start()
+        values = cycle([200,201])
+        name = "set_value %s" % ("scheduled" if scheduling else "unscheduled")
+        results[name] = measure(lambda: driver.set_value(1,next(values)),duration)
+        stop.set()
+        for thread in threads: thread.join()
+        driver.set_scheduling(False)
+        driver.close_port()
+    return results
+
+def transport_benchmarks(emulator_options,duration):
+    """get_value round trip and reopening the port (close and ID probe)
+    with the emulator on a pty, raw TCP and RFC 2217 (see transport.py)"""
+    from oasis_emulator import OasisEmulator
+    from oasis_chiller_driver import OasisChillerDriver
+    import transport
+    results = {}
+    for name,start in [("pty","start"),("tcp","start_tcp"),
+        ("rfc2217","start_rfc2217")]:
+        emulator = OasisEmulator(**emulator_options)
+        getattr(emulator,start)()
+        driver = OasisChillerDriver()
+        driver.cache_time = 0
+        driver.port = driver.probe_port(emulator.port_name)
+        results["get_value %s" % name] = measure(lambda: driver.get_value(9),duration)
+        def reopen():
+            driver.close_port()
+            driver.port = driver.probe_port(emulator.port_name)
+        results["reopen %s" % name] = measure(reopen,duration)
+        driver.close_port()
+        transport.close_all()
+        emulator.stop()
+    return results
+
+class InstantPort(object):
+    """In-process stand-in for the serial port that answers like the
+    emulator, without pty, thread or line time, so that only the driver's
+    own Python overhead is measured"""
+    name = "instant"
+    timeout = 1.0
+    def __init__(self):
+        from oasis_emulator import OasisEmulator
+        self.emulator = OasisEmulator(baudrate=0)
+        self.buffer = b""
+    def write(self,command):
+        command = bytearray(command)
+        i = 0
+        while i < len(command):
+            code = command[i]
+            payload = bytes(command[i+1:i+3]) if code & 0x20 else b""
+            self.buffer += self.emulator.reply(code,payload)
+            i += 1+len(payload)
+        return len(command)
+    def read(self,count=1):
+        data,self.buffer = self.buffer[0:count],self.buffer[count:]
+        return data
+    def readinto(self,buffer):
+        n = min(len(buffer),len(self.buffer))
+        buffer[0:n] = self.buffer[0:n]
+        self.buffer = self.buffer[n:]
+        return n
+    @property
+    def in_waiting(self): return len(self.buffer)
+    def isOpen(self): return True
+    def close(self): pass
+
+def overhead_benchmarks(duration=1.0):
+    """Python time per call of the driver against InstantPort"""
+    from oasis_chiller_driver import OasisChillerDriver
+    driver = OasisChillerDriver()
+    driver.cache_time = 0
+    driver.port = InstantPort()
+    driver.reconnector.connected()
+    values = cycle([200,201])
+    results = {}
+    results["get_value"] = measure(lambda: driver.get_value(9),duration)
+    results["set_value"] = measure(lambda: driver.set_value(1,next(values)),duration)
+    results["read_many"] = measure(lambda: driver.read_many([1,6,7,8,9]),duration)
+    return results
+
+def check_overhead(results,budget=overhead_budget):
+    """Messages if the median get_value overhead exceeds budget ms"""
+    cost = results["get_value"]["p50"]
+    if cost > budget: return ["get_value: %.1f us over budget of %.1f us" %
+        (cost*1000,budget*1000)]
+    return []
+
+class GarbagePort(InstantPort):
+    """InstantPort inserting one garbage byte before the reply to the
+    command with index before (in the order received)"""
+    def __init__(self,garbage,before):
+        InstantPort.__init__(self)
+        self.garbage = bytes(bytearray([garbage]))
+        self.before = before
+    def write(self,command):
+        command = bytearray(command)
+        i = 0
+        while i < len(command):
+            code = command[i]
+            payload = bytes(command[i+1:i+3]) if code & 0x20 else b""
+            if self.before == 0: self.buffer += self.garbage
+            self.before -= 1
+            self.buffer += self.emulator.reply(code,payload)
+            i += 1+len(payload)
+        return len(command)
+
+def check_framing():
+    """Pipelined reads of set point, limits, faults and actual temperature
+    with one garbage byte (each of the 256 values) before each of the
+    replies, by both drivers. Every value has to come back correct or
+    unreadable (nan). Returns a list of messages, empty if none is misread"""
+    from math import isnan
+    from logging import disable,WARNING,NOTSET
+    from oasis_chiller_driver import OasisChillerDriver
+    from serial_driver import Driver
+    names = ["target_temperature","lower_limit","upper_limit","faults",
+        "actual_temperature"]
+    def oasis_chiller_driver(port):
+        driver = OasisChillerDriver()
+        driver.cache_time = 0
+        driver.port = port
+        driver.reconnector.connected()
+        return driver.read_many([1,6,7,8,9])
+    def serial_driver(port):
+        driver = Driver()
+        driver.ser = port
+        return driver.read_many(names)
+    messages = []
+    disable(WARNING) # every read removes a garbage byte
+    for read in oasis_chiller_driver,serial_driver:
+        expected = read(InstantPort())
+        for before in range(0,len(names)):
+            for garbage in range(0,256):
+                values = read(GarbagePort(garbage,before))
+                for name in values:
+                    value = values[name]
+                    if value != expected[name] and not (isinstance(value,float)
+                        and isnan(value)):
+                        messages += ["%s: garbage 0x%02X before reply %d: %s %r" %
+                            (read.__name__,garbage,before,name,value)]
+    disable(NOTSET)
+    return messages
+
+def startup_benchmarks(count=10):
+    """Bare interpreter start and the import of the drivers, each in a
+    fresh process"""
+    import sys
+    from subprocess import check_call
+    from os.path import dirname,abspath
+    directory = dirname(abspath(__file__))
+    results = {}
+    for name,statement in [
+        ("python","pass"),
+        ("import oasis_chiller","import oasis_chiller"),
+        ("import oasis_chiller_driver","import oasis_chiller_driver"),
+        ("import serial_driver","import serial_driver"),
+        ]:
+        results[name] = measure(lambda statement=statement: check_call(
+            [sys.executable,"-c",statement],cwd=directory),count=count)
+    return results
+
+def check_startup(results,budget=startup_budget):
+    """Imports adding more than budget ms (median) to the start of a bare
+    interpreter. Returns a list of messages, empty if all are within budget"""
+    base = results["python"]["p50"]
+    messages = []
+    for name in sorted(results):
+        if name == "python": continue
+        cost = results[name]["p50"]-base
+        if cost > budget:
+            messages += ["%s: %.1f ms over budget of %.1f ms" % (name,cost,budget)]
+    return messages
+
+def run(duration=1.0,**emulator_options):
+    """All benchmarks, dictionary {section: {operation: statistics}}"""
+    from oasis_emulator import OasisEmulator
+    results = {}
+    for name,benchmarks in [
+        ("oasis_chiller_driver",oasis_chiller_driver_benchmarks),
+        ("serial_driver",serial_driver_benchmarks),
+        ("chiller_server",server_benchmarks),
+        ("command_scheduler",scheduling_benchmarks),
+        ]:
+        emulator = OasisEmulator(**emulator_options)
+        emulator.start()
+        try: results[name] = benchmarks(emulator,duration)
+        finally: emulator.stop()
+    results["chiller_fleet"] = fleet_benchmarks(emulator_options,duration)
+    results["transport"] = transport_benchmarks(emulator_options,duration)
+    results["startup"] = startup_benchmarks()
+    results["overhead"] = overhead_benchmarks(duration)
+    return results
+
+def report(results,baseline=None):
+    """Table of the results, with the change of calls/s relative to the
+    baseline if given"""
+    lines = ["%-22s %-20s %9s %8s %8s %8s %8s %8s" % ("section","operation",
+        "calls/s","p50 ms","p90 ms","p99 ms","max ms","vs base")]
+    for section in sorted(results):
+        for operation in sorted(results[section]):
+            r = results[section][operation]
+            change = ""
+            if baseline is not None:
+                try:
+                    base = baseline[section][operation]["calls_per_second"]
+                    change = "%+.0f%%" % (100*(r["calls_per_second"]/base-1))
+                except (KeyError,ZeroDivisionError): change = "new"
+            lines += ["%-22s %-20s %9.1f %8.2f %8.2f %8.2f %8.2f %8s" % (section,
+                operation,r["calls_per_second"],r["p50"],r["p90"],r["p99"],
+                r["max"],change)]
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import json
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--duration",type=float,default=1.0,
+        help="seconds per operation")
+    parser.add_argument("--response-delay",type=float,default=0.0,
+        help="emulated device turnaround time in seconds")
+    parser.add_argument("--baudrate",type=int,default=9600,
+        help="emulated line speed, 0 = no pacing")
+    parser.add_argument("--save",help="write results to this JSON file")
+    parser.add_argument("--baseline",help="compare against this JSON file")
+    parser.add_argument("--check-startup",action="store_true",
+        help="only measure the import time, fail if over budget")
+    parser.add_argument("--check-overhead",action="store_true",
+        help="only measure the Python time per query, fail if over budget")
+    parser.add_argument("--check-framing",action="store_true",
+        help="only check the resynchronization of pipelined replies")
+    parser.add_argument("--check-scaling",action="store_true",
+        help="only compare the throughput of 1, 4 and 8 ports, fail if not linear")
+    parser.add_argument("--transports",action="store_true",
+        help="only compare the pty, TCP and RFC 2217 transports")
+    args = parser.parse_args()
+    if args.transports:
+        print(report({"transport":transport_benchmarks({"baudrate":args.baudrate,
+            "response_delay":args.response_delay},args.duration)}))
+        raise SystemExit(0)
+    if args.check_framing:
+        messages = check_framing()
+        for message in messages: print(message)
+        print("framing: %d misread values" % len(messages))
+        raise SystemExit(1 if messages else 0)
+    if args.check_scaling:
+        results = {"chiller_fleet":fleet_benchmarks({"baudrate":args.baudrate,
+            "response_delay":args.response_delay},args.duration)}
+        print(report(results))
+        messages = check_scaling(results["chiller_fleet"])
+        for message in messages: print(message)
+        raise SystemExit(1 if messages else 0)
+    if args.check_overhead:
+        results = {"overhead":overhead_benchmarks(args.duration)}
+        print(report(results))
+        messages = check_overhead(results["overhead"])
+        for message in messages: print(message)
+        raise SystemExit(1 if messages else 0)
+    if args.check_startup:
+        results = {"startup":startup_benchmarks()}
+        print(report(results))
+        messages = check_startup(results["startup"])
+        for message in messages: print(message)
+        raise SystemExit(1 if messages else 0)
+    results = run(args.duration,response_delay=args.response_delay,
+        baudrate=args.baudrate)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+    print(report(results,baseline))
+    if args.save:
+        with open(args.save,"w") as f: json.dump(results,f,indent=1,sort_keys=True)
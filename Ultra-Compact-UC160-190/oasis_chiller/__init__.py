@@ -0,0 +1,43 @@
+"""
+Oasis chiller drivers, loaded on first use
+
+Importing this package only loads this registry. Each name is resolved from
+the driver modules next to the package the first time it is accessed, so
+numpy, pyserial and the driver singletons cost nothing until they are used.
+
+Usage:
+import oasis_chiller
+oasis_chiller.driver.actual_temperature  # OasisChillerDriver singleton
+oasis_chiller.serial_driver.faults       # serial_driver.Driver singleton
+oasis_chiller.get("oasis_chiller_driver")
+fleet = oasis_chiller.ChillerFleet()
+"""
+# name: (module,attribute)
+registry = {
+    "driver": ("oasis_chiller_driver","driver"),
+    "serial_driver": ("serial_driver","driver"),
+    "OasisChillerDriver": ("oasis_chiller_driver","OasisChillerDriver"),
+    "Driver": ("serial_driver","Driver"),
+    "ChillerFleet": ("chiller_fleet","ChillerFleet"),
+    "ChillerServer": ("chiller_server","ChillerServer"),
+    "ChillerClient": ("chiller_server","ChillerClient"),
+    "TemperatureArchive": ("temperature_archive","TemperatureArchive"),
+    "OasisEmulator": ("oasis_emulator","OasisEmulator"),
+}
+drivers = {"oasis_chiller_driver":"driver","serial_driver":"serial_driver"}
+
+def __getattr__(name):
+    """Import the module providing name on first access"""
+    from importlib import import_module
+    if name not in registry:
+        raise AttributeError("module %r has no attribute %r" % (__name__,name))
+    module,attribute = registry[name]
+    value = getattr(import_module(module),attribute)
+    globals()[name] = value
+    return value
+
+def __dir__(): return sorted(list(globals())+list(registry))
+
+def get(name="oasis_chiller_driver"):
+    """Driver singleton by module name, see drivers"""
+    return __getattr__(drivers[name])
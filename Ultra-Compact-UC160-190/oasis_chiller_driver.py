@@ -56,9 +56,36 @@ Date created: 2009-05-28
 Date last modified: 2018-10-15 Valentyn Stadnytskyi
 """
 
-from struct import pack,unpack
-from numpy import nan,rint,isnan
-from logging import error,warn,info,debug
+from struct import Struct
+from math import isnan
+from time import time,sleep
+from threading import local
+from logging import error,warn,info,debug,getLogger,DEBUG
+from oasis_protocol import reply_length,demultiplex,describe_faults,fault_code
+from oasis_protocol import expected_replies,aligned,realign,shifted
+from port_discovery import find_first
+import port_cache
+from query_stats import QueryStats
+from reconnect import Reconnector
+from command_scheduler import CONTROL,INTERACTIVE,BACKGROUND
+from port_lock import port_lock
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+nan = float("nan") # numpy is only loaded by the modules that need it
+logger = getLogger() # debug messages of the query path are only formatted
+    # if logger.isEnabledFor(DEBUG)
+
+# Precompiled codecs and command tables of the query path
+value_reply = Struct("<BH") # reply code, 16-bit count
+fault_reply = Struct("<BB") # reply code, fault byte
+write_command = Struct("<BH") # command code, 16-bit count
+code_byte = Struct("B")
+read_codes = [0x40 | n for n in range(0,32)] # 01000000 | parameter number
+write_codes = [0x60 | n for n in range(0,32)] # 01100000 | parameter number
+read_commands = [code_byte.pack(code) for code in read_codes]
+reply_lengths = [reply_length(code) for code in range(0,256)]
 
 __version__ = "2.1" # fault code
 
@@ -67,20 +94,44 @@ class OasisChillerDriver(object):
     name = "oasis_chiller"
     timeout = 1.0
     baudrate = 9600
-    id_query = "A"
+    id_query = b"A"
     id_reply_length = 3
+    network_ports = [] # terminal server URLs to scan, e.g. "socket://host:4001"
 
     wait_time = 0 # bewteen commands 
     last_reply_time = 0.0
+    cache_time = 0.5 # seconds a value read or written is reused
+    escalation_threshold = 3 # failed exchanges in a row before reconnecting
+    failed_exchanges = 0 # consecutive exchanges without a valid reply
+    timing = None # AdaptiveTiming, if enabled
+    scheduler = None # CommandScheduler, if enabled
+    recorder = None # WireRecorder, if recording
+
+    def __init__(self):
+        self.cache = {} # parameter number: (value,time)
+        self.pending_writes = {} # parameter number: latest value to write
+        self.cache_lock = allocate_lock()
+        self.query_stats = QueryStats()
+        self.reconnector = Reconnector(self)
+        self.buffers = local() # per-thread receive buffer and priority
+        self.__lock__ = allocate_lock() # queries and reconnects of this driver
+        self.lock_port,self.port_lock = None,None # __port_lock__ of this port
         
     def id_reply_valid(self,reply):
-        valid = reply.startswith("A") and len(reply) == 3
-        debug("Reply %r valid? %r" % (reply,valid))
+        valid = reply.startswith(b"A") and len(reply) == 3
+        debug("Reply %r valid? %r",reply,valid)
         return valid
 
-    # Make multithread safe
-    from thread import allocate_lock
-    __lock__ = allocate_lock()
+    # Make multithread safe: __lock__ serializes the queries of this driver,
+    # also across reconnects, __port_lock__ the exchanges on one physical
+    # port, so that drivers on different ports (or without a port) do not
+    # wait for each other
+    @property
+    def __port_lock__(self):
+        port = self.port
+        if self.port_lock is None or port is not self.lock_port:
+            self.port_lock,self.lock_port = port_lock(self.port_name),port
+        return self.port_lock
     
     port = None
 
@@ -88,7 +139,7 @@ class OasisChillerDriver(object):
         """Temperature set point"""
         debug("Getting nominal temperature...")
         value = self.get_value(1)/10.
-        if not isnan(value): debug("Nominal temperature %r C" % value)
+        if not isnan(value): debug("Nominal temperature %r C",value)
         else: warn("Nominal temperature unreadable")
         return value
     
@@ -101,7 +152,7 @@ class OasisChillerDriver(object):
         """Temperature read value"""
         debug("Getting actual temperature...")
         value = self.get_value(9)/10.
-        if not isnan(value): debug("Actual temperature %r C" % value)
+        if not isnan(value): debug("Actual temperature %r C",value)
         else: warn("Actual temperature unreadable")
         return value
     RBV = actual_temperature
@@ -110,7 +161,7 @@ class OasisChillerDriver(object):
         """Not supported early firmware (serial number 1)"""
         info("Getting low limit...")
         value = self.get_value(6)/10.
-        if not isnan(value): info("Low limit %r C" % value)
+        if not isnan(value): info("Low limit %r C",value)
         else: warn("Low limit unreadable (old firmware?)")
         return value
     def set_low_limit(self,value): self.set_value(6,value*10)
@@ -121,7 +172,7 @@ class OasisChillerDriver(object):
         """Not supported early firmware (serial number 1)"""
         info("Getting high limit...")
         value = self.get_value(7)/10.
-        if not isnan(value): info("High limit %r C" % value)
+        if not isnan(value): info("High limit %r C",value)
         else: warn("High limit unreadable (old firmware?)")
         return value
     def set_high_limit(self,value): self.set_value(7,value*10)
@@ -141,12 +192,120 @@ class OasisChillerDriver(object):
 
     @property
     def online(self):
-        if self.port is None: self.init_communications()
+        """Device found? While it is down, the port is searched again only
+        after the reconnection backoff delay (see reconnect.py)"""
+        reconnector = self.reconnector
+        if self.port is None and reconnector.available():
+            with self.__lock__:
+                if self.port is None:
+                    self.query_stats.count("reconnects")
+                    reconnector.reconnect()
         online = self.port is not None
         if online: debug("Device online")
         else: warn("Device offline")
         return online
 
+    sampler = None
+
+    def start_sampling(self,period=1.0,capacity=86400):
+        """Poll set point, actual temperature and faults in a background
+        thread every period seconds, keeping the last capacity samples"""
+        from sampler import Sampler
+        if self.sampler is None or self.sampler.period != period or \
+            self.sampler.buffer.capacity != capacity:
+            self.stop_sampling()
+            listeners = self.sampler.listeners if self.sampler else []
+            self.sampler = Sampler(self,period=period,capacity=capacity)
+            self.sampler.listeners = listeners
+        self.sampler.start()
+
+    def stop_sampling(self):
+        if self.sampler is not None: self.sampler.stop()
+
+    archive = None
+
+    def start_archiving(self,directory,period=1.0):
+        """Sample every period seconds and store the samples on disk,
+        with min/max/mean summaries for long time ranges
+        (see temperature_archive.py)"""
+        from temperature_archive import TemperatureArchive
+        self.stop_archiving()
+        self.archive = TemperatureArchive(directory,period=period)
+        self.start_sampling(period=period)
+        self.sampler.listeners.append(self.archive.append)
+
+    def stop_archiving(self):
+        if self.archive is not None:
+            if self.sampler is not None and self.archive.append in self.sampler.listeners:
+                self.sampler.listeners.remove(self.archive.append)
+            self.archive.close()
+        self.archive = None
+
+    subscriptions = None
+    subscription_period = 0.25 # seconds, if not sampling already
+
+    def subscribe(self,name,callback,deadband=0.0):
+        """Call callback(event) when a value changes (see subscriptions.py).
+        name: "actual_temperature", "nominal_temperature" or "faults"
+        deadband: minimum temperature change reported
+        All subscribers share the background sampler, which is started
+        if not running. Returns a subscription for unsubscribe"""
+        from subscriptions import Subscriptions
+        if self.subscriptions is None: self.subscriptions = Subscriptions()
+        subscription = self.subscriptions.subscribe(name,callback,deadband)
+        if self.sampler is None or not self.sampler.running:
+            self.start_sampling(period=self.subscription_period)
+        if self.subscriptions not in self.sampler.listeners:
+            self.sampler.listeners.append(self.subscriptions)
+        return subscription
+
+    def unsubscribe(self,subscription):
+        """subscription: as returned by subscribe, or the callback"""
+        if self.subscriptions is not None: self.subscriptions.unsubscribe(subscription)
+
+    publisher = None
+
+    def start_publishing(self,name=None,period=1.0):
+        """Write set point, actual temperature, limits, faults and PID
+        parameters every period seconds into a shared memory block, for
+        OasisChillerState readers in other processes (see shared_state.py)
+        name: of the block, default: self.name"""
+        from shared_state import Publisher
+        self.stop_publishing()
+        self.publisher = Publisher(self,name or self.name,period)
+        self.publisher.start()
+
+    def stop_publishing(self):
+        if self.publisher is not None: self.publisher.stop()
+        self.publisher = None
+
+    def state(self):
+        """Set point, actual temperature, limits, fault byte and PID
+        parameters in one round trip, dictionary with the field names of
+        shared_state.py"""
+        values = self.read_many([1,9,6,7,8,16,17,18,19,20,21])
+        state = {"set_point":values[1]/10.,"actual_temperature":values[9]/10.,
+            "low_limit":values[6]/10.,"high_limit":values[7]/10.,
+            "fault_bits":values[8]}
+        for name,n in zip(("p1","i1","d1","p2","i2","d2"),range(16,22)):
+            state[name] = values[n]
+        return state
+
+    def history(self,since=None):
+        """Sampled history as NumPy structured array with fields time,
+        set_point, actual_temperature, faults (-1 = unreadable), samples
+        taken at or after time since only (if given)"""
+        if self.sampler is None:
+            from numpy import zeros
+            from sampler import dtype
+            return zeros(0,dtype=dtype)
+        return self.sampler.buffer.history(since)
+
+    def latest(self):
+        """Most recent sample, None if not sampling"""
+        if self.sampler is None: return None
+        return self.sampler.buffer.latest()
+
     @property
     def fault_code(self):
         """Report faults as number
@@ -156,197 +315,459 @@ class OasisChillerDriver(object):
         bit 5: Pump Fault
         bit 7: Temperature below alarm range
         """
-        from numpy import nan
         debug("Getting faults...")
-        code = int("01001000",2)
-        command = pack('B',code)
-        reply = self.query(command,count=2)
-        fault_code = nan
-        # The reply is 0xC8 followed by a faults status byte.
-        if len(reply) != 2:
-            if len(reply)>0:
-                warn("%r: expecting 2-byte reply, got %r" % (command,reply))
-            elif self.connected:
-                warn("%r: expecting 2-byte reply, got no reply" % command)
-        else:
-            reply_code,fault_code = unpack('<BB',reply)
-            if reply_code != code:
-                warn("reply %r: expecting 0x%X(%s), got 0x%X(%s)" %
-                     (reply,code,bin(code),reply_code,bin(reply_code)))
-                fault_code = nan
-        if fault_code == 2.0**7:
-            fault_code = 8
-        elif fault_code == 2.0**6:
-            fault_code = 7
-        elif fault_code == 2.0**5:
-            fault_code = 6
-        elif fault_code == 2.0**4:
-            fault_code = 5
-        elif fault_code == 2.0**3:
-            fault_code = 4
-        elif fault_code == 2.0**2:
-            fault_code = 3
-        elif fault_code == 2.0**1:
-            fault_code = 2
-        elif fault_code == 2.0**0:
-            fault_code = 1
-        elif fault_code == 0:
-            fault_code = 0
-        else:
-            fault_code = -1
-        debug("Fault code %s" % fault_code)
-        return fault_code
+        code = fault_code(self.get_value(8))
+        debug("Fault code %s",code)
+        return code
 
     @property
     def faults(self):
         """Report list of faults as string"""
         debug("Getting faults...")
-        code = int("01001000",2)
-        command = pack('B',code)
-        reply = self.query(command,count=2)
-        faults = " "
-        # The reply is 0xC8 followed by a faults status byte.
-        if len(reply) != 2:
-            if len(reply)>0:
-                warn("%r: expecting 2-byte reply, got %r" % (command,reply))
-            elif self.connected:
-                warn("%r: expecting 2-byte reply, got no reply" % command)
-        else:
-            reply_code,bits = unpack('<BB',reply)
-            if reply_code != code:
-                warn("reply %r: expecting 0x%X(%s), got 0x%X(%s)" %
-                     (reply,code,bin(code),reply_code,bin(reply_code)))
-            else:
-                fault_names = {0:"Tank Level Low",2:"Temperature above alarm range",
-                    4:"RTD Fault",5:"Pump Fault",7:"Temperature below alarm range"}
-                faults = ""
-                for i in range(0,8):
-                    if (bits >> i) & 1:
-                        if i in fault_names: faults += fault_names[i]+", "
-                        else: faults += str(i)+", "
-                faults = faults.strip(", ")
-                if faults == "": faults = "none"
-        debug("Faults %s" % faults)
+        faults = describe_faults(self.get_value(8))
+        debug("Faults %s",faults)
         return faults
 
     def get_value(self,parameter_number):
-        """Read a 16-bit value
-        parameter_number: 1-15 (1=set point, 6=low limit, 7=high limit, 9=coolant temp.)
+        """Read a 16-bit value, or the fault byte for parameter 8.
+        A value read or written less than cache_time seconds ago is
+        returned without serial communication.
+        parameter_number: 1-15 (1=set point, 6=low limit, 7=high limit, 8=faults, 9=coolant temp.)
         """
-        code = int("01000000",2) | parameter_number
-        command = pack('B',code)
-        reply = self.query(command,count=3)
+        value = self.cached_value(parameter_number)
+        if value is None:
+            value = self.read_value(parameter_number)
+            self.cache_value(parameter_number,value)
+        return value
+
+    def read_value(self,parameter_number):
+        """Read a 16-bit value (or the fault byte) from the controller"""
+        code = read_codes[parameter_number]
+        command = read_commands[parameter_number]
+        count = reply_lengths[code]
+        n = self.query_into(command,count=count)
+        reply = self.reply_buffer()
         # The reply is 0xC1 followed by 1 16-bit binary count on little-endian byte
         # order. The count is the temperature in degrees Celsius, times 10.
-        if len(reply) != 3:
-            if len(reply)>0:
-                warn("%r: expecting 3-byte reply, got %r" % (command,reply))
+        # The faults reply is 0xC8 followed by a faults status byte.
+        if n != count:
+            if n>0:
+                warn("%r: expecting %d-byte reply, got %r",command,count,bytes(reply[0:n]))
             elif self.connected:
-                warn("%r: expecting 3-byte reply, got no reply" % command)
+                warn("%r: expecting %d-byte reply, got no reply",command,count)
             return nan
-        reply_code,count = unpack('<BH',reply)
+        reply_code,value = (fault_reply if count == 2 else value_reply).unpack_from(reply)
         if reply_code != code:
-            warn("reply %r: expecting 0x%X(%s), got 0x%X(%s)" %
-                 (reply,code,bin(code),reply_code,bin(reply_code)))
+            warn("reply %r: expecting 0x%X(%s), got 0x%X(%s)",bytes(reply[0:n]),
+                code,bin(code),reply_code,bin(reply_code))
+            self.mismatch()
             return nan
-        return count
+        return value
+
+    def cached_value(self,parameter_number):
+        """Value read or written less than cache_time seconds ago, else None"""
+        value,timestamp = self.cache.get(parameter_number,(None,0.0))
+        if time() - timestamp < self.cache_time: return value
+        return None
+
+    def cache_value(self,parameter_number,value):
+        """Remember a value as the device's current one (nan = forget it)"""
+        with self.cache_lock:
+            if isnan(value): self.cache.pop(parameter_number,None)
+            else: self.cache[parameter_number] = (value,time())
+
+    def read_many(self,parameter_numbers):
+        """Read several values in one round trip. The read commands are sent
+        back-to-back and the replies are matched by their echoed reply code.
+        parameter_numbers: e.g. [1,6,7,8,9] (8=faults)
+        Returns a dictionary {parameter_number: value}, with the 16-bit count
+        or the fault byte, nan if unreadable
+        """
+        codes = [read_codes[n] for n in parameter_numbers]
+        command = b"".join([read_commands[n] for n in parameter_numbers])
+        count = sum([reply_lengths[code] for code in codes])
+        reply = self.query(command,count=count)
+        replies = demultiplex(codes,reply)
+        values,missing = {},0
+        for n,code in zip(parameter_numbers,codes):
+            if code not in replies:
+                if self.connected:
+                    warn("reply %r: no reply to 0x%X(%s)",reply,code,bin(code))
+                missing += 1
+                values[n] = nan
+            elif reply_lengths[code] == 2: values[n] = fault_reply.unpack(replies[code])[1]
+            else: values[n] = value_reply.unpack(replies[code])[1]
+            self.cache_value(n,values[n])
+        if missing and len(reply) > 0:
+            self.mismatch(missing,short=len(reply) < count)
+        return values
 
     def set_value(self,parameter_number,value):
-        """Set a 16-bit value"""
-        code = int("01100000",2) | parameter_number
-        command = pack('<BH',code,int(rint(value)))
-        reply = self.query(command,count=1)
-        if len(reply) != 1:
-            warn("expecting 1, got %d bytes" % len(reply)); return
-        reply_code, = unpack('B',reply)
-        if reply_code != code: warn("expecting 0x%X, got 0x%X" % (code,reply_code))
+        """Set a 16-bit value.
+        Writes of the value the device is known to have are skipped. While a
+        write of the same parameter is in progress in another thread, only
+        the latest requested value is sent after it completes."""
+        count = int(round(value))
+        with self.cache_lock:
+            if parameter_number not in self.pending_writes and \
+                self.cached_value(parameter_number) == count:
+                debug("Parameter %r already %r",parameter_number,count)
+                return
+            writing = parameter_number in self.pending_writes
+            self.pending_writes[parameter_number] = count
+        if writing: return
+        try:
+            while True:
+                self.write_value(parameter_number,count)
+                with self.cache_lock:
+                    if self.pending_writes[parameter_number] == count:
+                        del self.pending_writes[parameter_number]
+                        break
+                    count = self.pending_writes[parameter_number]
+        except:
+            with self.cache_lock: self.pending_writes.pop(parameter_number,None)
+            raise
+
+    def write_value(self,parameter_number,count):
+        """Send a 16-bit value to the controller and update the cache"""
+        code = write_codes[parameter_number]
+        command = write_command.pack(code,count)
+        n = self.query_into(command,count=1)
+        if n != 1:
+            warn("expecting 1, got %d bytes",n)
+            self.cache_value(parameter_number,nan); return
+        reply_code = self.reply_buffer()[0]
+        if reply_code != code:
+            warn("expecting 0x%X, got 0x%X",code,reply_code)
+            self.mismatch()
+            self.cache_value(parameter_number,nan)
+        else: self.cache_value(parameter_number,count)
 
     def query(self,command,count=1):
-        """Send a command to the controller and return the reply"""
+        """Send a command to the controller and return the reply.
+        Fails immediately (empty reply) while the device is known to be
+        down, see reconnect.py"""
+        n = self.query_into(command,count)
+        return bytes(self.reply_buffer()[0:n])
+
+    def query_into(self,command,count=1):
+        """Send a command to the controller and receive the reply into this
+        thread's reply_buffer(). Returns the number of bytes received"""
+        scheduler = self.scheduler
+        if scheduler is not None and not scheduler.in_worker():
+            write = code_byte.unpack_from(command)[0] & 0x20
+            reply = scheduler.submit(lambda: self.query(command,count),
+                CONTROL if write else self.thread_priority,
+                key=None if write else command).result()
+            n = len(reply)
+            self.reply_buffer()[0:n] = reply
+            return n
+        reconnector = self.reconnector
+        if not reconnector.available():
+            debug("query: %r: device down",command)
+            return 0
         with self.__lock__: # multithread safe
-            for i in range(0,2):
-                try: reply = self.__query__(command,count)
-                except Exception,msg:
-                    warn("query: %r: attempt %s/2: %s" % (command,i+1,msg))
-                    reply = ""
-                if reply: return reply
-                self.init_communications()
-            return reply
+            lock_time = time()
+            try:
+                for i in range(0,2):
+                    if self.port is None: # not found yet: nothing to send
+                        self.query_stats.count("reconnects")
+                        if not reconnector.reconnect(): return 0
+                        self.failed_exchanges = 0
+                    if i > 0: self.query_stats.count("retries")
+                    sent = False
+                    try:
+                        n = self.__query__(command,count)
+                        sent = True
+                    except Exception as msg:
+                        warn("query: %r: attempt %s/2: %s",command,i+1,msg)
+                        n = 0
+                    if n:
+                        self.failed_exchanges = 0
+                        if reconnector.failures or not reconnector.last_port_name:
+                            reconnector.connected()
+                        return n
+                    # A glitch is resolved by the resynchronization of the
+                    # next exchange, a dead link (or a port error) by
+                    # reconnecting.
+                    if sent: self.failed_exchanges += 1
+                    if sent and self.failed_exchanges < self.escalation_threshold:
+                        continue
+                    self.query_stats.count("reconnects")
+                    if not reconnector.reconnect(): break
+                    self.failed_exchanges = 0
+                return n
+            finally: self.query_stats.count("lock_seconds",time()-lock_time)
+
+    def reply_buffer(self):
+        """Receive buffer of the calling thread, reused for every query"""
+        try: return self.buffers.reply
+        except AttributeError:
+            self.buffers.reply = bytearray(256)
+            return self.buffers.reply
+
+    def watch_hotplug(self):
+        """Reconnect as soon as a serial adapter is plugged in (Linux).
+        Returns False if not supported"""
+        import hotplug
+        return hotplug.watch(self.reconnector.hotplug)
 
     def __query__(self,command,count=1):
-        """Send a command to the controller and return the reply"""
-        from time import time
-        from sleep import sleep
-        sleep(self.last_reply_time + self.wait_time - time())
-        self.write(command)
-        reply = self.read(count=count)
+        """Send a command to the controller and receive the reply into
+        reply_buffer(). Returns the number of bytes received"""
+        wait_time,timeout = self.wait_time,self.timeout
+        timing = self.timing
+        if timing is not None:
+            commands = len(expected_replies(command))
+            wait_time = timing.spacing
+            timeout = timing.deadline(len(command),count,commands)
+        delay = self.last_reply_time + wait_time - time()
+        if delay > 0: sleep(delay)
+        with self.__port_lock__:
+            self.drain()
+            start_time = time()
+            self.write(command)
+            buffer = self.reply_buffer()
+            n = self.read_into(buffer,count,timeout=timeout)
+            if n and (buffer[0] != command[0] or
+                len(command) > (3 if command[0] & 0x20 else 1)): # several commands
+                n = self.resync(buffer,n,count,command,timeout)
         self.last_reply_time = time()
-        return reply
+        if self.port is not None:
+            self.query_stats.record(code_byte.unpack_from(command)[0],
+                self.last_reply_time-start_time,len(command),n,timeout=n < count)
+            if timing is not None:
+                timing.observe(self.last_reply_time-start_time,
+                    len(command),n,ok=n == count,commands=commands)
+        return n
+
+    def drain(self):
+        """Discard bytes received after the last reply (late or spurious),
+        so that they are not taken for the start of the next reply"""
+        waiting = getattr(self.port,"in_waiting",0)
+        if waiting:
+            data = self.read(count=waiting,timeout=0)
+            self.query_stats.count("drained_bytes",len(data))
+            debug("%s: drained %r",self.port_name,data)
+
+    def resync(self,buffer,n,count,command,timeout):
+        """Remove garbage bytes before and between the replies in
+        buffer[0:n] and read the bytes still missing (see
+        oasis_protocol.realign). Returns the new number of bytes, 0 if
+        there was no valid reply header"""
+        codes = expected_replies(command)
+        if aligned(buffer,0,n,codes):
+            extra = self.settle(buffer,n,count,codes)
+            if not extra: return n
+            n += extra
+        self.query_stats.count("resyncs")
+        for attempt in range(0,len(codes)+2):
+            received = bytes(buffer[0:n])
+            n,garbage = realign(buffer,n,codes)
+            if garbage:
+                self.query_stats.count("garbage_bytes",garbage)
+                warn("%r: removed %d garbage bytes from %r",command,garbage,received)
+            if n == 0: break
+            if n < count:
+                if not garbage: break
+                n += self.read_into(memoryview(buffer)[n:],count-n,timeout=timeout)
+                continue
+            extra = self.settle(buffer,n,count,codes)
+            if not extra: break
+            n += extra
+        return n
+
+    def settle(self,buffer,n,count,codes):
+        """If the last reply may have started one byte later (see
+        oasis_protocol.shifted), wait a few byte times for its last byte.
+        Returns the number of bytes received (0 or 1)"""
+        if n < count or not shifted(buffer,n,codes): return 0
+        return self.read_into(memoryview(buffer)[n:],1,timeout=self.settle_time)
+
+    @property
+    def settle_time(self):
+        """Seconds to wait for a byte still on the line (3 byte times)"""
+        return 30.0/self.baudrate
+
+    def mismatch(self,replies=1,short=False):
+        """Account for replies with an unexpected reply code, as one timing
+        error per exchange. short: the exchange timed out, which counted as
+        a timing error already"""
+        self.query_stats.count("mismatches",replies)
+        if self.timing is not None and not short: self.timing.error()
+
+    def set_adaptive_timing(self,enabled=True):
+        """Derive reply deadlines and command spacing from observed replies
+        (see adaptive_timing.py) instead of timeout and wait_time"""
+        from adaptive_timing import AdaptiveTiming
+        self.timing = AdaptiveTiming(self.baudrate) if enabled else None
+
+    def set_scheduling(self,enabled=True):
+        """Send all queries through one worker thread, writes first, then
+        interactive reads, then background telemetry (see command_scheduler.py)"""
+        from command_scheduler import CommandScheduler
+        if self.scheduler is not None: self.scheduler.stop()
+        self.scheduler = None
+        if enabled:
+            self.scheduler = CommandScheduler(self.name)
+            self.scheduler.start()
+
+    def get_thread_priority(self):
+        """Scheduling class of the reads made by the calling thread:
+        INTERACTIVE (default) or BACKGROUND. Writes are always CONTROL"""
+        return getattr(self.buffers,"priority",INTERACTIVE)
+    def set_thread_priority(self,priority): self.buffers.priority = priority
+    thread_priority = property(get_thread_priority,set_thread_priority)
+
+    def submit(self,function,priority=INTERACTIVE,key=None,deadline=None):
+        """Future of function(), executed by the scheduler's worker
+        (scheduling is enabled if needed)"""
+        if self.scheduler is None: self.set_scheduling()
+        return self.scheduler.submit(function,priority,key,deadline)
+
+    def get_value_async(self,parameter_number,priority=INTERACTIVE,deadline=None):
+        """Future of get_value(parameter_number)
+        deadline: seconds, the future fails with DeadlineExceeded if the read
+        cannot start in time"""
+        return self.submit(lambda: self.get_value(parameter_number),priority,
+            ("value",parameter_number),deadline)
+
+    def set_value_async(self,parameter_number,value,deadline=None):
+        """Future of set_value(parameter_number,value), ahead of all reads"""
+        return self.submit(lambda: self.set_value(parameter_number,value),
+            CONTROL,None,deadline)
+
+    def stats(self):
+        """Snapshot of the query statistics (see query_stats.py)"""
+        return self.query_stats.snapshot()
+
+    def start_recording(self,filename):
+        """Log all bytes sent and received to a binary file
+        (see wire_recorder.py)"""
+        from wire_recorder import WireRecorder
+        self.stop_recording()
+        self.recorder = WireRecorder(filename)
+
+    def stop_recording(self):
+        if self.recorder is not None: self.recorder.close()
+        self.recorder = None
 
     def write(self,command):
         """Send a command to the controller"""
-        if self.port is not None:
-            self.port.write(command)
-            debug("%s: Sent %r" % (self.port.name,command))
-
-    def read(self,count=None,port=None):
-        """Read a reply from the controller,
-        terminated with the given terminator string"""
-        ##debug("read count=%r,port=%r" % (count,port))
-        if port is None: port = self.port
+        port = self.port
         if port is not None:
-            #print("in wait:" + str(self.port.inWaiting()))
-            debug("Trying to read %r bytes from %s..." % (count,port.name))
-            port.timeout = self.timeout
-            reply = port.read(count)
-            debug("%s: Read %r" % (port.name,reply))
-        else: reply = ""
-        return reply
+            port.write(command)
+            if self.recorder is not None: self.recorder.sent(command)
+            if logger.isEnabledFor(DEBUG): debug("%s: Sent %r",port.name,command)
+
+    def read(self,count=1,port=None,timeout=None):
+        """Read a reply of count bytes from the controller
+        timeout: default: self.timeout"""
+        buffer = bytearray(count)
+        n = self.read_into(buffer,count,port,timeout)
+        return bytes(buffer[0:n])
+
+    def read_into(self,buffer,count,port=None,timeout=None):
+        """Read a reply of count bytes into buffer (bytearray)
+        timeout: default: self.timeout
+        Returns the number of bytes received"""
+        if port is None: port = self.port
+        if port is None: return 0
+        if timeout is None: timeout = self.timeout
+        # pyserial reconfigures the port on every assignment of timeout
+        if port.timeout != timeout: port.timeout = timeout
+        if hasattr(port,"readinto"): n = port.readinto(memoryview(buffer)[0:count])
+        else:
+            data = port.read(count)
+            n = len(data)
+            buffer[0:n] = data
+        if self.recorder is not None and port is self.port:
+            self.recorder.received(bytes(buffer[0:n]))
+        if logger.isEnabledFor(DEBUG): debug("%s: Read %r",port.name,bytes(buffer[0:n]))
+        return n
 
     def init_communications(self):
         """To do before communncating with the controller"""
-        from os.path import exists
-        from serial import Serial
-
         if self.port is not None:
             try:
                 info("Checking whether device is still responsive...")
-                self.port.write(self.id_query)
-                debug("%s: Sent %r" % (self.port.name,self.id_query))
+                self.write(self.id_query)
                 reply = self.read(count=self.id_reply_length)
                 if not self.id_reply_valid(reply):
-                    debug("%s: %r: invalid reply %r" % (self.port.name,self.id_query,reply))
-                    info("%s: lost connection" % self.port.name)
-                    self.port = None 
+                    debug("%s: %r: invalid reply %r",self.port.name,self.id_query,reply)
+                    info("%s: lost connection",self.port.name)
+                    self.close_port()
                 else: info("Device is still responsive.")
-            except Exception,msg:
-                debug("%s: %s" % (Exception,msg))
-                self.port = None 
+            except Exception as msg:
+                debug("%s: %s",Exception,msg)
+                self.close_port()
+
+        if self.port is None:
+            # Try the port on which the device answered last time first.
+            port_name = port_cache.lookup(self.name)
+            if port_name is not None:
+                try: self.port = self.probe_port(port_name)
+                except Exception as msg: debug("%s: %s",port_name,msg)
+                if self.port is None: port_cache.forget(self.name)
 
         if self.port is None:
-            port_basenames = ["COM"] if not exists("/dev") \
-                else ["/dev/tty.usbserial","/dev/ttyUSB"]
-            for i in range(-1,50):
-                for port_basename in port_basenames:
-                    port_name = port_basename+("%d" % i if i>=0 else "")
-                    ##debug("Trying port %s..." % port_name)
-                    try: 
-                        port = Serial(port_name,baudrate=self.baudrate)
-                        port.write(self.id_query)
-                        debug("%s: Sent %r" % (port.name,self.id_query))
-                        reply = self.read(count=self.id_reply_length,port=port)
-                        if self.id_reply_valid(reply): 
-                           self.port = port
-                           info("Discovered device at %s based on reply %r" % (self.port.name,reply))
-                           break
-                    except Exception,msg: debug("%s: %s" % (Exception,msg))
-                if self.port is not None: break
-
-driver = OasisChillerDriver()
+            # Probe all candidates concurrently, the first valid reply wins.
+            self.port = find_first(self.port_names(),self.probe_port)
+            if self.port is not None: port_cache.remember(self.name,self.port.name)
 
+    def close_port(self):
+        """Release the serial port"""
+        if self.port is not None:
+            try: self.port.close()
+            except Exception as msg: debug("%s: %s",self.port.name,msg)
+        self.port = None
+
+    def port_names(self):
+        """Candidate serial ports to scan for the device, network ports first"""
+        from os.path import exists
+        port_basenames = ["COM"] if not exists("/dev") \
+            else ["/dev/tty.usbserial","/dev/ttyUSB"]
+        port_names = list(self.network_ports)
+        for i in range(-1,50):
+            for port_basename in port_basenames:
+                port_name = port_basename+("%d" % i if i>=0 else "")
+                if port_basename == "COM" or exists(port_name):
+                    port_names += [port_name]
+        return port_names
+
+    def probe_port(self,port_name):
+        """Open a port (device name or URL, see transport.py) and send the
+        ID query. Returns the open port if the reply is valid, None otherwise.
+        The port is opened for exclusive access, so that a port already
+        owned by another driver instance or process is skipped."""
+        from transport import open_port
+        port = open_port(port_name,baudrate=self.baudrate,timeout=self.timeout,
+            exclusive=True)
+        try:
+            port.write(self.id_query)
+            debug("%s: Sent %r",port.name,self.id_query)
+            reply = self.read(count=self.id_reply_length,port=port)
+            if self.id_reply_valid(reply):
+                info("Discovered device at %s based on reply %r",port.name,reply)
+                return port
+        except Exception as msg: debug("%s: %s",Exception,msg)
+        port.close()
+
+singleton_lock = allocate_lock()
+
+def __getattr__(name):
+    """driver: the module's OasisChillerDriver instance, created on first
+    access rather than at import time"""
+    global driver
+    if name != "driver": raise AttributeError("module %r has no attribute %r" % (__name__,name))
+    with singleton_lock:
+        if "driver" not in globals(): driver = OasisChillerDriver()
+    return driver
 
 
 if __name__ == "__main__": # for testing 
+    import logging
     logging.basicConfig(level=logging.INFO,
         format="%(asctime)s %(levelname)s: %(message)s")
+    driver = OasisChillerDriver()
 
@@ -0,0 +1,273 @@
+"""
+Oasis chiller emulator on a Linux pseudo-terminal
+
+Serves the binary protocol both drivers speak, so that they can be tested
+and benchmarked without hardware. The drivers open emulator.port_name like
+a real serial port.
+
+Supported commands (any combination of bits 7 and 6):
+0x41 'A'    ID query / set point read
+0xC1-0xC9   read set point, low limit, high limit, faults, actual temperature
+0xE1-0xE7   write set point, low limit, high limit (followed by 2 bytes)
+0xD0-0xD5   read PID parameters p1,i1,d1,p2,i2,d2
+0xF0-0xF5   write PID parameters (followed by 2 bytes)
+Unknown commands are ignored.
+
+Network mode (terminal server stand-in): start_tcp() serves the protocol
+on a TCP port, port_name is "socket://127.0.0.1:<port>"; start_rfc2217()
+serves it with RFC 2217 Telnet COM port control, port_name is
+"rfc2217://127.0.0.1:<port>". One client at a time, as a terminal server.
+
+Simulated line conditions:
+baudrate        bytes are paced at 10 bits per byte, received and sent
+                (0 = no pacing)
+response_delay  turnaround time between command and reply in seconds
+drop_rate       probability of losing each reply byte
+noise_rate      probability of a garbage byte before a reply
+faults          fault byte reported (bit map, see oasis_chiller_driver.py)
+silent          if True, no replies at all (dead link)
+
+Usage:
+from oasis_emulator import OasisEmulator
+emulator = OasisEmulator()
+emulator.start()
+driver.port = Serial(emulator.port_name,9600)
+emulator.stop()
+emulator.start_tcp() # or start_rfc2217()
+driver.port = transport.open_port(emulator.port_name)
+"""
+from logging import debug
+from struct import pack,unpack
+
+default_values = {
+    1: 200, # set point [0.1 C]
+    6: 20, # low limit
+    7: 450, # high limit
+    8: 0, # faults
+    9: 201, # actual temperature
+    16: 90, 17: 32, 18: 2, 19: 50, 20: 35, 21: 3, # PID p1,i1,d1,p2,i2,d2
+}
+
+class OasisEmulator(object):
+    """Emulated Oasis chiller on a pseudo-terminal"""
+    def __init__(self,baudrate=9600,response_delay=0.0,drop_rate=0.0,
+        noise_rate=0.0,faults=0,seed=None):
+        from random import Random
+        self.baudrate = baudrate
+        self.response_delay = response_delay
+        self.drop_rate = drop_rate
+        self.noise_rate = noise_rate
+        self.silent = False
+        self.values = dict(default_values)
+        self.values[8] = faults
+        self.random = Random(seed)
+        self.commands = 0 # number of commands received
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.listener = None # TCP server socket in network mode
+        self.connection = None # TCP client being served
+        self.rfc2217 = False
+        self.connections = 0 # TCP connections accepted
+
+    def get_faults(self): return self.values[8]
+    def set_faults(self,value): self.values[8] = value
+    faults = property(get_faults,set_faults)
+
+    @property
+    def port_name(self):
+        from os import ttyname
+        if self.listener is not None:
+            host,port = self.listener.getsockname()[0:2]
+            return "%s://%s:%d" % ("rfc2217" if self.rfc2217 else "socket",host,port)
+        return ttyname(self.slave) if self.slave is not None else ""
+
+    @property
+    def byte_time(self):
+        """Transmission time of one byte (8N1 = 10 bits)"""
+        return 10.0/self.baudrate if self.baudrate else 0.0
+
+    def start(self):
+        from os import openpty
+        from threading import Thread
+        import tty
+        self.master,self.slave = openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.thread = Thread(target=self.run,name="oasis_emulator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start_tcp(self,host="127.0.0.1",port=0):
+        """Serve on a TCP port instead of a pty (port 0: any free port)"""
+        import socket
+        from threading import Thread
+        self.listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.listener.bind((host,port))
+        self.listener.listen(1)
+        self.listener.settimeout(0.1)
+        self.thread = Thread(target=self.serve,name="oasis_emulator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start_rfc2217(self,host="127.0.0.1",port=0):
+        """Serve on a TCP port with RFC 2217 Telnet COM port control"""
+        self.rfc2217 = True
+        self.start_tcp(host,port)
+
+    def serve(self):
+        """Accept one TCP client at a time and answer its commands"""
+        import socket
+        while self.listener is not None:
+            try: connection,address = self.listener.accept()
+            except socket.timeout: continue
+            except (OSError,AttributeError): break
+            connection.settimeout(None)
+            connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            self.connections += 1
+            debug("emulator: client %s:%d" % address[0:2])
+            self.connection = connection
+            if self.rfc2217: self.serve_rfc2217(connection)
+            else:
+                self.master = connection.fileno()
+                self.run()
+            self.master,self.connection = None,None
+            try: connection.close()
+            except OSError: pass
+
+    def serve_rfc2217(self,connection):
+        """Telnet COM port control on connection, the protocol on a
+        socket pair behind it"""
+        import socket
+        from threading import Thread
+        from serial.rfc2217 import PortManager
+        device,line = socket.socketpair()
+        self.master = device.fileno()
+        thread = Thread(target=self.run,name="oasis_emulator device")
+        thread.daemon = True
+        thread.start()
+        manager = PortManager(SocketSerial(line),Writer(connection))
+        def to_client():
+            while True:
+                try: data = line.recv(1024)
+                except OSError: break
+                if not data: break
+                try: connection.sendall(b"".join(manager.escape(data)))
+                except OSError: break
+        forward = Thread(target=to_client,name="oasis_emulator rfc2217")
+        forward.daemon = True
+        forward.start()
+        while self.listener is not None:
+            try: data = connection.recv(1024)
+            except OSError: break
+            if not data: break
+            line.sendall(b"".join(manager.filter(data)))
+        self.master = None
+        for sock in device,line:
+            try: sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+        thread.join(1.0)
+        forward.join(1.0)
+        device.close()
+        line.close()
+
+    def stop(self):
+        from os import close
+        listener,connection = self.listener,self.connection
+        self.listener = None
+        if connection is not None:
+            import socket
+            self.master = None # closed with the connection, not here
+            try: connection.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+        if listener is not None: listener.close()
+        master,slave = self.master,self.slave
+        self.master,self.slave = None,None
+        for fd in master,slave:
+            if fd is not None:
+                try: close(fd)
+                except OSError: pass
+        if self.thread is not None: self.thread.join(1.0)
+
+    def run(self):
+        while self.master is not None:
+            try:
+                code = self.receive(1)
+                if code is None: break
+                code, = unpack("B",code)
+                payload = b""
+                if code & 0x20:
+                    payload = self.receive(2)
+                    if payload is None: break
+                self.commands += 1
+                reply = self.reply(code,payload)
+                if reply: self.send(reply)
+            except OSError: break
+
+    def reply(self,code,payload):
+        """Reply to a command, empty for unknown commands"""
+        from time import sleep
+        parameter = code & 0x1F
+        if parameter not in self.values or self.silent: return b""
+        if payload:
+            if parameter in (8,9): return b"" # read-only
+            self.values[parameter], = unpack("<H",payload)
+            reply = pack("B",code)
+        elif parameter == 8: reply = pack("BB",code,self.values[8])
+        else: reply = pack("<BH",code,self.values[parameter])
+        if self.response_delay: sleep(self.response_delay)
+        return reply
+
+    def receive(self,count):
+        """Read count bytes from the line, None if closed"""
+        from os import read
+        from time import sleep
+        data = b""
+        while len(data) < count:
+            try: chunk = read(self.master,count-len(data))
+            except OSError: return None
+            if not chunk: return None
+            data += chunk
+        if self.byte_time: sleep(count*self.byte_time)
+        return data
+
+    def send(self,reply):
+        """Write a reply byte by byte with line pacing and impairments"""
+        from os import write
+        from time import sleep
+        if self.noise_rate and self.random.random() < self.noise_rate:
+            reply = pack("B",self.random.randint(0,255))+reply
+        for i in range(0,len(reply)):
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                debug("emulator: dropped byte %d of %r" % (i,reply))
+                continue
+            if self.byte_time: sleep(self.byte_time)
+            write(self.master,reply[i:i+1])
+
+class SocketSerial(object):
+    """Serial port interface of the device end of the RFC 2217 stand-in,
+    as far as serial.rfc2217.PortManager uses it"""
+    def __init__(self,sock):
+        self.socket = sock
+        self.name = "oasis_emulator"
+        self.baudrate,self.bytesize,self.parity,self.stopbits = 9600,8,"N",1
+        self.rtscts = self.xonxoff = False
+        self.rts = self.dtr = self.break_condition = False
+        self.cts = self.dsr = self.ri = self.cd = False
+    def reset_input_buffer(self): pass
+    def reset_output_buffer(self): pass
+
+class Writer(object):
+    """PortManager's connection object: write() sends to the client"""
+    def __init__(self,sock): self.socket = sock
+    def write(self,data): self.socket.sendall(data)
+
+if __name__ == "__main__":
+    from time import sleep
+    emulator = OasisEmulator()
+    emulator.start()
+    print("Oasis emulator at %s" % emulator.port_name)
+    try:
+        while True: sleep(1)
+    except KeyboardInterrupt: emulator.stop()
@@ -0,0 +1,183 @@
+"""
+Oasis chiller binary protocol helpers shared by oasis_chiller_driver.py and
+serial_driver.py
+
+Command byte: bit 7: remote control active
+              bit 6: remote on/off
+              bit 5: communication direction (1 = write,0 = read)
+              bits 4-0: parameter number
+
+Replies echo the command byte. A write is acknowledged by the echo alone
+(1 byte), the fault read (parameter 8) returns the echo and one status byte
+(2 bytes), every other read returns the echo and a 16-bit little-endian
+value (3 bytes).
+"""
+
+def reply_length(code):
+    """Number of bytes the controller sends back for the given command byte"""
+    if code & 0x20: return 1
+    if code & 0x1F == 8: return 2
+    return 3
+
+def demultiplex(codes,data):
+    """Split the concatenated replies to commands sent back-to-back.
+    codes: command bytes (integers) in the order they were sent
+    data: received bytes
+    Returns a dictionary {code: reply}. A reply only counts if the reply to
+    the next command follows it, or, for the last command, if it ends
+    exactly at the end of data. If data is short (bytes were lost), all
+    replies from it to the end of data have to line up, so that a lost byte
+    cannot shift a value byte into the place of the next reply code.
+    Replies that cannot be checked this way or are incomplete are missing
+    from the dictionary. Bytes that do not start a reply are skipped."""
+    data = bytearray(data)
+    short = len(data) < sum([reply_length(code) for code in codes])
+    replies = {}
+    i = k = 0 # read position, next expected code
+    while i < len(data) and k < len(codes):
+        for m in range(k,len(codes)):
+            if data[i] == codes[m] and framed(data,i,codes,m,short): break
+        else:
+            i += 1
+            continue
+        n = reply_length(codes[m])
+        replies[codes[m]] = bytes(data[i:i+n])
+        i,k = i+n,m+1
+    return replies
+
+def framed(data,i,codes,m,short=False):
+    """Is data[i] the start of the reply to codes[m]? It has to be followed
+    by the reply to codes[m+1], or, for the last code, end with data.
+    short: the replies to all of codes[m:] have to follow"""
+    for code in codes[m:m+1] if not short else codes[m:]:
+        if i >= len(data) or data[i] != code: return False
+        i += reply_length(code)
+    if i == len(data): return True
+    return not short and m+1 < len(codes) and data[i] == codes[m+1]
+
+def expected_replies(command):
+    """Reply codes to the commands in command (bytes), in order. A write
+    command is followed by its 2-byte value"""
+    data = bytearray(command)
+    codes = []
+    i = 0
+    while i < len(data):
+        codes += [data[i]]
+        i += 3 if data[i] & 0x20 else 1
+    return codes
+
+def realign(data,n,codes):
+    """Resynchronization: remove garbage bytes before and between the
+    replies to codes in data[0:n] (bytearray, modified in place).
+    A valid reply header is a byte equal to the next expected reply code
+    that passes intact() and is not doubled(), or to a later one (if
+    replies are missing) that passes skipped().
+    codes: as returned by expected_replies
+    Returns (number of bytes kept, number of garbage bytes removed)"""
+    i = j = k = 0 # read position, write position, next expected code
+    while i < n and k < len(codes):
+        p,next_k = header(data,i,n,codes,k)
+        if p >= n: break
+        length = min(reply_length(codes[next_k]),n-p)
+        data[j:j+length] = data[p:p+length]
+        i,j,k = p+length,j+length,next_k+1
+    return j,n-j
+
+def header(data,i,n,codes,k):
+    """First valid reply header at or after data[i], for codes[k:].
+    Returns (position,index of its code), position n if there is none"""
+    p = i
+    while p < n:
+        if data[p] == codes[k] and intact(data,p,n,codes,k):
+            if not doubled(data,p,n,codes,k): return p,k
+            p += 2 # either byte may start the reply: unreadable
+            continue
+        for m in range(k+1,len(codes)):
+            if data[p] == codes[m] and skipped(data,p,n,codes,k,m): return p,m
+        p += 1
+    return n,k
+
+def intact(data,p,n,codes,m):
+    """Can the reply to codes[m] start at data[p]? Yes if the reply to the
+    next code follows it, as far as received. Otherwise garbage may follow
+    it, or it was cut short by lost bytes, which shows as a reply to
+    codes[m:] starting inside it (skipping replies only as in skipped())"""
+    if m == len(codes)-1 and p+1 < n and data[p+1] == codes[m] and \
+        p+1+reply_length(codes[m]) == n: return False # see shifted()
+    if aligned(data,p,n,codes[m:m+2]): return True
+    for q in range(p+1,min(p+reply_length(codes[m]),n)):
+        for l in range(m,len(codes)):
+            if data[q] != codes[l]: continue
+            if l > m+1 and not complete(data,q,n,codes[l:]): continue
+            if aligned(data,q,n,codes[l:l+2]): return False
+    return True
+
+def skipped(data,p,n,codes,k,m):
+    """Can the reply to the later code codes[m] start at data[p], the
+    replies to codes[k:m] being lost? The replies to all codes after it
+    have to follow and account for the rest of the data, and no intact
+    reply to codes[k] may start inside it (data[p] would be a garbage byte
+    before it)"""
+    if not complete(data,p,n,codes[m:]): return False
+    for q in range(p+1,min(p+reply_length(codes[m]),n)):
+        if data[q] == codes[k] and intact(data,q,n,codes,k): return False
+    return True
+
+def doubled(data,p,n,codes,k):
+    """Is data[p+1] equal to codes[k] too, with neither of the two followed
+    by the reply to the next code? A garbage byte equal to the code before
+    the reply and a first value byte equal to the code look the same then"""
+    return p+1 < n and data[p+1] == codes[k] and \
+        not aligned(data,p,n,codes[k:k+2]) and not aligned(data,p+1,n,codes[k:k+2])
+
+def shifted(data,n,codes):
+    """Could the last reply in data[0:n] start one byte later? If its first
+    value byte equals its code, a garbage byte equal to the last code
+    before the last reply looks like a complete reply. Only the byte after
+    it tells: if there is one, the reply ending with it is the real one
+    (intact() prefers it)"""
+    length = reply_length(codes[-1])
+    return length > 1 and n >= length and \
+        data[n-length] == data[n-length+1] == codes[-1]
+
+def complete(data,i,n,codes):
+    """Do the replies to codes start at data[i] and fill data[i:n], as far
+    as received?"""
+    for code in codes:
+        if i >= n: return True
+        if data[i] != code: return False
+        i += reply_length(code)
+    return i >= n
+
+def aligned(data,i,n,codes):
+    """Do the replies to codes start at data[i], as far as received?"""
+    for code in codes:
+        if i >= n: return True
+        if data[i] != code: return False
+        i += reply_length(code)
+    return True
+
+fault_names = {0:"Tank Level Low",2:"Temperature above alarm range",
+    4:"RTD Fault",5:"Pump Fault",7:"Temperature below alarm range"}
+
+def describe_faults(bits):
+    """Fault byte as comma-separated list of fault names, "none" if there
+    are no faults, " " if unreadable (nan)"""
+    if bits != bits: return " "
+    bits = int(bits)
+    faults = ""
+    for i in range(0,8):
+        if (bits >> i) & 1:
+            if i in fault_names: faults += fault_names[i]+", "
+            else: faults += str(i)+", "
+    faults = faults.strip(", ")
+    if faults == "": faults = "none"
+    return faults
+
+def fault_code(bits):
+    """Fault byte as number: 0 = no faults, n = bit n-1 set alone,
+    -1 = several faults or unreadable"""
+    for i in range(0,8):
+        if bits == 2**i: return i+1
+    if bits == 0: return 0
+    return -1
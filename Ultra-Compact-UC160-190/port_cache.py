@@ -0,0 +1,118 @@
+"""
+Persistent cache of the serial port on which a device last answered its ID
+query, so that startup can try that port first and skip the full scan.
+
+The port is remembered by the identity of its USB-serial adapter (VID:PID,
+serial number and /dev/serial/by-id path, as reported by
+serial.tools.list_ports), not only by its device name, which may change
+between reboots or when the adapter is replugged.
+
+Invalidation rules:
+- an entry older than max_age is ignored
+- if a serial number or by-id path was recorded, the entry is used only if an adapter
+  with the same identity is currently enumerated (under whatever device name
+  it has now)
+- the caller forgets the entry when the cached port fails the ID query
+
+The cache is a small JSON file. Updates are read-modify-write under an
+exclusive file lock and the new contents replace the file atomically, so
+several processes can update it concurrently.
+
+Usage:
+port_name = port_cache.lookup("oasis_chiller")
+port_cache.remember("oasis_chiller",port.name)
+port_cache.forget("oasis_chiller")
+"""
+from logging import debug,warning
+from os.path import join,expanduser,exists,realpath,dirname
+
+filename = join(expanduser("~"),".devices","port_cache.json")
+max_age = 30*24*3600 # seconds
+
+def lookup(device_name):
+    """Device name of the port to try first, or None"""
+    from time import time
+    entry = load().get(device_name)
+    if entry is None: return None
+    if time() - entry.get("time",0) > max_age:
+        debug("port cache: %s: entry expired" % device_name)
+        return None
+    identity = entry.get("identity") or {}
+    # Adapters without serial number and by-id link can only be recognized
+    # by their device name.
+    if not (identity.get("by_id") or identity.get("serial_number")):
+        return entry.get("port")
+    for port_name,port_identity in adapters().items():
+        if same_adapter(identity,port_identity):
+            return port_name
+    debug("port cache: %s: adapter %r not present" % (device_name,identity))
+    return None
+
+def remember(device_name,port_name):
+    """Record that device_name answered on port_name"""
+    from time import time
+    entry = {"port":port_name,"time":time(),
+        "identity":adapters().get(port_name,{})}
+    update(device_name,entry)
+
+def forget(device_name):
+    """Invalidate the entry of device_name"""
+    update(device_name,None)
+
+def same_adapter(a,b):
+    """Do two identity dictionaries describe the same adapter?"""
+    if a.get("by_id") and a.get("by_id") == b.get("by_id"): return True
+    if a.get("serial_number"):
+        return a.get("serial_number") == b.get("serial_number") and \
+            a.get("vid") == b.get("vid") and a.get("pid") == b.get("pid")
+    return False
+
+def adapters():
+    """Identity of the currently enumerated serial ports,
+    dictionary {port_name: identity}"""
+    from glob import glob
+    try: from serial.tools.list_ports import comports
+    except ImportError: return {}
+    by_id = {}
+    for link in glob("/dev/serial/by-id/*"): by_id[realpath(link)] = link
+    identities = {}
+    for item in comports():
+        identities[item.device] = {
+            "vid":item.vid,"pid":item.pid,"serial_number":item.serial_number,
+            "by_id":by_id.get(realpath(item.device)),
+        }
+    return identities
+
+def load():
+    """Contents of the cache file as dictionary"""
+    import json
+    try:
+        with open(filename) as f: return json.load(f)
+    except (IOError,OSError,ValueError) as msg:
+        if exists(filename): warning("port cache: %s: %s" % (filename,msg))
+        return {}
+
+def update(device_name,entry):
+    """Replace the entry of device_name (None = remove) atomically"""
+    import json,os
+    from tempfile import NamedTemporaryFile
+    try:
+        if not exists(dirname(filename)): os.makedirs(dirname(filename))
+        with open(filename+".lock","a") as lock_file:
+            lock(lock_file)
+            cache = load()
+            if entry is None: cache.pop(device_name,None)
+            else: cache[device_name] = entry
+            with NamedTemporaryFile("w",dir=dirname(filename),delete=False) as f:
+                json.dump(cache,f,indent=1,sort_keys=True)
+            os.replace(f.name,filename)
+    except (IOError,OSError) as msg:
+        warning("port cache: %s: %s" % (filename,msg))
+
+def lock(f):
+    """Exclusive lock on an open file, released when the file is closed"""
+    try: import fcntl
+    except ImportError:
+        import msvcrt
+        msvcrt.locking(f.fileno(),msvcrt.LK_LOCK,1)
+    else: fcntl.flock(f.fileno(),fcntl.LOCK_EX)
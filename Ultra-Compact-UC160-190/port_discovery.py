@@ -0,0 +1,80 @@
+"""
+Concurrent serial port discovery shared by oasis_chiller_driver.py and
+serial_driver.py
+
+All candidate ports are probed at the same time in a thread pool, each
+probe bounded by its own port timeout. The first port that answers the ID
+query wins; probes that have not started yet are cancelled and ports opened
+by probes still in flight are closed as soon as they finish.
+
+find_all waits for all probes and returns every port that answered, for
+setups with several identical devices.
+"""
+from logging import debug
+
+max_workers = 32
+
+def find_first(port_names,probe):
+    """Probe all ports concurrently.
+    port_names: candidate device names
+    probe: function(port_name) returning an open port object on a valid ID
+        reply, None otherwise
+    Returns the first open port found, or None"""
+    from concurrent.futures import ThreadPoolExecutor,as_completed
+    from threading import Event
+    port_names = list(port_names)
+    if len(port_names) == 0: return None
+    done = Event()
+
+    def run(port_name):
+        if done.is_set(): return None
+        try: return probe(port_name)
+        except Exception as msg:
+            debug("%s: %s" % (port_name,msg))
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=min(len(port_names),max_workers))
+    futures = [executor.submit(run,port_name) for port_name in port_names]
+    port,winner = None,None
+    try:
+        for future in as_completed(futures):
+            port = future.result()
+            if port is not None:
+                winner = future
+                break
+    finally:
+        done.set()
+        for future in futures:
+            if future is not winner and not future.cancel():
+                future.add_done_callback(close_result)
+        executor.shutdown(wait=False)
+    return port
+
+def find_all(port_names,probe):
+    """Probe all ports concurrently.
+    port_names: candidate device names
+    probe: function(port_name) returning an open port object on a valid ID
+        reply, None otherwise
+    Returns the list of all open ports found, in the order of port_names"""
+    from concurrent.futures import ThreadPoolExecutor
+    port_names = list(port_names)
+    if len(port_names) == 0: return []
+
+    def run(port_name):
+        try: return probe(port_name)
+        except Exception as msg:
+            debug("%s: %s" % (port_name,msg))
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=min(len(port_names),max_workers))
+    try: ports = list(executor.map(run,port_names))
+    finally: executor.shutdown(wait=False)
+    return [port for port in ports if port is not None]
+
+def close_result(future):
+    """Close the port returned by a probe that lost the race"""
+    port = future.result()
+    if port is not None:
+        debug("%s: closing, device already found" % port.name)
+        try: port.close()
+        except Exception as msg: debug("%s: %s" % (port.name,msg))
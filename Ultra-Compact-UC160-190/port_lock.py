@@ -0,0 +1,28 @@
+"""
+One lock per physical serial port
+
+Driver objects talking to the same port must not interleave commands, but
+drivers on different ports should not wait for each other. port_lock(name)
+returns the same lock for all callers asking for the same device, also when
+it is addressed through a different path (e.g. a /dev/serial/by-id link).
+"""
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+locks = {}
+registry_lock = allocate_lock()
+
+def port_lock(port_name):
+    """Lock shared by all users of the serial port port_name"""
+    key = device_key(port_name)
+    with registry_lock:
+        if key not in locks: locks[key] = allocate_lock()
+        return locks[key]
+
+def device_key(port_name):
+    """Canonical name of a device: symbolic links resolved on POSIX,
+    case-insensitive on Windows, network URLs as given"""
+    from os.path import exists,realpath
+    if "://" in port_name: return port_name
+    if exists("/dev"): return realpath(port_name) if port_name else port_name
+    return port_name.upper()
@@ -0,0 +1,131 @@
+"""
+Always-on instrumentation of the serial query path
+
+QueryStats keeps, per command code (first byte of the command), a latency
+histogram with fixed buckets, plus counters of timeouts, retries, reply-code
+mismatches, reconnects, bytes sent and received, the time the port lock
+was held, resynchronizations, garbage bytes skipped and stale bytes drained
+before a command. Recording is a few integer and float updates under a lock, cheap
+enough to leave enabled.
+
+Usage:
+driver.stats()                  # dictionary snapshot
+print(driver.query_stats.prometheus())
+start_exporter([driver],9101)   # http://localhost:9101/metrics
+"""
+from bisect import bisect_left
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+# upper bounds of the latency buckets in seconds, the last bucket is +Inf
+buckets = (0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.0,2.0,5.0)
+counter_names = ("timeouts","retries","mismatches","reconnects","bytes_out",
+    "bytes_in","lock_seconds","resyncs","garbage_bytes","drained_bytes")
+
+class QueryStats(object):
+    """Latency histograms and error counters of one driver"""
+    def __init__(self):
+        self.lock = allocate_lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {} # code: [count per bucket..., count of +Inf]
+            self.sums = {} # code: total seconds
+            self.counters = dict([(name,0) for name in counter_names])
+
+    def record(self,code,seconds,bytes_out=0,bytes_in=0,timeout=False):
+        """One command/reply exchange"""
+        i = bisect_left(buckets,seconds)
+        with self.lock:
+            if code not in self.histograms:
+                self.histograms[code] = [0]*(len(buckets)+1)
+                self.sums[code] = 0.0
+            self.histograms[code][i] += 1
+            self.sums[code] += seconds
+            self.counters["bytes_out"] += bytes_out
+            self.counters["bytes_in"] += bytes_in
+            if timeout: self.counters["timeouts"] += 1
+
+    def count(self,name,value=1):
+        """Increment a counter, e.g. "retries", "mismatches", "reconnects",
+        "lock_seconds" """
+        with self.lock: self.counters[name] += value
+
+    def snapshot(self):
+        """Copy of all statistics as dictionary:
+        buckets, counters, commands: {code: {histogram,count,sum}}"""
+        with self.lock:
+            commands = {}
+            for code in self.histograms:
+                histogram = list(self.histograms[code])
+                commands[code] = {"histogram":histogram,"count":sum(histogram),
+                    "sum":self.sums[code]}
+            return {"buckets":buckets,"counters":dict(self.counters),
+                "commands":commands}
+
+    def prometheus(self,prefix="oasis_chiller",labels=None):
+        """Statistics in Prometheus text exposition format"""
+        return prometheus_text([(self,labels or {})],prefix)
+
+def prometheus_text(sources,prefix="oasis_chiller"):
+    """Prometheus text exposition of several QueryStats, each metric family
+    as one group.
+    sources: list of (QueryStats,labels dictionary)"""
+    snapshots = [(stats.snapshot(),labels) for stats,labels in sources]
+    lines = []
+    name = prefix+"_query_seconds"
+    lines += ["# HELP %s Command/reply latency" % name,
+        "# TYPE %s histogram" % name]
+    for stats,labels in snapshots:
+        for code in sorted(stats["commands"]):
+            command = stats["commands"][code]
+            code_labels = dict(labels,code="0x%02X" % code)
+            total = 0
+            for le,n in zip([repr(b) for b in buckets]+["+Inf"],command["histogram"]):
+                total += n
+                lines += ["%s_bucket%s %d" % (name,label_text(dict(code_labels,le=le)),total)]
+            lines += ["%s_sum%s %r" % (name,label_text(code_labels),command["sum"])]
+            lines += ["%s_count%s %d" % (name,label_text(code_labels),command["count"])]
+    for counter in counter_names:
+        name = "%s_%s_total" % (prefix,counter)
+        lines += ["# TYPE %s counter" % name]
+        for stats,labels in snapshots:
+            lines += ["%s%s %r" % (name,label_text(labels),stats["counters"][counter])]
+    return "\n".join(lines)+"\n"
+
+def label_text(labels):
+    if not labels: return ""
+    return "{"+",".join(['%s="%s"' % (k,labels[k]) for k in sorted(labels)])+"}"
+
+def start_exporter(drivers,port=9101):
+    """Serve /metrics of the given drivers over HTTP in a background thread.
+    Returns the server; call server.shutdown() to stop"""
+    from threading import Thread
+    try: from http.server import HTTPServer,BaseHTTPRequestHandler
+    except ImportError: from BaseHTTPServer import HTTPServer,BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            text = prometheus_text([(driver.query_stats,{"device":driver.name,
+                "port":port_of(driver)}) for driver in drivers])
+            body = text.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4")
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self,*args): pass
+
+    server = HTTPServer(("",port),Handler)
+    thread = Thread(target=server.serve_forever,name="stats_exporter")
+    thread.daemon = True
+    thread.start()
+    return server
+
+def port_of(driver):
+    """Port name of either driver class"""
+    if hasattr(driver,"port_name"): return driver.port_name
+    ser = getattr(driver,"ser",None)
+    return ser.port if ser is not None else ""
@@ -0,0 +1,93 @@
+"""
+Targeted reconnection of OasisChillerDriver after a failed query
+
+Instead of a full port rescan after every failed query, a Reconnector tries,
+in this order:
+1. reopen the device path that worked last
+2. the port of the same USB adapter, found by its identity (port_cache.py),
+   in case it came back under a different name
+3. a full concurrent scan (port_discovery.py)
+Between failed attempts it waits with exponential backoff and jitter
+(base_delay x 2^n x 0.5...1.5, at most max_delay). While the device is known
+to be down, queries fail immediately instead of blocking on the port.
+
+With hot-plug detection enabled (hotplug.py, Linux inotify on /dev and
+/dev/serial/by-id), a new serial device node ends the backoff and triggers
+a reconnection attempt right away.
+
+Usage:
+driver.watch_hotplug()
+driver.reconnector.down
+"""
+from logging import debug,info,warn
+from time import time
+
+class Reconnector(object):
+    """Reconnect state machine of one driver"""
+    base_delay = 0.5 # seconds
+    max_delay = 30.0 # seconds
+
+    def __init__(self,driver):
+        from random import Random
+        self.driver = driver
+        self.failures = 0 # consecutive failed reconnection attempts
+        self.next_attempt = 0.0
+        self.last_port_name = ""
+        self.random = Random()
+
+    @property
+    def down(self):
+        """Has the device been unreachable since the last attempt?"""
+        return self.failures > 0
+
+    def available(self):
+        """May a query use the port now? False while the device is down and
+        the backoff delay has not expired"""
+        return self.failures == 0 or time() >= self.next_attempt
+
+    def connected(self):
+        """Record a successful exchange"""
+        if self.driver.port is not None:
+            self.last_port_name = self.driver.port_name
+        if self.failures:
+            info("%s: device back on %s" % (self.driver.name,self.last_port_name))
+        self.failures = 0
+
+    def reconnect(self):
+        """One reconnection attempt. Returns True if the device answers"""
+        import port_cache
+        from port_discovery import find_first
+        driver = self.driver
+        if driver.port is not None:
+            self.last_port_name = driver.port_name
+            driver.close_port()
+        port_names = []
+        if self.last_port_name: port_names += [self.last_port_name]
+        cached = port_cache.lookup(driver.name)
+        if cached is not None and cached not in port_names: port_names += [cached]
+        port = None
+        for port_name in port_names:
+            try: port = driver.probe_port(port_name)
+            except Exception as msg: debug("%s: %s" % (port_name,msg))
+            if port is not None: break
+        if port is None:
+            port = find_first(driver.port_names(),driver.probe_port)
+        if port is not None:
+            driver.port = port
+            port_cache.remember(driver.name,driver.port_name)
+            self.connected()
+            return True
+        self.failures += 1
+        delay = min(self.base_delay*2**(self.failures-1),self.max_delay)
+        delay *= self.random.uniform(0.5,1.5)
+        self.next_attempt = time()+delay
+        warn("%s: device down, next attempt in %.1f s" % (driver.name,delay))
+        return False
+
+    def hotplug(self,path):
+        """A serial device node appeared: end the backoff and retry now"""
+        if not self.down: return
+        debug("%s: %s appeared" % (self.driver.name,path))
+        self.next_attempt = 0.0
+        with self.driver.__lock__:
+            if self.down: self.reconnect()
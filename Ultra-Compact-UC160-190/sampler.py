@@ -0,0 +1,108 @@
+"""
+Background sampling of the Oasis chiller into a fixed-capacity history
+
+A Sampler thread polls the driver at a fixed rate and stores timestamped
+set point, actual temperature and fault byte in a RingBuffer, a
+preallocated NumPy structured array. Dashboards and loggers read the
+history from memory without serial communication.
+
+Usage:
+driver.start_sampling(period=1.0)
+driver.latest()
+driver.history(since=time()-3600)
+driver.stop_sampling()
+driver.start_archiving(directory) # also to disk, see temperature_archive.py
+driver.subscribe(name,callback) # on change, see subscriptions.py
+"""
+from logging import warn
+from numpy import isnan,zeros,concatenate,searchsorted
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+dtype = [("time","f8"),("set_point","f8"),("actual_temperature","f8"),
+    ("faults","i2")]
+
+class RingBuffer(object):
+    """Fixed-capacity history of records, oldest overwritten first"""
+    def __init__(self,capacity,dtype=dtype):
+        self.data = zeros(capacity,dtype=dtype)
+        self.count = 0 # total number of records ever appended
+        self.lock = allocate_lock()
+
+    @property
+    def capacity(self): return len(self.data)
+
+    def append(self,record):
+        """record: tuple matching the dtype"""
+        with self.lock:
+            self.data[self.count % self.capacity] = record
+            self.count += 1
+
+    def latest(self):
+        """Copy of the most recent record, None if empty"""
+        with self.lock:
+            if self.count == 0: return None
+            return self.data[(self.count-1) % self.capacity].copy()
+
+    def history(self,since=None):
+        """Copy of the records in chronological order, those with time >=
+        since only (if given)"""
+        with self.lock:
+            i = self.count % self.capacity
+            if self.count <= self.capacity: data = self.data[0:self.count].copy()
+            else: data = concatenate((self.data[i:],self.data[0:i]))
+        if since is not None:
+            data = data[searchsorted(data["time"],since):]
+        return data
+
+class Sampler(object):
+    """Thread polling a driver at a fixed rate into a RingBuffer"""
+    def __init__(self,driver,period=1.0,capacity=86400):
+        self.driver = driver
+        self.period = period
+        self.buffer = RingBuffer(capacity)
+        self.listeners = [] # functions called with every sample
+        self.thread = None
+        from threading import Event
+        self.stop_event = Event()
+
+    @property
+    def running(self): return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        from threading import Thread
+        if self.running: return
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run,name="sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+
+    def run(self):
+        from time import time
+        from command_scheduler import BACKGROUND
+        self.driver.thread_priority = BACKGROUND
+        next_time = time()
+        while not self.stop_event.is_set():
+            try: self.sample()
+            except Exception as msg: warn("sampler: %s" % msg)
+            next_time += self.period
+            # Skip missed samples rather than bursting to catch up.
+            if next_time < time(): next_time = time()
+            self.stop_event.wait(next_time - time())
+
+    def sample(self):
+        """Read set point, actual temperature and faults in one round trip"""
+        from time import time
+        values = self.driver.read_many([1,9,8])
+        faults = values[8]
+        sample = (time(),values[1]/10.,values[9]/10.,-1 if isnan(faults) else faults)
+        self.buffer.append(sample)
+        for listener in list(self.listeners):
+            try: listener(sample)
+            except Exception as msg: warn("sampler: %s: %s" % (listener,msg))
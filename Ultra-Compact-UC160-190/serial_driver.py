@@ -58,8 +58,9 @@ avaiable properties:
 
 special functions:
     - get_PID
-    - set_PID
+    - set_PID (writes only the parameters that differ, confirmed)
     - set_default_PID
+    - write_many
 
 The fault byte is a bit map (0 = OK, 1 = Fault):
 bit 0: Tank Level Low
@@ -72,22 +73,31 @@ version 1.0.0 - basic working version
 
 """
 
-from serial import Serial
-from time import time, sleep, clock
+from time import time, sleep
+from threading import local
 import sys
 import os.path
-from pdb import pm
 from time import gmtime, strftime
 import logging
 from struct import pack, unpack
-from timeit import Timer
+from math import isnan
 
 from logging import debug,info,warning,error
 
-from numpy import nan
+from oasis_protocol import reply_length, demultiplex
+from oasis_protocol import expected_replies, aligned, realign, shifted
+from port_discovery import find_first
+import port_cache
+from query_stats import QueryStats
+from command_scheduler import CONTROL, INTERACTIVE, BACKGROUND
 
 __version__ = '1.0.0' #
 
+nan = float('nan') #same as numpy.nan, numpy is imported where needed
+
+#factory settings: good settings
+factory_PID = {'p1': 90, 'i1': 32, 'd1': 2, 'p2': 50, 'i2': 35, 'd2': 3}
+
 
 class Driver(object): #Oasis driver
     def __init__(self):
@@ -101,6 +111,27 @@ class Driver(object): #Oasis driver
         self.fault_description[4] = 'RTD Fault'
         self.fault_description[5] = 'Pump Fault'
         self.fault_description[7] = 'Temperature below alarm range'
+        self.query_stats = QueryStats()
+        self.timing = None #AdaptiveTiming, see set_adaptive_timing
+        self.last_reply_time = 0.0
+        self.recorder = None #WireRecorder, see start_recording
+        self.scheduler = None #CommandScheduler, see set_scheduling
+        #terminal server URLs to scan, e.g. 'socket://host:4001'
+        self.network_ports = []
+        self.threads = local() #per-thread scheduling priority
+        #read command bytes by parameter name, see read_many
+        self.read_commands = {}
+        self.read_commands['target_temperature'] = 0xC1
+        self.read_commands['lower_limit'] = 0xC6
+        self.read_commands['upper_limit'] = 0xC7
+        self.read_commands['faults'] = 0xC8
+        self.read_commands['actual_temperature'] = 0xC9
+        self.read_commands['p1'] = 0xD0
+        self.read_commands['i1'] = 0xD1
+        self.read_commands['d1'] = 0xD2
+        self.read_commands['p2'] = 0xD3
+        self.read_commands['i2'] = 0xD4
+        self.read_commands['d2'] = 0xD5
         
     def init(self):
         """
@@ -115,33 +146,63 @@ class Driver(object): #Oasis driver
         """
         executes proper shutdown of the driver
         """
+        self.stop_publishing()
+        self.set_scheduling(False)
         self._close_port()
 
     def find_port(self):
+        """
+        tries the port cached from the last successful run first, otherwise
+        probes all enumerated comports concurrently and keeps the first one
+        that answers the 'A' ID query. Returns True if the device was found.
+        """
         import serial.tools.list_ports
-        lst = serial.tools.list_ports.comports()
-        flag = False
-        id_query_command = 'A'
-        for item in lst:
-            port = item.device
+        ser = None
+        port = port_cache.lookup(self.name)
+        if port is not None:
             try:
-                self.ser = Serial(port, baudrate=9600, timeout=0.1)
-                sleep(0.5)
-                try:
-                    info('open Com port (%r) found (%r)' % (port,item.description))
-                    if self.check_id():
-                        info("the requested device is connected to COM Port %r" % self.ser.port)
-                        flag = True
-                        break
-                    else:
-                        info("Oasis is not found")
-                        self.ser.close()
-                        info("closing com port")
-                except:
-                    self.ser.close()
-            except:
-                pass
-        return flag
+                ser = self._probe_port(port)
+            except Exception as msg:
+                debug('%s: %s' % (port,msg))
+            if ser is None:
+                port_cache.forget(self.name)
+        if ser is None:
+            lst = serial.tools.list_ports.comports()
+            for item in lst:
+                info('open Com port (%r) found (%r)' % (item.device,item.description))
+            ser = find_first(self.network_ports+[item.device for item in lst],
+                self._probe_port)
+            if ser is not None:
+                port_cache.remember(self.name,ser.port)
+        if ser is not None:
+            self.ser = ser
+            info("the requested device is connected to COM Port %r" % self.ser.port)
+        else:
+            info("Oasis is not found")
+        return ser is not None
+
+    def _probe_port(self,port):
+        """
+        opens the port (device name or URL, see transport.py) and sends the
+        'A' ID query.
+        Returns the open port object on a valid reply, None otherwise.
+        """
+        from transport import open_port, is_url
+        ser = open_port(port, baudrate=9600, timeout=0.1)
+        try:
+            if not is_url(port):
+                sleep(0.5) #settling time after opening the port
+            ser.reset_input_buffer()
+            ser.write(b'A')
+            ser.timeout = 1.0
+            reply = ser.read(3)
+            if len(reply) == 3 and reply[0:1] == b'A':
+                return ser
+        except Exception as msg:
+            debug('%s: %s' % (port,msg))
+        info("closing com port %r" % port)
+        ser.close()
+        return None
     
     """Basic serial communication functions"""   
     def _readall(self):
@@ -150,7 +211,6 @@ class Driver(object): #Oasis driver
 
     def _readN(self,N):
         #tested dec 17, 2017
-        from numpy import nan
         data = ""
         if self._waiting()[0] >= N:
             data = self.ser.read(N)
@@ -173,23 +233,172 @@ class Driver(object): #Oasis driver
         
     def _inquire(self,command, N):
         #tested dec 17, 2017
-        from time import time
-        from numpy import nan
         result = None
-        if 'ser' in driver.__dict__.keys():
+        if 'ser' in self.__dict__.keys():
             if self.ser.isOpen():
-                self.ser.write(command)
-                tstart = time()
-                while self.ser.inWaiting() < N:
-                    sleep(0.05)
-                    if time() - tstart > self.timeout_time:
-                        break   
-                if self.ser.inWaiting() == N:
-                    result = self._readN(N)
-                else:
+                result = self._transact(command,N)
+                if len(result) != N:
                     result = nan
         return result
-        
+
+    def _transact(self,command,N):
+        """
+        writes command, reads the N-byte reply and records the exchange
+        in query_stats
+        """
+        scheduler = self.__dict__.get('scheduler')
+        if scheduler is not None and not scheduler.in_worker():
+            write = bytearray(command)[0] & 0x20
+            return scheduler.submit(lambda: self._transact(command,N),
+                CONTROL if write else self.thread_priority,
+                key = None if write else command).result()
+        timeout = None
+        if self.timing is not None:
+            commands = len(expected_replies(command))
+            sleep(max(self.last_reply_time + self.timing.spacing - time(),0))
+            timeout = self.timing.deadline(len(command),N,commands)
+        self._drain()
+        start = time()
+        self.ser.write(command)
+        if self.recorder is not None:
+            self.recorder.sent(command)
+        reply = self._read_exactly(N,timeout)
+        if len(reply) > 0 and (reply[0:1] != command[0:1] or
+            len(command) > (3 if bytearray(command)[0] & 0x20 else 1)):
+            reply = self._resync(reply,N,command,timeout)
+        self.last_reply_time = time()
+        self.query_stats.record(bytearray(command)[0],self.last_reply_time-start,
+            len(command),len(reply),timeout = len(reply) < N)
+        if self.timing is not None:
+            self.timing.observe(self.last_reply_time-start,len(command),
+                len(reply),ok = len(reply) == N,commands = commands)
+        return reply
+
+    def set_adaptive_timing(self,enabled = True):
+        """
+        derives reply deadlines and command spacing from observed replies
+        (see adaptive_timing.py) instead of timeout_time
+        """
+        from adaptive_timing import AdaptiveTiming
+        self.timing = AdaptiveTiming(9600) if enabled else None
+
+    def set_scheduling(self,enabled = True):
+        """
+        sends all commands through one worker thread: writes first, then
+        interactive reads, then background telemetry (see
+        command_scheduler.py). The pauses between PID writes no longer hold
+        up other threads' commands.
+        """
+        from command_scheduler import CommandScheduler
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.scheduler = None
+        if enabled:
+            self.scheduler = CommandScheduler(self.name)
+            self.scheduler.start()
+
+    def get_thread_priority(self):
+        """
+        scheduling class of the reads made by the calling thread:
+        INTERACTIVE (default) or BACKGROUND. Writes are always CONTROL.
+        """
+        return getattr(self.threads,'priority',INTERACTIVE)
+    def set_thread_priority(self,priority):
+        self.threads.priority = priority
+    thread_priority = property(get_thread_priority,set_thread_priority)
+
+    def start_recording(self,filename):
+        """
+        logs all commands and replies to a binary file (see wire_recorder.py)
+        """
+        from wire_recorder import WireRecorder
+        self.stop_recording()
+        self.recorder = WireRecorder(filename)
+
+    def stop_recording(self):
+        if self.recorder is not None: self.recorder.close()
+        self.recorder = None
+
+    def _drain(self):
+        """
+        discards bytes received after the last reply (late or spurious),
+        so that they are not taken for the start of the next reply
+        """
+        waiting = self.ser.in_waiting
+        if waiting:
+            data = self.ser.read(waiting)
+            if self.recorder is not None:
+                self.recorder.received(data)
+            self.query_stats.count('drained_bytes',len(data))
+            debug('drained %r' % data)
+
+    def _resync(self,reply,N,command,timeout = None):
+        """
+        removes garbage bytes before and between the replies and reads the
+        bytes still missing (see oasis_protocol.realign). Returns the
+        realigned reply, empty if there was no valid reply header.
+        """
+        codes = expected_replies(command)
+        data = bytearray(reply)
+        if aligned(data,0,len(data),codes):
+            extra = self._settle(data,N,codes)
+            if not extra:
+                return reply
+            data += extra
+        self.query_stats.count('resyncs')
+        for attempt in range(0,len(codes)+2):
+            received = bytes(data)
+            n,garbage = realign(data,len(data),codes)
+            del data[n:]
+            if garbage:
+                self.query_stats.count('garbage_bytes',garbage)
+                warning('%r: removed %d garbage bytes from %r' % (command,garbage,received))
+            if n == 0:
+                break
+            if n < N:
+                if not garbage:
+                    break
+                data += self._read_exactly(N-n,timeout)
+                continue
+            extra = self._settle(data,N,codes)
+            if not extra:
+                break
+            data += extra
+        return bytes(data)
+
+    def _settle(self,data,N,codes):
+        """
+        if the last reply may have started one byte later (see
+        oasis_protocol.shifted), waits three byte times for its last byte.
+        Returns the bytes received (at most one).
+        """
+        if len(data) < N or not shifted(data,len(data),codes):
+            return b''
+        return self._read_exactly(1,30.0/9600)
+
+    def _read_exactly(self,N,timeout = None):
+        """
+        blocks until exactly N bytes have arrived or the deadline has passed.
+        Returns the bytes received, shorter than N on timeout. Extra bytes
+        are left in the input buffer.
+        """
+        if timeout is None:
+            timeout = self.timeout_time
+        # pyserial's blocking read returns as soon as the N-th byte arrives;
+        # only reconfigure the port when the timeout actually changes
+        if self.ser.timeout != timeout:
+            self.ser.timeout = timeout
+        data = self.ser.read(N)
+        if self.recorder is not None:
+            self.recorder.received(data)
+        return data
+
+    def stats(self):
+        """
+        returns a snapshot of the query statistics (see query_stats.py)
+        """
+        return self.query_stats.snapshot()
+
     def _waiting(self):
         #tested dec 17, 2017
         return [self.ser.in_waiting,self.ser.out_waiting]
@@ -204,20 +413,20 @@ class Driver(object): #Oasis driver
         self.ser.open()
 
     def check_id(self):
-        id_query_command = 'A'
-        if self._inquire(id_query_command,3) is not None:
-            response = self._inquire(id_query_command,3)[0]
+        id_query_command = b'A'
+        response = self._inquire(id_query_command,3)
+        if isinstance(response,bytes):
+            response = response[0:1]
         else:
-            response = ''
+            response = b''
         return id_query_command == response
     
     def set_target_temperature(self,temperature):
-        local_byte = pack('h',round(temperature*10,0))
-        byte_temp = local_byte[0]+local_byte[1]
-        self._inquire('\xe1'+byte_temp,1)
+        byte_temp = pack('h',int(round(temperature*10,0)))
+        self._inquire(b'\xe1'+byte_temp,1)
     def get_target_temperature(self):  
-        res = self._inquire('\xc1',3)
-        if res is not None:
+        res = self._inquire(b'\xc1',3)
+        if isinstance(res,bytes):
             temperature = unpack('h',res[1:3])[0]/10.
         else:
             temperature = None
@@ -225,8 +434,8 @@ class Driver(object): #Oasis driver
     target_temperature = property(get_target_temperature,set_target_temperature)
         
     def get_actual_temperature(self):
-        res = self._inquire('\xc9',3)
-        if res is not None:
+        res = self._inquire(b'\xc9',3)
+        if isinstance(res,bytes):
             temperature = unpack('h',res[1:3])[0]/10.
         else:
             temperature = None
@@ -234,130 +443,220 @@ class Driver(object): #Oasis driver
     actual_temperature = property(get_actual_temperature)
     
     def get_faults(self):
-        from numpy import log2
-        res_temp = self._inquire('\xc8',2)
-        if res_temp is not None:
-            res = unpack('b',res_temp[1])[0]
+        res_temp = self._inquire(b'\xc8',2)
+        if isinstance(res_temp,bytes):
+            res = unpack('b',res_temp[1:2])[0]
         else:
             res = -1
-        
+        return self._decode_faults(res)
+    faults = property(get_faults)
+
+    def _decode_faults(self,res):
+        """
+        converts the signed fault byte into (0,0) if there are no faults,
+        (1,bit number) otherwise and None if there was no reply (-1)
+        """
         if res == 0:
             result = (0,int(res))
         elif res == -1:
             result = None
         else:
-            result = (1,int(log2(abs(res))))
+            result = (1,abs(res).bit_length()-1)
         return result
-    faults = property(get_faults)
 
 
     def get_lower_limit(self):
-        res = self._inquire('\xc6',3)
-        if res is not None:
+        res = self._inquire(b'\xc6',3)
+        if isinstance(res,bytes):
             lower_limit = unpack('h',res[1:3])[0]/10.
         else:
             lower_limit = None
         return lower_limit
     def set_lower_limit(self,temperature):
-        local_byte = pack('h',round(temperature*10,0))
-        byte_temp = local_byte[0]+local_byte[1]
-        self._inquire('\xe6'+byte_temp,1)
+        byte_temp = pack('h',int(round(temperature*10,0)))
+        self._inquire(b'\xe6'+byte_temp,1)
     lower_limit = property(get_lower_limit,set_lower_limit)
 
-    def get_PID(self):
-        from time import sleep
-        dic = {}
-        res_dic = {}
-        try:
-            dic['p1'] = ('\xd0',3)
-        except:
-            dic['p1'] = nan
-        try:
-            dic['i1'] = ('\xd1',3)
-        except:
-            dic['p1'] = nan
-        try:
-            dic['d1'] = ('\xd2',3)
-        except:
-            dic['p1'] = nan
-        try:
-            dic['p2'] = ('\xd3',3)
-        except:
-            dic['p1'] = nan
-        try:   
-            dic['i2'] = ('\xd4',3)
-        except:
-            dic['p1'] = nan
-        try:
-            dic['d2'] = ('\xd5',3)
-        except:
-            dic['p1'] = nan
-        for key in dic.keys():
-            res = self._inquire(dic[key][0],dic[key][1])
-            if res is not None or res is not nan:
-                res_dic[key] = unpack('H',res[1]+res[2])
+    def read_many(self,names):
+        """
+        reads several parameters in one round trip: the read commands are
+        sent back-to-back and the replies are matched by their echoed reply
+        code (0xC1, 0xC6, 0xC7, 0xC8, 0xC9, 0xD0-0xD5).
+
+        names: list of keys of self.read_commands,
+        e.g. ['target_temperature','actual_temperature','faults']
+        returns dictionary {name: value}: temperatures in C, faults as in
+        get_faults, PID parameters as integers and nan for missing replies.
+        With 'faults', 'fault_bits' is the raw fault byte (bit map).
+        """
+        result = {}
+        if 'ser' not in self.__dict__.keys() or not self.ser.isOpen():
+            return result
+        codes = [self.read_commands[name] for name in names]
+        N = sum([reply_length(code) for code in codes])
+        reply = self._transact(bytes(bytearray(codes)),N)
+        replies = demultiplex(codes,reply)
+        missing = 0
+        for name,code in zip(names,codes):
+            if code not in replies:
+                warning('read_many: no reply to 0x%X (%s)' % (code,name))
+                missing += 1
+                result[name] = nan
+            elif name == 'faults':
+                result[name] = self._decode_faults(unpack('b',replies[code][1:2])[0])
+                result['fault_bits'] = bytearray(replies[code])[1]
+            elif code >= 0xD0:
+                result[name] = unpack('H',replies[code][1:3])[0]
             else:
-                res = nan
-            sleep(0.5)
-        return res_dic
-
-    def set_default_PID(self, pid_dic = ('','')):
-        pid_dic = {}
-        #factory settings: good settings
-        pid_dic['p1'] = 90
-        pid_dic['i1'] = 32
-        pid_dic['d1'] = 2
-        pid_dic['p2'] = 50
-        pid_dic['i2'] = 35
-        pid_dic['d2'] = 3
-        dic = {}
-        dic['p1'] = '\xf0'
-        dic['i1'] = '\xf1'
-        dic['d1'] = '\xf2'
-        dic['p2'] = '\xf3'
-        dic['i2'] = '\xf4'
-        dic['d2'] = '\xf5'
-        for key in pid_dic.keys():
-            byte_temp =  pack('h',round(pid_dic[key],0))    
-            self._inquire(dic[key]+byte_temp,1)
-            sleep(0.5)
+                result[name] = unpack('h',replies[code][1:3])[0]/10.
+        if missing and len(reply) > 0:
+            self.query_stats.count('mismatches',missing)
+            #one timing error per exchange, a short reply counted already
+            if self.timing is not None and len(reply) == N:
+                self.timing.error()
+        return result
+
+    def get_PID(self):
+        """
+        returns p1,i1,d1,p2,i2,d2 pid parameters as dictionary
+        """
+        return self.read_many(['p1','i1','d1','p2','i2','d2'])
+
+    def start_publishing(self,name = None,period = 1.0):
+        """
+        writes target temperature, actual temperature, limits, faults and
+        PID parameters every period seconds into a shared memory block, for
+        DriverState readers in other processes (see shared_state.py)
+
+        name: of the block, default: self.name
+        """
+        from shared_state import Publisher
+        self.stop_publishing()
+        self.publisher = Publisher(self,name or self.name,period)
+        self.publisher.start()
+
+    def stop_publishing(self):
+        if self.__dict__.get('publisher') is not None:
+            self.publisher.stop()
+        self.publisher = None
+
+    def state(self):
+        """
+        returns all parameters in one round trip as dictionary with the
+        field names of shared_state.py
+        """
+        names = ['target_temperature','actual_temperature','lower_limit',
+            'upper_limit','faults','p1','i1','d1','p2','i2','d2']
+        values = self.read_many(names)
+        state = {}
+        state['set_point'] = values.get('target_temperature',nan)
+        state['actual_temperature'] = values.get('actual_temperature',nan)
+        state['low_limit'] = values.get('lower_limit',nan)
+        state['high_limit'] = values.get('upper_limit',nan)
+        state['fault_bits'] = values.get('fault_bits',nan)
+        for name in ['p1','i1','d1','p2','i2','d2']:
+            state[name] = values.get(name,nan)
+        return state
+
+    def set_default_PID(self):
+        """
+        sets the factory PID parameters, see set_PID
+        """
+        return self.set_PID(dict(factory_PID))
 
     def set_PID(self, pid_dic = None):
         """sets p1,i1,d1,p2,i2,d2 pid parameters submitted as dictionary
+        (default: factory settings). The current parameters are read in one
+        round trip and only those that differ are written, back-to-back in
+        a second one. Each write is confirmed by its echoed reply code. If a
+        write fails, the parameters already changed are restored.
 
         example: {'p2': 50, 'p1': 90, 'i1': 32, 'i2': 35, 'd2': 3, 'd1': 2}
+        returns dictionary {name: result}, result one of 'unchanged',
+        'written', 'failed', 'rolled back'
         """
-        pid_dic = {}
-        #factory settings: good settings
-        pid_dic['p1'] = 90
-        pid_dic['i1'] = 32
-        pid_dic['d1'] = 2
-        pid_dic['p2'] = 50
-        pid_dic['i2'] = 35
-        pid_dic['d2'] = 3
-        dic = {}
-        dic['p1'] = '\xf0'
-        dic['i1'] = '\xf1'
-        dic['d1'] = '\xf2'
-        dic['p2'] = '\xf3'
-        dic['i2'] = '\xf4'
-        dic['d2'] = '\xf5'
+        if pid_dic is None:
+            pid_dic = dict(factory_PID)
         for key in pid_dic.keys():
-            byte_temp =  pack('h',round(pid_dic[key],0))    
-            self._inquire(dic[key]+byte_temp,1)
-            sleep(0.5)
-##            
-        
+            if key not in factory_PID:
+                raise ValueError('set_PID: unknown parameter %r' % key)
+        wanted = dict([(key,int(round(pid_dic[key]))) for key in pid_dic.keys()])
+        current = self.read_many(list(wanted.keys()))
+        changes = dict([(key,value) for key,value in wanted.items()
+            if current.get(key) != value])
+        result = dict([(key,'unchanged') for key in wanted.keys() if key not in changes])
+        if not changes:
+            debug('set_PID: no changes')
+            return result
+        written = self.write_many(changes)
+        failed = [key for key in changes.keys() if not written[key]]
+        for key in changes.keys():
+            result[key] = 'failed' if key in failed else 'written'
+        if failed:
+            warning('set_PID: %s not confirmed, restoring %r' % (failed,current))
+            restore = dict([(key,current[key]) for key in changes.keys()
+                if written[key] and not isnan(current[key])])
+            restored = self.write_many(restore)
+            for key in restore.keys():
+                if restored[key]:
+                    result[key] = 'rolled back'
+        return result
 
-        
+    def write_many(self,values):
+        """
+        writes several parameters in one round trip: the write commands are
+        sent back-to-back and each is confirmed by its echoed reply code
+
+        values: dictionary {name: value}, names of self.read_commands,
+        temperatures in C, PID parameters as integers
+        returns dictionary {name: True if confirmed}
+        """
+        result = {}
+        if 'ser' not in self.__dict__.keys() or not self.ser.isOpen():
+            return dict([(name,False) for name in values.keys()])
+        names = list(values.keys())
+        codes = [self.read_commands[name] | 0x20 for name in names]
+        command = b''
+        for name,code in zip(names,codes):
+            if code >= 0xF0:
+                count = int(round(values[name]))
+            else:
+                count = int(round(values[name]*10))
+            command += bytearray([code]) + pack('h',count)
+        N = sum([reply_length(code) for code in codes])
+        reply = self._transact(command,N)
+        replies = demultiplex(codes,reply)
+        for name,code in zip(names,codes):
+            result[name] = code in replies
+            if not result[name]:
+                warning('write_many: no reply to 0x%X (%s)' % (code,name))
+        if len(replies) < len(codes) and len(reply) > 0:
+            self.query_stats.count('mismatches')
+        return result
 
-driver = Driver()
+def __getattr__(name):
+    """
+    driver: the module's Driver instance, created on first access instead
+    of at import time
+    """
+    global driver
+    if name != 'driver':
+        raise AttributeError('module %r has no attribute %r' % (__name__,name))
+    with _singleton_lock:
+        if 'driver' not in globals():
+            driver = Driver()
+    return driver
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+_singleton_lock = allocate_lock()
         
 if __name__ == "__main__": #for testing
     from tempfile import gettempdir
     import logging
     logging.basicConfig(#filename=gettempdir()+'/di245_DL.log',
                         level=logging.DEBUG, format="%(asctime)s %(levelname)s: %(message)s")
+    driver = Driver()
     print('driver.find_port()')
     print('driver.actual_temperature')
     print('driver.target_temperature')
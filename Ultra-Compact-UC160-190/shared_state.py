@@ -0,0 +1,260 @@
+"""
+Latest chiller state in a shared memory block, for any number of local
+reader processes without serial I/O or IPC round trips
+
+The process owning the driver (and the serial port) publishes a snapshot
+every period seconds (driver.start_publishing). Readers in other processes
+attach to the block by name and read the values with plain memory loads.
+
+Layout (little-endian, 112 bytes):
+0   8s  magic "OASISSB1"
+8   Q   sequence counter, odd while the writer updates the values
+16  12d time, set_point, actual_temperature, low_limit, high_limit,
+        fault_bits, p1, i1, d1, p2, i2, d2 (temperatures in C,
+        nan = unreadable)
+
+Reads are lock-free (sequence lock): a reader takes the counter, the values
+and the counter again, and retries if the counter was odd or has changed.
+There is only one writer per block.
+
+Usage:
+owner:  driver.start_publishing() # block named after the driver
+reader: from shared_state import OasisChillerState
+        chiller = OasisChillerState("oasis_chiller")
+        chiller.RBV,chiller.faults,chiller.age
+        from shared_state import DriverState # serial_driver.Driver names
+        chiller = DriverState("oasis chiller driver")
+        chiller.target_temperature,chiller.get_PID()
+"""
+from logging import debug,info,warn
+from struct import Struct
+from math import isnan
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+nan = float("nan")
+magic = b"OASISSB1"
+fields = ("time","set_point","actual_temperature","low_limit","high_limit",
+    "fault_bits","p1","i1","d1","p2","i2","d2")
+header = Struct("<8sQ")
+counter = Struct("<Q")
+values = Struct("<%dd" % len(fields))
+value = Struct("<d")
+offsets = dict([(name,header.size+i*value.size) for i,name in enumerate(fields)])
+size = header.size+values.size
+max_retries = 10000 # reads while the writer holds the counter odd
+published = set() # names of the blocks written by this process
+
+def block_name(name):
+    """Shared memory name for a driver name ("oasis chiller driver" ->
+    "oasis_chiller_driver")"""
+    return name.replace(" ","_").replace("/","_")
+
+class StateWriter(object):
+    """Owner side: creates the block and updates it"""
+    def __init__(self,name):
+        from multiprocessing.shared_memory import SharedMemory
+        self.name = block_name(name)
+        try: self.memory = SharedMemory(self.name,create=True,size=size)
+        except FileExistsError:
+            # left over by an owner that did not shut down cleanly
+            self.memory = SharedMemory(self.name)
+            if self.memory.size < size:
+                self.memory.close()
+                self.memory.unlink()
+                self.memory = SharedMemory(self.name,create=True,size=size)
+        published.add(self.name)
+        self.buffer = self.memory.buf
+        self.lock = allocate_lock()
+        self.count = counter.unpack_from(self.buffer,8)[0]
+        if self.count & 1: self.count += 1
+        self.publish({})
+        header.pack_into(self.buffer,0,magic,self.count)
+        info("%s: publishing %d bytes of shared memory" % (self.name,size))
+
+    def publish(self,state):
+        """state: dictionary with (some of) fields, missing ones are nan"""
+        data = [state.get(name,nan) for name in fields]
+        with self.lock:
+            buffer = self.buffer
+            counter.pack_into(buffer,8,self.count+1)
+            values.pack_into(buffer,header.size,*data)
+            self.count += 2
+            counter.pack_into(buffer,8,self.count)
+
+    def close(self):
+        """Release and remove the block"""
+        if self.buffer is None: return
+        self.buffer.release()
+        self.buffer = None
+        self.memory.close()
+        try: self.memory.unlink()
+        except OSError: pass
+        published.discard(self.name)
+
+class StateReader(object):
+    """Reader side: attaches to the block of a running owner"""
+    def __init__(self,name="oasis_chiller"):
+        from multiprocessing.shared_memory import SharedMemory
+        self.name = block_name(name)
+        self.memory = SharedMemory(self.name)
+        # Before Python 3.13 the resource tracker of this process would
+        # remove the block when this process exits, as if it were its owner.
+        if self.name not in published:
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.memory._name,"shared_memory")
+            except Exception as msg: debug("%s: %s" % (self.name,msg))
+        self.buffer = self.memory.buf
+        if bytes(self.buffer[0:len(magic)]) != magic:
+            self.close()
+            raise IOError("%s: not a chiller state block" % self.name)
+
+    def close(self):
+        if self.buffer is None: return
+        self.buffer.release()
+        self.buffer = None
+        self.memory.close()
+
+    def value(self,name):
+        """Current value of one of fields, nan if unpublished"""
+        buffer,offset = self.buffer,offsets[name]
+        for i in range(0,max_retries):
+            count = counter.unpack_from(buffer,8)[0]
+            if count & 1: continue
+            result = value.unpack_from(buffer,offset)[0]
+            if counter.unpack_from(buffer,8)[0] == count: return result
+        warn("%s: %s: writer not finishing" % (self.name,name))
+        return nan
+
+    def snapshot(self):
+        """All fields from the same update, as dictionary"""
+        buffer = self.buffer
+        for i in range(0,max_retries):
+            count = counter.unpack_from(buffer,8)[0]
+            if count & 1: continue
+            data = values.unpack_from(buffer,header.size)
+            if counter.unpack_from(buffer,8)[0] == count:
+                return dict(zip(fields,data))
+        warn("%s: writer not finishing" % self.name)
+        return dict([(name,nan) for name in fields])
+
+    @property
+    def sequence(self):
+        """Number of updates published times 2"""
+        return counter.unpack_from(self.buffer,8)[0]
+
+    @property
+    def time(self): return self.value("time")
+
+    @property
+    def age(self):
+        """Seconds since the last update (large if the owner stopped)"""
+        from time import time
+        return time()-self.value("time")
+
+class OasisChillerState(StateReader):
+    """Properties of OasisChillerDriver, read from shared memory"""
+    @property
+    def nominal_temperature(self): return self.value("set_point")
+    VAL = nominal_temperature
+
+    @property
+    def actual_temperature(self): return self.value("actual_temperature")
+    RBV = actual_temperature
+
+    @property
+    def low_limit(self): return self.value("low_limit")
+    LLM = low_limit
+
+    @property
+    def high_limit(self): return self.value("high_limit")
+    HLM = high_limit
+
+    @property
+    def fault_code(self):
+        from oasis_protocol import fault_code
+        return fault_code(self.value("fault_bits"))
+
+    @property
+    def faults(self):
+        from oasis_protocol import describe_faults
+        return describe_faults(self.value("fault_bits"))
+
+class DriverState(StateReader):
+    """Properties of serial_driver.Driver, read from shared memory"""
+    def __init__(self,name="oasis chiller driver"):
+        StateReader.__init__(self,name)
+
+    @property
+    def target_temperature(self): return self.value("set_point")
+
+    @property
+    def actual_temperature(self): return self.value("actual_temperature")
+
+    @property
+    def lower_limit(self): return self.value("low_limit")
+
+    @property
+    def faults(self):
+        """(0,0) if there are no faults, (1,bit number) otherwise and None
+        if unreadable, as Driver.get_faults"""
+        from math import log
+        bits = self.value("fault_bits")
+        if isnan(bits): return None
+        res = int(bits)-256 if bits >= 128 else int(bits) # signed byte
+        if res == 0: return (0,0)
+        return (1,int(log(abs(res),2)))
+
+    def get_PID(self):
+        """p1,i1,d1,p2,i2,d2 PID parameters as dictionary"""
+        state = self.snapshot()
+        return dict([(name,state[name] if isnan(state[name]) else int(state[name]))
+            for name in ("p1","i1","d1","p2","i2","d2")])
+
+class Publisher(object):
+    """Thread writing driver.state() into a StateWriter every period
+    seconds, as background telemetry (see command_scheduler.py)"""
+    def __init__(self,driver,name,period=1.0):
+        from threading import Event
+        self.driver = driver
+        self.writer = StateWriter(name)
+        self.period = period
+        self.thread = None
+        self.stop_event = Event()
+
+    @property
+    def running(self): return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        from threading import Thread
+        if self.running: return
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run,name="publisher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+        self.writer.close()
+
+    def run(self):
+        from time import time
+        from command_scheduler import BACKGROUND
+        self.driver.thread_priority = BACKGROUND
+        next_time = time()
+        while not self.stop_event.is_set():
+            try: self.publish()
+            except Exception as msg: warn("publisher: %s" % msg)
+            next_time += self.period
+            if next_time < time(): next_time = time()
+            self.stop_event.wait(next_time - time())
+
+    def publish(self):
+        from time import time
+        state = self.driver.state()
+        state["time"] = time()
+        self.writer.publish(state)
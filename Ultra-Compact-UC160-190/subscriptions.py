@@ -0,0 +1,90 @@
+"""
+Change-driven notifications from the shared background sampler
+
+Instead of every consumer polling the chiller, consumers subscribe to a
+value and the one Sampler thread of the driver (sampler.py) drives all of
+them: serial traffic does not grow with the number of subscribers. A
+callback fires with an Event(name,value,time,previous) when
+- a temperature moves more than deadband away from the value last reported
+  to this subscriber (the first sample is always reported, and so is a
+  value becoming unreadable (nan) or readable again)
+- the fault byte changes (value ^ previous are the fault bits that
+  changed; -1 = unreadable)
+time is the time the sample was taken.
+
+Names: actual_temperature (alias RBV), nominal_temperature (aliases VAL,
+set_point), faults
+
+Usage:
+def report(event): print(event.name,event.value,event.time)
+subscription = driver.subscribe("actual_temperature",report,deadband=0.1)
+driver.subscribe("faults",report)
+driver.unsubscribe(subscription)
+"""
+from collections import namedtuple
+from logging import warn
+from math import isnan
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+Event = namedtuple("Event","name value time previous")
+
+# subscription name: index in the sample (time,set_point,actual_temperature,faults)
+fields = {
+    "nominal_temperature": 1, "VAL": 1, "set_point": 1,
+    "actual_temperature": 2, "RBV": 2,
+    "faults": 3,
+}
+
+class Subscription(object):
+    """One callback watching one value"""
+    def __init__(self,name,callback,deadband=0.0):
+        if name not in fields: raise KeyError("unknown value %r, known: %s" %
+            (name,", ".join(sorted(fields))))
+        self.name = name
+        self.callback = callback
+        self.deadband = deadband
+        self.index = fields[name]
+        self.last = None # value last reported
+
+    def changed(self,value):
+        """Is value different enough from the one last reported?"""
+        last = self.last
+        if last is None: return True
+        if self.index == 3: return value != last
+        if isnan(value) or isnan(last): return isnan(value) != isnan(last)
+        return abs(value-last) > self.deadband
+
+    def update(self,sample):
+        value = sample[self.index]
+        if not self.changed(value): return
+        previous,self.last = self.last,value
+        self.callback(Event(self.name,value,sample[0],previous))
+
+class Subscriptions(object):
+    """All subscriptions of a driver, called by the Sampler with every
+    sample"""
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = allocate_lock()
+
+    def __len__(self): return len(self.subscriptions)
+
+    def subscribe(self,name,callback,deadband=0.0):
+        subscription = Subscription(name,callback,deadband)
+        with self.lock: self.subscriptions = self.subscriptions+[subscription]
+        return subscription
+
+    def unsubscribe(self,subscription):
+        """subscription: as returned by subscribe, or the callback"""
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions
+                if s is not subscription and s.callback != subscription]
+
+    def __call__(self,sample):
+        for subscription in self.subscriptions:
+            try: subscription.update(sample)
+            except Exception as msg:
+                warn("subscription %r: %s: %s" % (subscription.name,
+                    subscription.callback,msg))
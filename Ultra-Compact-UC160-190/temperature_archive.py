@@ -0,0 +1,256 @@
+"""
+Long-term on-disk archive of chiller temperatures with a decimation pyramid
+
+TemperatureArchive stores the samples taken by the Sampler (time, set point,
+actual temperature, faults) in a directory with one subdirectory per level:
+level 0 holds the raw samples, each higher level one summary record per
+time bucket (resolutions: 10 s, 1 min, 10 min, 1 h, 6 h) with the number of
+samples, mean set point, minimum, maximum and mean actual temperature and the
+bitwise OR of the fault bytes.
+
+Each level is a series of chunks of chunk_size records. Completed chunks are
+.npy files, written once under a temporary name and renamed into place, so
+they are never modified afterwards. The chunk being filled is a .part file of
+raw records, appended to sample by sample. After a crash, a partly written
+record at the end of a .part file is cut off and the open buckets of the
+summary levels are rebuilt from the raw samples; completed chunks are not
+touched. Memory use is bounded by the open buckets and a small cache of
+memory-mapped chunks.
+
+query(start,end) picks the finest level that has at most max_points records
+in the window and reads only the chunks overlapping it, so plotting a month
+costs about as much as plotting an hour.
+
+Usage:
+driver.start_archiving("/data/oasis_chiller")
+archive = driver.archive
+data = archive.query(time()-30*86400,time()) # time,count,set_point,
+    # actual_min,actual_max,actual_mean,faults
+"""
+from logging import warn
+from numpy import dtype as numpy_dtype,zeros,fromfile,load,concatenate,\
+    searchsorted,isnan,nan
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+from sampler import dtype as sample_dtype
+sample_dtype = numpy_dtype(sample_dtype)
+summary_dtype = numpy_dtype([("time","f8"),("count","i4"),("set_point","f8"),
+    ("actual_min","f8"),("actual_max","f8"),("actual_mean","f8"),("faults","i2")])
+resolutions = (10,60,600,3600,21600) # seconds per bucket of levels 1,2,...
+
+class Bucket(object):
+    """Running summary of the samples of one time bucket"""
+    def __init__(self,start):
+        self.start = start
+        self.count = 0 # samples
+        self.set_point_sum,self.set_point_count = 0.0,0
+        self.sum,self.valid = 0.0,0 # of the readable actual temperatures
+        self.min,self.max = nan,nan
+        self.faults = -1
+
+    def add(self,set_point,actual_temperature,faults):
+        self.count += 1
+        if not isnan(set_point):
+            self.set_point_sum += set_point
+            self.set_point_count += 1
+        if not isnan(actual_temperature):
+            if self.valid == 0: self.min = self.max = actual_temperature
+            self.min = min(self.min,actual_temperature)
+            self.max = max(self.max,actual_temperature)
+            self.sum += actual_temperature
+            self.valid += 1
+        if faults >= 0: self.faults = max(self.faults,0) | faults
+
+    def record(self):
+        return (self.start,self.count,
+            self.set_point_sum/self.set_point_count if self.set_point_count else nan,
+            self.min,self.max,self.sum/self.valid if self.valid else nan,self.faults)
+
+class Level(object):
+    """Append-only chunked record series in one directory"""
+    def __init__(self,directory,dtype,chunk_size):
+        from os import makedirs
+        from os.path import exists
+        self.directory = directory
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        if not exists(directory): makedirs(directory)
+        self.starts = [] # time of the first record of each completed chunk
+        self.cache = {} # chunk number: memory-mapped array
+        self.recover()
+
+    def chunk_name(self,i): return "%s/%08d.npy" % (self.directory,i)
+    def part_name(self,i): return "%s/%08d.part" % (self.directory,i)
+
+    def recover(self):
+        """Scan the completed chunks and repair the open one"""
+        from os import listdir,remove
+        from os.path import exists,getsize
+        chunks = sorted([f for f in listdir(self.directory) if f.endswith(".npy")])
+        for i,f in enumerate(chunks):
+            if f != "%08d.npy" % i:
+                warn("%s: chunk %s out of sequence, ignoring the rest" % (self.directory,f))
+                break
+            self.starts += [float(self.chunk(i)["time"][0])]
+        for f in listdir(self.directory):
+            if f.endswith(".tmp"): remove("%s/%s" % (self.directory,f))
+        n = len(self.starts)
+        part = self.part_name(n)
+        if exists(part):
+            size = getsize(part)
+            if size % self.dtype.itemsize:
+                warn("%s: dropping partly written record" % part)
+                with open(part,"r+b") as f: f.truncate(size-size % self.dtype.itemsize)
+        # a chunk completed just before a crash leaves its .part file behind
+        if exists(self.part_name(n-1)): remove(self.part_name(n-1))
+        self.part = open(part,"ab")
+        self.part_count = getsize(part)//self.dtype.itemsize
+
+    def chunk(self,i):
+        if i not in self.cache:
+            if len(self.cache) >= 16: self.cache.clear()
+            self.cache[i] = load(self.chunk_name(i),mmap_mode="r")
+        return self.cache[i]
+
+    def open_records(self):
+        """Records of the chunk being filled"""
+        self.part.flush()
+        return fromfile(self.part_name(len(self.starts)),dtype=self.dtype)
+
+    def append(self,record):
+        from numpy import array
+        self.part.write(array([record],dtype=self.dtype).tobytes())
+        self.part.flush()
+        self.part_count += 1
+        if self.part_count >= self.chunk_size: self.complete()
+
+    def complete(self):
+        """Turn the open chunk into an immutable .npy file"""
+        from os import remove,rename,fsync
+        from numpy import save
+        data = self.open_records()
+        n = len(self.starts)
+        temporary = self.chunk_name(n)+".tmp"
+        with open(temporary,"wb") as f:
+            save(f,data)
+            f.flush()
+            fsync(f.fileno())
+        rename(temporary,self.chunk_name(n))
+        self.starts += [float(data["time"][0])]
+        self.part.close()
+        remove(self.part_name(n))
+        self.part = open(self.part_name(n+1),"ab")
+        self.part_count = 0
+
+    def last_time(self):
+        """Time of the last record, None if empty"""
+        if self.part_count: return float(self.open_records()["time"][-1])
+        if self.starts: return float(self.chunk(len(self.starts)-1)["time"][-1])
+        return None
+
+    def range(self,start,end):
+        """Records with start <= time < end"""
+        from bisect import bisect_right
+        first = max(bisect_right(self.starts,start)-1,0)
+        last = bisect_right(self.starts,end)
+        parts = [self.chunk(i) for i in range(first,min(last,len(self.starts)))]
+        if last >= len(self.starts): parts += [self.open_records()]
+        if len(parts) == 0: return zeros(0,dtype=self.dtype)
+        data = concatenate(parts)
+        return data[searchsorted(data["time"],start):searchsorted(data["time"],end)].copy()
+
+    def close(self): self.part.close()
+
+class TemperatureArchive(object):
+    """Raw samples plus min/max/mean summaries at several resolutions"""
+    chunk_size = 4096 # records per chunk file
+
+    def __init__(self,directory,period=1.0):
+        """period: sampling period in seconds, used to pick the raw level"""
+        self.directory = directory
+        self.period = period
+        self.lock = allocate_lock()
+        self.levels = [Level(directory+"/level0",sample_dtype,self.chunk_size)]
+        for r in resolutions:
+            self.levels += [Level(directory+"/level%d" % (len(self.levels)),
+                summary_dtype,self.chunk_size)]
+        self.buckets = [None]*len(resolutions)
+        self.rebuild_buckets()
+        self.last_time = self.levels[0].last_time()
+
+    def rebuild_buckets(self):
+        """Restore the open buckets from the raw samples after a restart"""
+        for i,r in enumerate(resolutions):
+            last = self.levels[i+1].last_time()
+            since = last+r if last is not None else 0.0
+            for sample in self.levels[0].range(since,float("inf")):
+                self.add_to_bucket(i,sample)
+
+    def append(self,sample):
+        """sample: (time,set_point,actual_temperature,faults)"""
+        from numpy import array
+        sample = array([sample],dtype=sample_dtype)[0]
+        with self.lock:
+            if self.last_time is not None and sample["time"] <= self.last_time:
+                warn("archive: ignoring sample older than the last one")
+                return
+            self.last_time = float(sample["time"])
+            self.levels[0].append(sample)
+            for i in range(0,len(resolutions)): self.add_to_bucket(i,sample)
+
+    def add_to_bucket(self,i,sample):
+        t = float(sample["time"])
+        start = t - t % resolutions[i]
+        bucket = self.buckets[i]
+        if bucket is not None and bucket.start != start:
+            self.levels[i+1].append(bucket.record())
+            bucket = None
+        if bucket is None: bucket = self.buckets[i] = Bucket(start)
+        bucket.add(float(sample["set_point"]),float(sample["actual_temperature"]),
+            int(sample["faults"]))
+
+    def resolution(self,start,end,max_points=1000):
+        """Level to use for a window: the finest one with at most max_points
+        records"""
+        if (end-start)/self.period <= max_points: return 0
+        for i,r in enumerate(resolutions):
+            if (end-start)/r <= max_points: return i+1
+        return len(resolutions)
+
+    def query(self,start,end,max_points=1000):
+        """Summary records (summary_dtype) of the buckets overlapping
+        start <= time < end at the finest resolution with at most about
+        max_points records, including the bucket still being filled"""
+        with self.lock:
+            level = self.resolution(start,end,max_points)
+            if level == 0: return summary(self.levels[0].range(start,end))
+            r = resolutions[level-1]
+            data = self.levels[level].range(start-r,end)
+            data = data[data["time"]+r > start]
+            bucket = self.buckets[level-1]
+            if bucket is not None and bucket.start+r > start and bucket.start < end:
+                from numpy import array
+                data = concatenate([data,array([bucket.record()],dtype=summary_dtype)])
+            return data
+
+    def raw(self,start,end):
+        """Samples (time,set_point,actual_temperature,faults) with
+        start <= time < end"""
+        with self.lock: return self.levels[0].range(start,end)
+
+    def close(self):
+        with self.lock:
+            for level in self.levels: level.close()
+
+def summary(samples):
+    """Raw samples as summary records of one sample each"""
+    data = zeros(len(samples),dtype=summary_dtype)
+    data["time"] = samples["time"]
+    data["count"] = 1
+    data["set_point"] = samples["set_point"]
+    for name in "actual_min","actual_max","actual_mean":
+        data[name] = samples["actual_temperature"]
+    data["faults"] = samples["faults"]
+    return data
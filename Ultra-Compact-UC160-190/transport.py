@@ -0,0 +1,213 @@
+"""
+Serial transports for the chiller drivers: local serial ports and chillers
+behind serial-to-Ethernet terminal servers
+
+open_port(name) accepts
+/dev/ttyUSB0, COM3          local serial port (serial.Serial)
+socket://host:port          raw TCP (terminal server in "TCP server" mode)
+tcp://host:port             same as socket://
+rfc2217://host:port         Telnet COM port control (RFC 2217), the baud
+                            rate is set on the terminal server's port
+
+Network connections are pooled: closing a port returns its connection to
+the pool and the next open of the same URL reuses it, so reconnecting and
+the ID probe need no new TCP (and Telnet) handshake. A connection is only
+reused if the peer has not closed it and its last read did not time out;
+otherwise it is closed and a new one is made.
+Sockets have TCP_NODELAY, so that the 1-3 byte commands are not held back
+by Nagle's algorithm, and keepalive, so that a terminal server that went
+away is noticed on an idle connection.
+
+Usage:
+from transport import open_port
+port = open_port("socket://192.168.1.50:4001",baudrate=9600,timeout=1.0)
+port.write(b"A"); port.read(3)
+port.close() # back to the pool
+transport.close_all()
+"""
+from logging import debug,info
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+
+keepalive_idle = 10 # seconds idle before the first keepalive probe
+keepalive_interval = 5 # seconds between probes
+keepalive_count = 3 # unanswered probes before the connection is dropped
+
+def is_url(name):
+    """Network port name (socket://, tcp://, rfc2217://)?"""
+    return "://" in name
+
+def open_port(name,baudrate=9600,timeout=1.0,exclusive=False):
+    """Open port object for a device name or URL.
+    exclusive: local ports only; a pooled connection is never given to two
+    users at a time"""
+    if not is_url(name):
+        from serial import Serial
+        # pyserial on Windows is always exclusive and rejects exclusive=False
+        return Serial(name,baudrate=baudrate,timeout=timeout,
+            exclusive=exclusive or None)
+    port = PooledPort(name,baudrate,timeout)
+    port.open()
+    return port
+
+def tune_socket(sock):
+    """TCP_NODELAY and keepalive"""
+    import socket
+    sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+    for option,value in [("TCP_KEEPIDLE",keepalive_idle),
+        ("TCP_KEEPINTVL",keepalive_interval),("TCP_KEEPCNT",keepalive_count)]:
+        if hasattr(socket,option):
+            sock.setsockopt(socket.IPPROTO_TCP,getattr(socket,option),value)
+
+def alive(connection):
+    """Has the peer not closed the connection? Discards unread input"""
+    from select import select
+    try:
+        if not connection.is_open: return False
+        if rfc2217(connection):
+            # The Telnet reader thread ends at EOF. Stale data is drained
+            # locally, reset_input_buffer would be a round trip.
+            if not connection._thread.is_alive(): return False
+            while connection.in_waiting: connection.read(connection.in_waiting)
+        else:
+            # raw socket: readable means stale data or end of stream, where
+            # pyserial's read raises SerialException
+            while select([connection._socket],[],[],0)[0]: connection.read(1)
+    except Exception as msg:
+        debug("%s: %s" % (connection.portstr,msg))
+        return False
+    return True
+
+def rfc2217(connection):
+    """pyserial RFC 2217 client?"""
+    return getattr(connection,"_thread",None) is not None
+
+def set_timeout(connection,timeout):
+    """pyserial's RFC 2217 client sends all port settings to the terminal
+    server (two round trips) on every change of the timeout, which only
+    matters locally"""
+    if connection.timeout == timeout: return
+    if rfc2217(connection): connection._timeout = timeout
+    else: connection.timeout = timeout
+
+class Pool(object):
+    """Idle network connections by URL"""
+    def __init__(self):
+        self.idle = {} # URL: pyserial connection
+        self.lock = allocate_lock()
+        self.connects = 0 # new connections made
+        self.reuses = 0 # connections taken from the pool
+
+    def take(self,url,baudrate,timeout):
+        """Idle connection to url if still usable, else a new one"""
+        with self.lock: connection = self.idle.pop(url,None)
+        if connection is not None:
+            if alive(connection):
+                self.reuses += 1
+                set_timeout(connection,timeout)
+                return connection
+            debug("%s: pooled connection lost" % url)
+            close(connection)
+        return self.connect(url,baudrate,timeout)
+
+    def connect(self,url,baudrate,timeout):
+        from serial import serial_for_url
+        if url.startswith("tcp://"): url = "socket://"+url[len("tcp://"):]
+        connection = serial_for_url(url,baudrate=baudrate,timeout=timeout)
+        try: tune_socket(connection._socket)
+        except Exception as msg: debug("%s: %s" % (url,msg))
+        self.connects += 1
+        info("%s: connected" % url)
+        return connection
+
+    def release(self,url,connection):
+        """Keep connection for the next open of url"""
+        with self.lock: connection,self.idle[url] = self.idle.get(url),connection
+        if connection is not None: close(connection) # only one per URL
+
+    def close_all(self):
+        with self.lock: connections,self.idle = list(self.idle.values()),{}
+        for connection in connections: close(connection)
+
+def close(connection):
+    try: connection.close()
+    except Exception as msg: debug("%s" % msg)
+
+pool = Pool()
+
+def close_all():
+    """Close the idle pooled connections"""
+    pool.close_all()
+
+class PooledPort(object):
+    """Port object of a pooled network connection. Behaves like
+    serial.Serial; close() returns the connection to the pool, unless the
+    last read timed out"""
+    def __init__(self,url,baudrate=9600,timeout=1.0):
+        self.url = url
+        self.baudrate = baudrate
+        self.connection = None
+        self.timed_out = False
+        self.__timeout__ = timeout
+
+    @property
+    def name(self): return self.url
+    port = name
+
+    @property
+    def is_open(self): return self.connection is not None
+
+    def open(self):
+        if self.connection is not None: return
+        self.connection = pool.take(self.url,self.baudrate,self.__timeout__)
+        self.timed_out = False
+
+    def close(self):
+        connection,self.connection = self.connection,None
+        if connection is None: return
+        if self.timed_out: close(connection)
+        else: pool.release(self.url,connection)
+
+    def discard(self):
+        """Close the connection instead of returning it to the pool"""
+        self.timed_out = True
+        self.close()
+
+    def get_timeout(self): return self.__timeout__
+    def set_timeout(self,value):
+        self.__timeout__ = value
+        if self.connection is not None: set_timeout(self.connection,value)
+    timeout = property(get_timeout,set_timeout)
+
+    def write(self,data): return self.__connection__.write(data)
+
+    def read(self,size=1):
+        data = self.__connection__.read(size)
+        self.timed_out = len(data) < size
+        return data
+
+    def readinto(self,buffer):
+        n = self.__connection__.readinto(buffer)
+        self.timed_out = n < len(buffer)
+        return n
+
+    def read_until(self,expected=b"\n",size=None):
+        data = self.__connection__.read_until(expected,size)
+        self.timed_out = not data.endswith(expected) and \
+            (size is None or len(data) < size)
+        return data
+
+    @property
+    def __connection__(self):
+        if self.connection is None:
+            from serial import SerialException
+            raise SerialException("%s: port not open" % self.url)
+        return self.connection
+
+    def __getattr__(self,name):
+        # in_waiting, reset_input_buffer, flush, ...
+        return getattr(self.__connection__,name)
+
+    def __repr__(self): return "PooledPort(%r)" % self.url
@@ -0,0 +1,197 @@
+"""
+Binary recording of the serial traffic of the Oasis chiller drivers
+
+WireRecorder appends every frame sent (TX) and received (RX) to a
+memory-mapped file of fixed-size 24-byte records:
+time (float64, monotonic clock), direction (0 = TX, 1 = RX), code (first
+byte of the frame), length (payload bytes in this record), flags (bit 0 =
+continuation of the previous record's frame), payload (12 bytes).
+Received data is split into one record per reply (the reply length follows
+from the echoed command byte), so pipelined read_many replies decode like
+single ones; commands longer than 12 bytes continue in the following
+records. The 16-byte file header holds a magic string and the
+number of records, updated after every record, so a crash loses at most the
+record being written.
+
+Offline, load() maps a capture of any size as NumPy structured array without
+reading it into memory, and temperatures() / faults() decode all replies in
+vectorized form. ReplayPort feeds a recorded session back into a driver in
+place of the serial port.
+
+Usage:
+driver.start_recording("/tmp/oasis.rec")
+driver.stop_recording()
+records = load("/tmp/oasis.rec")
+temperatures(records)["temperature"]
+faults(records)["bits"]
+driver.port = ReplayPort("/tmp/oasis.rec")
+"""
+from struct import Struct
+from numpy import dtype as numpy_dtype
+
+try: from thread import allocate_lock
+except ImportError: from _thread import allocate_lock
+try: from time import monotonic
+except ImportError: from time import time as monotonic
+
+TX,RX = 0,1
+CONTINUED = 1
+magic = b"OASISWR1"
+header = Struct("<8sQ") # magic, number of records
+record = Struct("<dBBBB12s")
+payload_size = 12
+dtype = numpy_dtype([("time","<f8"),("direction","u1"),("code","u1"),
+    ("length","u1"),("flags","u1"),("payload","u1",(payload_size,))])
+assert dtype.itemsize == record.size
+
+class WireRecorder(object):
+    """Append-only memory-mapped frame log"""
+    grow_records = 65536 # file grows in steps of this many records
+
+    def __init__(self,filename):
+        from os.path import exists,getsize
+        self.filename = filename
+        self.lock = allocate_lock()
+        if not exists(filename) or getsize(filename) < header.size:
+            with open(filename,"wb") as f: f.write(header.pack(magic,0))
+        self.file = open(filename,"r+b")
+        self.mmap = None
+        self.capacity = 0
+        self.count = 0
+        self.map(max(self.file_records(),self.grow_records))
+        file_magic,self.count = header.unpack_from(self.mmap,0)
+        if file_magic != magic: raise IOError("%s: not a wire recording" % filename)
+
+    def file_records(self):
+        from os import fstat
+        return (fstat(self.file.fileno()).st_size-header.size)//record.size
+
+    def map(self,capacity):
+        """(Re)map the file with room for capacity records"""
+        from mmap import mmap
+        if self.mmap is not None: self.mmap.close()
+        self.file.truncate(header.size+capacity*record.size)
+        self.mmap = mmap(self.file.fileno(),header.size+capacity*record.size)
+        self.capacity = capacity
+
+    def record(self,direction,data):
+        """Append the bytes sent (TX) or received (RX)"""
+        if not data: return
+        t = monotonic()
+        data = bytearray(data)
+        with self.lock:
+            if self.mmap is None: return
+            for frame in (split(data) if direction == RX else [data]):
+                for i in range(0,len(frame),payload_size):
+                    chunk = bytes(frame[i:i+payload_size])
+                    if self.count >= self.capacity:
+                        self.map(self.capacity+self.grow_records)
+                    record.pack_into(self.mmap,header.size+self.count*record.size,
+                        t,direction,frame[0],len(chunk),CONTINUED if i else 0,chunk)
+                    self.count += 1
+            header.pack_into(self.mmap,0,magic,self.count)
+
+    def sent(self,data): self.record(TX,data)
+    def received(self,data): self.record(RX,data)
+
+    def close(self):
+        """Flush and trim the file to the records written"""
+        with self.lock:
+            if self.mmap is None: return
+            self.mmap.flush()
+            self.mmap.close()
+            self.mmap = None
+            self.file.truncate(header.size+self.count*record.size)
+            self.file.close()
+
+def split(data):
+    """Received bytes as list of replies"""
+    from oasis_protocol import reply_length
+    frames = []
+    i = 0
+    while i < len(data):
+        n = reply_length(data[i])
+        frames += [data[i:i+n]]
+        i += n
+    return frames
+
+def load(filename):
+    """Recorded frames as read-only memory-mapped NumPy structured array"""
+    from numpy import memmap,zeros
+    with open(filename,"rb") as f:
+        file_magic,count = header.unpack(f.read(header.size))
+    if file_magic != magic: raise IOError("%s: not a wire recording" % filename)
+    if count == 0: return zeros(0,dtype=dtype) # memmap cannot map 0 bytes
+    return memmap(filename,dtype=dtype,mode="r",offset=header.size,shape=(count,))
+
+def replies(records,length):
+    """Complete RX replies of the given length"""
+    from numpy import flatnonzero
+    mask = (records["direction"] == RX) & (records["flags"] == 0) & \
+        (records["length"] == length)
+    return records[flatnonzero(mask)]
+
+def temperatures(records):
+    """All 16-bit read replies (set point 1, low limit 6, high limit 7,
+    actual temperature 9) as structured array: time, parameter,
+    temperature [C]"""
+    from numpy import zeros,isin
+    rx = replies(records,3)
+    parameter = rx["code"] & 0x1F
+    rx = rx[isin(parameter,[1,6,7,9]) & (rx["code"] & 0x20 == 0)]
+    result = zeros(len(rx),dtype=[("time","f8"),("parameter","u1"),("temperature","f8")])
+    result["time"] = rx["time"]
+    result["parameter"] = rx["code"] & 0x1F
+    payload = rx["payload"].astype("u2")
+    result["temperature"] = (payload[:,1] | (payload[:,2] << 8)).astype("i2")/10.
+    return result
+
+def faults(records):
+    """All fault replies as structured array: time, byte, bits (8 booleans,
+    bit 0 first)"""
+    from numpy import zeros,unpackbits
+    rx = replies(records,2)
+    rx = rx[(rx["code"] & 0x3F) == 8]
+    result = zeros(len(rx),dtype=[("time","f8"),("byte","u1"),("bits","?",(8,))])
+    result["time"] = rx["time"]
+    result["byte"] = rx["payload"][:,1]
+    result["bits"] = unpackbits(rx["payload"][:,1:2],axis=1,bitorder="little")
+    return result
+
+class ReplayPort(object):
+    """Stand-in for serial.Serial replaying a recorded session: each write
+    makes the RX frames that followed the next recorded TX frame readable"""
+    def __init__(self,filename):
+        self.name = self.port = filename
+        self.records = load(filename)
+        self.index = 0
+        self.buffer = b""
+        self.timeout = 1.0
+        self.baudrate = 9600
+        self.is_open = True
+
+    def write(self,data):
+        records = self.records
+        # skip to the next TX frame, then collect the RX frames after it
+        while self.index < len(records) and records[self.index]["direction"] != TX:
+            self.index += 1
+        self.index += 1
+        while self.index < len(records) and (records[self.index]["direction"] == RX
+            or records[self.index]["flags"] & CONTINUED):
+            r = records[self.index]
+            if r["direction"] == RX: self.buffer += r["payload"][0:r["length"]].tobytes()
+            self.index += 1
+        return len(data)
+
+    def read(self,count=1):
+        data,self.buffer = self.buffer[0:count],self.buffer[count:]
+        return data
+
+    @property
+    def in_waiting(self): return len(self.buffer)
+    def inWaiting(self): return len(self.buffer)
+    def isOpen(self): return self.is_open
+    def reset_input_buffer(self): self.buffer = b""
+    def flushInput(self): self.buffer = b""
+    def flushOutput(self): pass
+    def close(self): self.is_open = False